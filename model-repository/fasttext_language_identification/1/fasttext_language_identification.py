@@ -1,5 +1,7 @@
+from collections import defaultdict
 import fasttext
 from huggingface_hub import hf_hub_download
+import itertools
 import json
 import numpy as np
 import re
@@ -55,10 +57,18 @@ class TritonPythonModel:
         """Predict the language id of the text provided in the request. Newlines are
         stripped since they throw an error.
 
+        Each request may contain several texts along the batch dimension, i.e.,
+        INPUT_TEXT has shape [n, 1]. All the texts in the dynamic batch that share the
+        same `top_k` and `threshold` are sent through a single call to
+        `self.model.predict`. Outputs have shape [n, k] with one row per text.
+
         Default behavior has `top_k` = 1 and `threshold` = 0.0. You can set the `top_k`
         and `threshold` via request parameters to enable returning more than the top
         result and use the threshold to only return predictions whose probability
-        exceeds the threshold value.
+        exceeds the threshold value. If a text has fewer than k predictions exceeding
+        the threshold, its row is padded with "" for SRC_LANG & SRC_SCRIPT and 0.0 for
+        the PROBABILITY. Outputs always have at least one column, so a text without any
+        prediction exceeding the threshold gets a row of "" and 0.0.
 
         Parameters
         ----------
@@ -75,14 +85,18 @@ class TritonPythonModel:
             f"fasttext_language_identification received {batch_size} requests"
         )
         responses = [None] * batch_size
+        # Group the texts by (top_k, threshold) so each group is one predict call
+        # groups = {(top_k, threshold): {batch_id: [input_text_cleaned, ...]}}
+        groups = defaultdict(dict)
         for batch_id, request in enumerate(requests):
-            # Handle any request parameters
-            request_params = json.loads(request.parameters())
-            top_k = request_params.get("top_k", self.default_top_k)
-            threshold = request_params.get("threshold", self.default_threshold)
-
-            # Get INPUT_TEXT from request. This is a Triton Tensor
             try:
+                # Handle any request parameters
+                request_params = json.loads(request.parameters())
+                top_k = int(request_params.get("top_k", self.default_top_k))
+                threshold = float(
+                    request_params.get("threshold", self.default_threshold)
+                )
+                # Get INPUT_TEXT from request. This is a Triton Tensor
                 input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
             except Exception as exc:
                 response = pb_utils.InferenceResponse(
@@ -94,45 +108,73 @@ class TritonPythonModel:
                 continue
 
             # Convert Triton Tensor (TYPE_STRING) to numpy (dtype=np.object_)
-            # Array has just one element (config.pbtxt has dims: [1])
+            # Array has one element per text (config.pbtxt has dims: [1])
             # TYPE_STRING is bytes when sending through a request. Decode to get str
-            input_text = input_text_tt.as_numpy().reshape(-1)[0].decode("utf-8")
             # Replace newlines with ' '. FastText breaks on \n
-            input_text_cleaned = self.REMOVE_NEWLINE.sub(" ", input_text)
+            groups[(top_k, threshold)][batch_id] = [
+                self.REMOVE_NEWLINE.sub(" ", b.decode("utf-8"))
+                for b in input_text_tt.as_numpy().reshape(-1)
+            ]
 
+        for (top_k, threshold), group in groups.items():
+            input_texts_cleaned = list(itertools.chain.from_iterable(group.values()))
             # Run through the model
             try:
                 output_labels, probs = self.model.predict(
-                    input_text_cleaned, k=top_k, threshold=threshold
+                    input_texts_cleaned, k=top_k, threshold=threshold
                 )
             except Exception as exc:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(f"{exc}")
-                )
-                responses[batch_id] = response
+                for batch_id in group:
+                    response = pb_utils.InferenceResponse(
+                        error=pb_utils.TritonError(f"{exc}")
+                    )
+                    responses[batch_id] = response
                 continue
 
-            src_langs = []
-            src_scripts = []
-            for output_label in output_labels:
-                # Returns '__label__<lang_id>_<script>', e.g., '__label__spa_Latn'
-                src_lang, src_script = output_label.replace("__label__", "").split("_")
-                src_langs.append(src_lang)
-                src_scripts.append(src_script)
-
-            # Make Triton Inference Response
-            src_lang_tt = pb_utils.Tensor(
-                "SRC_LANG",
-                np.array(src_langs, dtype=self.src_lang_dtype).reshape(1, -1),
-            )
-            src_script_tt = pb_utils.Tensor(
-                "SRC_SCRIPT",
-                np.array(src_scripts, dtype=self.src_script_dtype).reshape(1, -1),
-            )
-            probability_tt = pb_utils.Tensor("PROBABILITY", probs.reshape(1, -1))
-            response = pb_utils.InferenceResponse(
-                output_tensors=[src_lang_tt, src_script_tt, probability_tt],
-            )
-            responses[batch_id] = response
+            # Split the predictions back into their requests
+            start = 0
+            for batch_id, input_texts in group.items():
+                end = start + len(input_texts)
+                responses[batch_id] = self.make_response(
+                    output_labels[start:end], probs[start:end]
+                )
+                start = end
 
         return responses
+
+    def make_response(self, output_labels: list, probs: list):
+        """Make the Triton Inference Response for one request. Each row corresponds to
+        one of the texts in the request and is padded out to the same number of
+        predictions.
+
+        Parameters
+        ----------
+        output_labels : list[list[str]]
+            Predicted labels for each text, '__label__<lang_id>_<script>'
+        probs : list[np.ndarray]
+            Probabilities for each of the predicted labels
+
+        Returns
+        -------
+        pb_utils.InferenceResponse
+        """
+        n_texts = len(output_labels)
+        # At least one column, even if the threshold filtered out every prediction
+        k = max([len(labels) for labels in output_labels] + [1])
+        src_langs = np.full((n_texts, k), "", dtype=self.src_lang_dtype)
+        src_scripts = np.full((n_texts, k), "", dtype=self.src_script_dtype)
+        probabilities = np.zeros((n_texts, k), dtype=self.probability_dtype)
+        for i, (labels, prob) in enumerate(zip(output_labels, probs)):
+            for j, output_label in enumerate(labels):
+                # Returns '__label__<lang_id>_<script>', e.g., '__label__spa_Latn'
+                src_lang, src_script = output_label.replace("__label__", "").split("_")
+                src_langs[i, j] = src_lang
+                src_scripts[i, j] = src_script
+            probabilities[i, : len(prob)] = prob
+
+        src_lang_tt = pb_utils.Tensor("SRC_LANG", src_langs)
+        src_script_tt = pb_utils.Tensor("SRC_SCRIPT", src_scripts)
+        probability_tt = pb_utils.Tensor("PROBABILITY", probabilities)
+        return pb_utils.InferenceResponse(
+            output_tensors=[src_lang_tt, src_script_tt, probability_tt],
+        )
@@ -0,0 +1,99 @@
+import os
+from typing import List
+
+import torch
+
+# ctranslate2 compute_type for each precision. GPUs use "fp16"
+COMPUTE_TYPES = {
+    "fp16": "float16",
+    "fp32": "float32",
+    "bf16": "bfloat16",
+    "int8": "int8",
+}
+
+
+class CTranslate2Nllb:
+    """Run NLLB with CTranslate2's Translator instead of Hugging Face's generate().
+
+    Takes the same tokenized batch as NllbMulti, i.e., input_ids from
+    NllbTokenizerFastMulti whose first token is each row's src_lang, and forces each
+    row's tgt_lang as the first generated token, so a batch can mix src_langs and
+    tgt_langs. The generated token ids are returned in the same form as generate(),
+    [decoder_start_token_id, tgt_lang_id, ...], so they are decoded the same way.
+
+    Parameters
+    ----------
+    model_dir : str
+        Directory of the model converted with convert_ctranslate2.py
+    tokenizer : NllbTokenizerFastMulti
+        Used to map between token ids and the token strings CTranslate2 expects
+    device : torch.device
+    precision : str
+        One of "fp16", "fp32", "bf16", or "int8". Weights are converted at load time.
+    """
+
+    def __init__(self, model_dir: str, tokenizer, device, precision: str):
+        # Optional dependency. Only needed when the ctranslate2 engine is selected
+        import ctranslate2
+
+        if not os.path.isdir(model_dir):
+            raise FileNotFoundError(
+                f"No CTranslate2 model at {model_dir}. Create it with "
+                + "convert_ctranslate2.py"
+            )
+        if precision not in COMPUTE_TYPES:
+            raise ValueError(
+                f"precision {precision} is not supported by the ctranslate2 engine. "
+                + f"Needs to be one of {list(COMPUTE_TYPES)}"
+            )
+        self.tokenizer = tokenizer
+        self.decoder_start_token_id = tokenizer.eos_token_id
+        self.translator = ctranslate2.Translator(
+            model_dir,
+            device=device.type,
+            compute_type=COMPUTE_TYPES[precision],
+        )
+
+    def generate(
+        self,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        tgt_lang: List[str],
+        num_beams: int,
+        max_new_tokens: int,
+        no_repeat_ngram_size: int,
+    ) -> List[List[int]]:
+        """Translate the rows of a tokenized batch
+
+        Parameters
+        ----------
+        input_ids : torch.Tensor
+            Padded token ids, shape [batch_size, seq_len]
+        attention_mask : torch.Tensor
+            Shape [batch_size, seq_len]. Padding is dropped before translating
+        tgt_lang : List[str]
+            Target language of each row, e.g., "fra_Latn"
+
+        Returns
+        -------
+        List[List[int]]
+            Generated token ids of each row
+        """
+        source = [
+            self.tokenizer.convert_ids_to_tokens(ids[mask.bool()].tolist())
+            for ids, mask in zip(input_ids.cpu(), attention_mask.cpu())
+        ]
+        results = self.translator.translate_batch(
+            source,
+            target_prefix=[[tgt] for tgt in tgt_lang],
+            beam_size=num_beams,
+            num_hypotheses=1,
+            max_decoding_length=max_new_tokens,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+        )
+        # Hypotheses start with the target prefix, i.e., the tgt_lang token
+        return [
+            [self.decoder_start_token_id]
+            + self.tokenizer.convert_tokens_to_ids(result.hypotheses[0])
+            for result in results
+        ]
@@ -0,0 +1,90 @@
+import itertools
+import os
+
+import torch
+from transformers import GenerationConfig
+
+WEIGHTS_FILE = "weights.pt"
+
+
+def export_mmap_weights(model, output_dir: str) -> str:
+    """Save the model's config, generation config, and tensors so that
+    `load_mmap_weights` can memory-map them. Non-persistent buffers, e.g., the
+    sinusoidal positional embeddings, are saved as well since the model is built
+    without initializing any tensors when it is loaded.
+
+    Returns
+    -------
+    str
+        Path of the saved tensors
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model.config.save_pretrained(output_dir)
+    model.generation_config.save_pretrained(output_dir)
+    tensors = model.state_dict()
+    for name, buffer in model.named_buffers():
+        tensors.setdefault(name, buffer)
+    weights_path = os.path.join(output_dir, WEIGHTS_FILE)
+    torch.save(tensors, weights_path)
+    return weights_path
+
+
+def load_mmap_weights(model_class, weights_dir: str, torch_dtype: torch.dtype):
+    """Build the model around tensors memory-mapped from the file written by
+    `export_mmap_weights`, without copying them.
+
+    The file is mapped copy-on-write and the weights are only read, so every process
+    that loads the same file shares the same physical pages through the page cache.
+    Pages are read from disk on first use, so loading takes about as long as building
+    the modules.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no exported weights file in `weights_dir`
+    ValueError
+        If the weights were exported with a different dtype or don't match the model
+    """
+    weights_path = os.path.join(weights_dir, WEIGHTS_FILE)
+    if not os.path.isfile(weights_path):
+        raise FileNotFoundError(
+            f"No memory-mapped weights at {weights_path}. Create them with "
+            + "export_mmap_weights.py"
+        )
+    config = model_class.config_class.from_pretrained(weights_dir)
+    # Build the modules without allocating or initializing their tensors
+    with torch.device("meta"):
+        model = model_class(config)
+    tensors = torch.load(weights_path, mmap=True, weights_only=True)
+    dtypes = {
+        tensors[name].dtype for name, _ in model.named_parameters() if name in tensors
+    }
+    if dtypes != {torch_dtype}:
+        raise ValueError(
+            f"Weights at {weights_path} have dtype {dtypes}, but {torch_dtype} is "
+            + "needed. Export them again with the matching --precision"
+        )
+    result = model.load_state_dict(tensors, strict=False, assign=True)
+    if result.missing_keys:
+        raise ValueError(f"Weights at {weights_path} are missing {result.missing_keys}")
+    # The remaining tensors are non-persistent buffers
+    for name in result.unexpected_keys:
+        module_name, _, buffer_name = name.rpartition(".")
+        module = model.get_submodule(module_name)
+        if buffer_name not in module._buffers:
+            raise ValueError(f"Weights at {weights_path} have unknown tensor {name}")
+        module.register_buffer(buffer_name, tensors[name], persistent=False)
+    # Assigning replaced the shared embedding's parameter in each module separately
+    model.tie_weights()
+    meta = [
+        name
+        for name, tensor in itertools.chain(
+            model.named_parameters(), model.named_buffers()
+        )
+        if tensor.is_meta
+    ]
+    if meta:
+        raise ValueError(f"Weights at {weights_path} didn't provide {meta}")
+    model.generation_config = GenerationConfig.from_pretrained(weights_dir)
+    model.eval()
+    return model
@@ -1,198 +1,113 @@
-import itertools
-import json
-import numpy as np
+import os
 import torch
 from typing import List
 
+from ctranslate2_engine import CTranslate2Nllb
+from mmap_weights import load_mmap_weights
 from nllb_fix import NllbTokenizerFastMulti, NllbMulti
+from translation_common.precision import apply_cpu_precision
+from translation_common.translation_model import TranslationModel
 import triton_python_backend_utils as pb_utils
 
 
-class TritonPythonModel:
-    """Perform translation using SeamlessM4T-large-v2's Text2Text"""
+class TritonPythonModel(TranslationModel):
+    """Perform translation using NLLB-200 (distilled 600M)"""
 
-    def initialize(self, args):
-        self.model_config = model_config = json.loads(args["model_config"])
-        # Get TRANSLATED_TEXT configuration
-        translated_text_config = pb_utils.get_output_config_by_name(
-            model_config, "TRANSLATED_TEXT"
-        )
-        # Convert Triton types to numpy types
-        self.translated_text_dtype = pb_utils.triton_string_to_numpy(
-            translated_text_config["data_type"]
-        )
+    name = "nllb_200_distilled_600M"
+    display_name = "NLLB"
+    # Language tokens are of the form "eng_Latn"
+    lang_token_format = "{}"
+    warmup_src_lang = "eng_Latn"
+    warmup_tgt_lang = "fra_Latn"
 
-        # Use the GPU if available, otherwise use the CPU
-        if args["model_instance_kind"] == "GPU" and torch.cuda.is_available():
-            self.device = torch.device("cuda")
-            torch_dtype = torch.float16
-            # attn_implementation = "flash_attention_2"
-        else:
-            self.device = torch.device("cpu")
-            torch_dtype = torch.float32  # CPUs can't handle float16
-            # attn_implementation = None
-        self.model = NllbMulti.from_pretrained(
-            "facebook/nllb-200-distilled-600M",
-            device_map="auto",
-            torch_dtype=torch_dtype,
-            local_files_only=True,
-            # attn_implementation=attn_implementation,
-        )
+    def load_model(self, args, model_config, torch_dtype, precision) -> None:
         self.tokenizer = NllbTokenizerFastMulti.from_pretrained(
             "facebook/nllb-200-distilled-600M",
             local_files_only=True,
         )
-        # Get list of supported language tokens. Of the form "eng_Latn"
-        self.supported_languages = set(self.tokenizer.additional_special_tokens)
-
-    def execute(self, requests: List) -> List:
-        """
-        Each request is sent by a client and represents appropriately chunked text
-        for translation. The INPUT_TEXT is a 1-d array of with one element of bytes.
-        The SRC_LANG and TGT_LANG inputs are 1-d array of bytes but have just one
-        element in them.
-
-        Parameters
-        ----------
-        requests : List[pb_utils.InferenceRequest]
-
-        Returns
-        -------
-        responses: List[pb_utils.InferenceResponse]
-        """
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        logger = pb_utils.Logger
-        batch_size = len(requests)
-        logger.log_info(
-            f"nllb_200_distilled_600M.execute received {batch_size} requests"
+        # Either Hugging Face's generate() ("transformers") or a model converted with
+        # convert_ctranslate2.py ("ctranslate2")
+        self.engine = model_config["parameters"]["engine"]["string_value"]
+        # Optionally map the weights exported by export_mmap_weights.py instead of
+        # loading a private copy, so that every CPU instance shares the same pages
+        mmap_weights = (
+            model_config["parameters"]["mmap_weights"]["string_value"].lower() == "true"
         )
-        responses = [None] * batch_size
-        valid_requests = []
-        batch_input_text = []
-        batch_src_lang = []
-        batch_tgt_lang = []
-        for batch_id, request in enumerate(requests):
-            try:
-                # Get the input data as Triton Tensors
-                input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
-                src_lang_tt = pb_utils.get_input_tensor_by_name(request, "SRC_LANG")
-                tgt_lang_tt = pb_utils.get_input_tensor_by_name(request, "TGT_LANG")
-
-                # Convert TritonTensor -> numpy -> python str
-                # NOTE: Triton converts your input string to bytes so you need to decode
-                input_text = [
-                    b.decode("utf-8") for b in input_text_tt.as_numpy().reshape(-1)
-                ]
-                src_lang = [
-                    b.decode("utf-8") for b in src_lang_tt.as_numpy().reshape(-1)
-                ]
-                tgt_lang = [
-                    b.decode("utf-8") for b in tgt_lang_tt.as_numpy().reshape(-1)
-                ]
-
-                if self.unsupported_lang(src_lang[0]):
-                    raise ValueError(
-                        f"src_lang {src_lang[0]} is not supported by NLLB. Needs to "
-                        + f"be one of {self.supported_languages}"
-                    )
-                if self.unsupported_lang(tgt_lang[0]):
-                    raise ValueError(
-                        f"tgt_lang {tgt_lang[0]} is not supported by NLLB. Needs to "
-                        + f"be one of {self.supported_languages}"
-                    )
-
-                batch_input_text.append(input_text)
-                batch_src_lang.append(src_lang)
-                batch_tgt_lang.append(tgt_lang)
-            except Exception as exc:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(
-                        f"{exc}", pb_utils.TritonError.INVALID_ARG
-                    )
-                )
-                responses[batch_id] = response
-                continue
-            else:
-                valid_requests.append(batch_id)
-
-        input_texts = list(itertools.chain.from_iterable(batch_input_text))
-        src_langs = list(itertools.chain.from_iterable(batch_src_lang))
-        tgt_langs = list(itertools.chain.from_iterable(batch_tgt_lang))
-        # Run through the model for translation
-        ## Tokenize
-        try:
-            input_ids = self.tokenizer(
-                text=input_texts,
-                src_lang=src_langs,
-                return_tensors="pt",
-                padding=True,
-            ).to(self.device)
-        except Exception as exc:
-            # Error with the batch. Be careful error msg doesn't cross
-            # contaminate user data
-            for batch_id in valid_requests:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(
-                        f"nllb_200_distilled_600M.processor threw error tokenizing the batch: {exc}"
-                    )
-                )
-                responses[batch_id] = response
-            return responses
-
-        ## Generate output tokens
-        try:
-            with torch.no_grad():
-                output_tokens = self.model.generate(
-                    **input_ids,
-                    tgt_lang=tgt_langs,
-                    num_beams=1,  # Massive throughput hit if > 1
-                    num_return_sequences=1,
-                    max_new_tokens=512,
-                    no_repeat_ngram_size=3,
-                )
-        except Exception as exc:
-            for batch_id in valid_requests:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(
-                        f"nllb_200_distilled_600M.model.generate threw error on batch: {exc}"
-                    )
-                )
-                responses[batch_id] = response
-            return responses
-
-        ## Decode tokens to text
-        try:
-            translated_texts = self.tokenizer.batch_decode(
-                output_tokens, skip_special_tokens=True
+        on_cpu = self.device.type == "cpu"
+        if mmap_weights and (self.engine != "transformers" or not on_cpu):
+            pb_utils.Logger.log_warn(
+                "nllb_200_distilled_600M mmap_weights is only used by the transformers "
+                + f"engine on the CPU. Ignoring it on {self.device}"
             )
-        except Exception as exc:
-            for batch_id in valid_requests:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(
-                        "nllb_200_distilled_600M.processor.batch_decode threw on batch: {exc}"
-                    )
-                )
-                responses[batch_id] = response
-            return responses
-
-        for batch_id, translated_text in zip(valid_requests, translated_texts):
-            # Convert to TritonTensor & make the TritonInferenceResponse
-            translated_text_tt = pb_utils.Tensor(
-                "TRANSLATED_TEXT",
-                np.array(translated_text, dtype=self.translated_text_dtype).reshape(
-                    -1, 1
+            mmap_weights = False
+        if mmap_weights and precision == "int8":
+            raise ValueError(
+                "mmap_weights needs cpu_precision fp32 or bf16. int8 quantizes the "
+                + "weights into a private copy in each instance"
+            )
+        if self.engine == "transformers" and mmap_weights:
+            self.model = load_mmap_weights(
+                NllbMulti,
+                os.path.join(
+                    args["model_repository"],
+                    model_config["parameters"]["mmap_weights_dir"]["string_value"],
                 ),
+                torch_dtype,
+            )
+        elif self.engine == "transformers":
+            self.model = NllbMulti.from_pretrained(
+                "facebook/nllb-200-distilled-600M",
+                device_map="auto",
+                torch_dtype=torch_dtype,
+                local_files_only=True,
+                # attn_implementation="flash_attention_2",
+            )
+            self.model = apply_cpu_precision(self.model, precision)
+        elif self.engine == "ctranslate2":
+            ctranslate2_model_dir = os.path.join(
+                args["model_repository"],
+                model_config["parameters"]["ctranslate2_model_dir"]["string_value"],
+            )
+            self.model = CTranslate2Nllb(
+                ctranslate2_model_dir, self.tokenizer, self.device, precision
             )
-            inference_response = pb_utils.InferenceResponse(
-                output_tensors=[translated_text_tt],
+        else:
+            raise ValueError(
+                f"engine {self.engine} is not supported. Needs to be one of "
+                + "['transformers', 'ctranslate2']"
             )
-            responses[batch_id] = inference_response
+        pb_utils.Logger.log_info(
+            f"nllb_200_distilled_600M running on {self.device} "
+            + f"with {precision} precision using the {self.engine} engine"
+        )
 
-        return responses
+    def generate(
+        self,
+        encoding: dict,
+        expand: torch.Tensor,
+        tgt_lang: List[str],
+        decoding_profile: dict,
+    ):
+        """Generate the translation tokens of a sub-batch with the selected engine.
 
-    def unsupported_lang(self, lang_id):
-        if lang_id in self.supported_languages:
-            return False
-        else:
-            return True
+        Returns
+        -------
+        torch.Tensor | List[List[int]]
+            Generated token ids of each output row
+        """
+        if self.engine != "ctranslate2":
+            return super().generate(encoding, expand, tgt_lang, decoding_profile)
+        # CTranslate2 doesn't take encoder outputs, so shared sources are encoded
+        # once per tgt_lang. It only takes a single length limit for the batch and
+        # can't end looping rows early.
+        max_new_tokens = self.row_max_new_tokens(
+            encoding["attention_mask"][expand], decoding_profile
+        )
+        return self.model.generate(
+            input_ids=encoding["input_ids"][expand],
+            attention_mask=encoding["attention_mask"][expand],
+            tgt_lang=tgt_lang,
+            num_beams=decoding_profile["num_beams"],
+            max_new_tokens=max(max_new_tokens),
+            no_repeat_ngram_size=3,
+        )
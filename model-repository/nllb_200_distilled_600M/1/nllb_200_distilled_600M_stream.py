@@ -0,0 +1,36 @@
+from nllb_fix import LANG_TOKEN_TO_ID, NllbMulti, NllbTokenizerFastMulti
+from translation_common.precision import apply_cpu_precision
+from translation_common.stream_model import StreamTranslationModel
+import triton_python_backend_utils as pb_utils
+
+
+class TritonPythonModel(StreamTranslationModel):
+    """Perform translation using NLLB-200 (distilled 600M) with continuous
+    (iteration-level) batching. Must be deployed in decoupled mode."""
+
+    name = "nllb_200_distilled_600M_stream"
+    display_name = "NLLB"
+    # Language tokens are of the form "eng_Latn"
+    lang_token_format = "{}"
+
+    def load_model(self, args, model_config, torch_dtype, precision) -> None:
+        self.model = NllbMulti.from_pretrained(
+            "facebook/nllb-200-distilled-600M",
+            device_map="auto",
+            torch_dtype=torch_dtype,
+            local_files_only=True,
+        )
+        self.model = apply_cpu_precision(self.model, precision)
+        pb_utils.Logger.log_info(
+            f"nllb_200_distilled_600M_stream running on {self.device} "
+            + f"with {precision} precision"
+        )
+        self.tokenizer = NllbTokenizerFastMulti.from_pretrained(
+            "facebook/nllb-200-distilled-600M",
+            local_files_only=True,
+        )
+
+    def tgt_lang_id(self, tgt_lang: str) -> int:
+        # Same as generate() with NllbMulti forcing the tgt_lang as the first
+        # generated token
+        return LANG_TOKEN_TO_ID[tgt_lang]
@@ -221,6 +221,13 @@ LANG_TOKEN_TO_ID = {
 
 
 class TgtLangIdsLogitsProcessor(LogitsProcessor):
+    """Force each row's tgt_lang token as the first generated token.
+
+    `bos_token_ids` has one id per row of the batch. With beam search `input_ids`
+    and `scores` have `num_beams` consecutive rows per row of the batch, i.e., row
+    `b * num_beams + j` is beam `j` of row `b`, so each id is repeated per beam.
+    """
+
     def __init__(self, bos_token_ids: list[int]):
         self.bos_token_ids = bos_token_ids
 
@@ -228,12 +235,16 @@ class TgtLangIdsLogitsProcessor(LogitsProcessor):
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor
     ) -> torch.FloatTensor:
         cur_len = input_ids.shape[-1]
-        batch_size = input_ids.shape[0]
         scores_processed = scores
         if cur_len == 1:
+            num_beams = input_ids.shape[0] // len(self.bos_token_ids)
+            bos_token_ids = torch.tensor(
+                self.bos_token_ids, dtype=torch.long, device=scores.device
+            ).repeat_interleave(num_beams)
             scores_processed = torch.full_like(scores, -math.inf)
-            for b, bos_token_id in enumerate(self.bos_token_ids):
-                scores_processed[b, bos_token_id] = 0
+            scores_processed[
+                torch.arange(len(bos_token_ids), device=scores.device), bos_token_ids
+            ] = 0
         return scores_processed
 
 
@@ -255,8 +266,16 @@ class NllbMulti(M2M100ForConditionalGeneration):
         negative_prompt_attention_mask: Optional[torch.Tensor] = None,
         **kwargs,
     ):
-        batch_size = input_ids.shape[0]
-        logits_processor = LogitsProcessorList()
+        if input_ids is not None:
+            batch_size = input_ids.shape[0]
+        else:
+            # Encoder was run separately, e.g., shared across several tgt_langs
+            batch_size = kwargs["encoder_outputs"][0].shape[0]
+        # Keep any logits processors passed in. tgt_lang's must come last so that it
+        # forces the first token
+        logits_processor = LogitsProcessorList(
+            logits_processor if logits_processor is not None else []
+        )
         if tgt_lang is not None:
             if isinstance(tgt_lang, str):
                 tgt_lang = [tgt_lang] * batch_size
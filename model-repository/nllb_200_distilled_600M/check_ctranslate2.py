@@ -0,0 +1,145 @@
+"""Check that the CTranslate2 model produces the same translations as the eager
+Hugging Face model.
+
+Translates FLORES devtest sentences with both engines, using the same tokenization,
+decoding settings, and mixed src_lang/tgt_lang batches that nllb_200_distilled_600M
+uses, and reports how many translations are identical along with the chrF2++ of the
+CTranslate2 translations using the eager ones as the reference. Exits with status 1
+if the fraction of identical translations is below --min-exact-match.
+
+Run from inside the nllb_200_distilled_600M conda environment, with datasets and
+sacrebleu installed, after convert_ctranslate2.py, e.g.,
+
+    HF_HUB_CACHE=./models python model-repository/nllb_200_distilled_600M/check_ctranslate2.py
+"""
+
+import argparse
+import os
+import sys
+
+from datasets import load_dataset
+from sacrebleu.metrics import CHRF
+import torch
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODEL_DIR, "1"))
+
+from ctranslate2_engine import CTranslate2Nllb  # noqa: E402
+from nllb_fix import NllbMulti, NllbTokenizerFastMulti  # noqa: E402
+from translation_common.precision import (  # noqa: E402
+    apply_cpu_precision,
+    get_cpu_torch_dtype,
+)
+
+# Same settings as nllb_200_distilled_600M.py
+NUM_BEAMS = 1
+MAX_NEW_TOKENS = 512
+NO_REPEAT_NGRAM_SIZE = 3
+
+# Each source language is translated into the next one in the list
+LANGUAGES = ["eng_Latn", "fra_Latn", "deu_Latn", "spa_Latn", "zho_Hans", "arb_Arab"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--ctranslate2-model-dir", default=os.path.join(MODEL_DIR, "ctranslate2")
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "bf16", "int8"],
+        help="Precision of both engines on the CPU. GPUs always use fp16",
+    )
+    parser.add_argument("--n-sentences", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-exact-match", type=float, default=0.95)
+    args = parser.parse_args()
+
+    if torch.cuda.is_available():
+        device = torch.device("cuda")
+        torch_dtype = torch.float16
+        precision = "fp16"
+    else:
+        device = torch.device("cpu")
+        torch_dtype = get_cpu_torch_dtype(args.precision)
+        precision = args.precision
+
+    tokenizer = NllbTokenizerFastMulti.from_pretrained(
+        "facebook/nllb-200-distilled-600M", local_files_only=True
+    )
+    model = NllbMulti.from_pretrained(
+        "facebook/nllb-200-distilled-600M",
+        torch_dtype=torch_dtype,
+        local_files_only=True,
+    ).to(device)
+    model = apply_cpu_precision(model, precision)
+    model.eval()
+    ct2_model = CTranslate2Nllb(args.ctranslate2_model_dir, tokenizer, device, precision)
+
+    flores = load_dataset("facebook/flores", "all", split="devtest")
+    sentences = {
+        src: flores[f"sentence_{src}"][: args.n_sentences] for src in LANGUAGES
+    }
+    # Interleave the languages so that every batch mixes them
+    texts = []
+    src_langs = []
+    tgt_langs = []
+    for j in range(min(args.n_sentences, len(flores))):
+        for i, src in enumerate(LANGUAGES):
+            texts.append(sentences[src][j])
+            src_langs.append(src)
+            tgt_langs.append(LANGUAGES[(i + 1) % len(LANGUAGES)])
+
+    eager_translations = []
+    ct2_translations = []
+    for start in range(0, len(texts), args.batch_size):
+        rows = range(start, min(start + args.batch_size, len(texts)))
+        encoding = tokenizer(
+            text=[texts[i] for i in rows],
+            src_lang=[src_langs[i] for i in rows],
+            return_tensors="pt",
+            padding=True,
+        ).to(device)
+        batch_tgt_langs = [tgt_langs[i] for i in rows]
+        with torch.no_grad():
+            eager_tokens = model.generate(
+                **encoding,
+                tgt_lang=batch_tgt_langs,
+                num_beams=NUM_BEAMS,
+                num_return_sequences=1,
+                max_new_tokens=MAX_NEW_TOKENS,
+                no_repeat_ngram_size=NO_REPEAT_NGRAM_SIZE,
+            )
+        ct2_tokens = ct2_model.generate(
+            input_ids=encoding["input_ids"],
+            attention_mask=encoding["attention_mask"],
+            tgt_lang=batch_tgt_langs,
+            num_beams=NUM_BEAMS,
+            max_new_tokens=MAX_NEW_TOKENS,
+            no_repeat_ngram_size=NO_REPEAT_NGRAM_SIZE,
+        )
+        eager_translations += tokenizer.batch_decode(
+            eager_tokens, skip_special_tokens=True
+        )
+        ct2_translations += tokenizer.batch_decode(ct2_tokens, skip_special_tokens=True)
+
+    n_exact = sum(e == c for e, c in zip(eager_translations, ct2_translations))
+    exact_match = n_exact / len(eager_translations)
+    chrf = CHRF(word_order=2, eps_smoothing=True)
+    score = chrf.corpus_score(ct2_translations, [eager_translations]).score
+    print(f"Compared {len(eager_translations)} translations at {precision} precision")
+    print(f"Identical translations: {n_exact} ({exact_match:.1%})")
+    print(f"chrF2++ of ctranslate2 against eager: {score:.1f}")
+    for e, c in zip(eager_translations, ct2_translations):
+        if e != c:
+            print(f"\neager:       {e}\nctranslate2: {c}")
+            break
+
+    if exact_match < args.min_exact_match:
+        print(f"\nFAILED: below --min-exact-match of {args.min_exact_match:.1%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""Convert facebook/nllb-200-distilled-600M to a CTranslate2 model for the
+nllb_200_distilled_600M "ctranslate2" engine.
+
+Run from inside the nllb_200_distilled_600M conda environment with HF_HUB_CACHE
+pointing at the downloaded models, e.g.,
+
+    HF_HUB_CACHE=./models python model-repository/nllb_200_distilled_600M/convert_ctranslate2.py
+
+The converted model is written to model-repository/nllb_200_distilled_600M/ctranslate2
+which is where the config.pbtxt's ctranslate2_model_dir looks for it by default.
+"""
+
+import argparse
+import os
+
+from ctranslate2.converters import TransformersConverter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "ctranslate2"),
+        help="Where to write the converted model",
+    )
+    parser.add_argument(
+        "--quantization",
+        default=None,
+        choices=["float32", "float16", "bfloat16", "int8"],
+        help="Weight type stored on disk. Defaults to the checkpoint's float32. The "
+        + "model is converted to the config's precision when loaded regardless.",
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Overwrite an existing output directory"
+    )
+    args = parser.parse_args()
+
+    converter = TransformersConverter("facebook/nllb-200-distilled-600M")
+    output_dir = converter.convert(
+        args.output_dir, quantization=args.quantization, force=args.force
+    )
+    print(f"Wrote CTranslate2 model to {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Export facebook/nllb-200-distilled-600M's weights for the nllb_200_distilled_600M
+mmap_weights option.
+
+Run from inside the nllb_200_distilled_600M conda environment with HF_HUB_CACHE
+pointing at the downloaded models, e.g.,
+
+    HF_HUB_CACHE=./models python model-repository/nllb_200_distilled_600M/export_mmap_weights.py
+
+The weights are written to model-repository/nllb_200_distilled_600M/mmap_weights which
+is where the config.pbtxt's mmap_weights_dir looks for them by default. Export with the
+same --precision as the config's cpu_precision.
+"""
+
+import argparse
+import os
+import sys
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODEL_DIR, "1"))
+
+from mmap_weights import export_mmap_weights  # noqa: E402
+from nllb_fix import NllbMulti  # noqa: E402
+from translation_common.precision import get_cpu_torch_dtype  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join(MODEL_DIR, "mmap_weights"),
+        help="Where to write the weights",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="Must match the config's cpu_precision",
+    )
+    args = parser.parse_args()
+
+    model = NllbMulti.from_pretrained(
+        "facebook/nllb-200-distilled-600M",
+        torch_dtype=get_cpu_torch_dtype(args.precision),
+        local_files_only=True,
+    )
+    weights_path = export_mmap_weights(model, args.output_dir)
+    print(f"Wrote {args.precision} weights to {weights_path}")
+
+
+if __name__ == "__main__":
+    main()
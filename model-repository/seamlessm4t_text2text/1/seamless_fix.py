@@ -1,5 +1,11 @@
+from functools import partial
+
 import torch
-from transformers import SeamlessM4Tv2ForTextToText, SeamlessM4TProcessor
+from transformers import (
+    AutoTokenizer,
+    SeamlessM4Tv2ForTextToText,
+    SeamlessM4TProcessor,
+)
 
 
 class SeamlessM4Tv2ForTextToTextMulti(SeamlessM4Tv2ForTextToText):
@@ -81,11 +87,13 @@ class SeamlessM4Tv2ForTextToTextMulti(SeamlessM4Tv2ForTextToText):
         text_decoder_input_ids = kwargs.pop("decoder_input_ids", None)
         # overwrite text_decoder_input_ids if tgt_lang is passed. The latter gets priority over decoder_input_ids.
         if tgt_lang is not None:
-            batch_size = (
-                len(input_ids)
-                if input_ids is not None
-                else len(kwargs.get("inputs_embeds"))
-            )
+            if input_ids is not None:
+                batch_size = len(input_ids)
+            elif kwargs.get("encoder_outputs", None) is not None:
+                # Encoder was run separately, e.g., shared across several tgt_langs
+                batch_size = len(kwargs["encoder_outputs"][0])
+            else:
+                batch_size = len(kwargs.get("inputs_embeds"))
 
             if hasattr(self.generation_config, "text_decoder_lang_to_code_id"):
                 if isinstance(tgt_lang, str):
@@ -137,6 +145,23 @@ class SeamlessM4Tv2ForTextToTextMulti(SeamlessM4Tv2ForTextToText):
         )
 
 
+def encode_src_langs(tokenizer, encode, text, src_lang: list):
+    """Tokenize a batch of `text` where each row has its own `src_lang`.
+
+    `encode(src_lang=...)` tokenizes the whole batch with a single src_lang. The batch
+    is tokenized once with the first src_lang and the first token of each row is then
+    replaced by its own src_lang token.
+    """
+    if isinstance(text, str):
+        raise ValueError("Processor: `text` is str, but `src_lang` is list")
+    if len(text) != len(src_lang):
+        raise ValueError(f"Processor: `text` batch size != `src_lang` batch_size")
+    encoding = encode(src_lang=src_lang[0])
+    src_lang_ids = tokenizer.convert_tokens_to_ids([f"__{src}__" for src in src_lang])
+    encoding["input_ids"][:, 0] = torch.LongTensor(src_lang_ids)
+    return encoding
+
+
 class SeamlessM4TProcessorMulti(SeamlessM4TProcessor):
     def __call__(self, text=None, audios=None, src_lang=None, tgt_lang=None, **kwargs):
         """
@@ -183,23 +208,18 @@ class SeamlessM4TProcessorMulti(SeamlessM4TProcessor):
                     **kwargs,
                 )
             elif isinstance(src_lang, list):
-                if isinstance(text, str):
-                    raise ValueError("Processor: `text` is str, but `src_lang` is list")
-                if len(text) != len(src_lang):
-                    raise ValueError(
-                        f"Processor: `text` batch size != `src_lang` batch_size"
-                    )
-                encoding = super().__call__(
-                    text=text,
-                    audios=audios,
-                    src_lang=src_lang[0],  # Just need the first one for now
-                    tgt_lang=tgt_lang,
-                    **kwargs,
-                )
-                src_lang_ids = self.tokenizer.convert_tokens_to_ids(
-                    [f"__{src}__" for src in src_lang]
+                encoding = encode_src_langs(
+                    self.tokenizer,
+                    partial(
+                        super().__call__,
+                        text=text,
+                        audios=audios,
+                        tgt_lang=tgt_lang,
+                        **kwargs,
+                    ),
+                    text,
+                    src_lang,
                 )
-                encoding["input_ids"][:, 0] = torch.LongTensor(src_lang_ids)
         # Audios functions as before
         else:
             encoding = super().__call__(
@@ -207,3 +227,31 @@ class SeamlessM4TProcessorMulti(SeamlessM4TProcessor):
             )
 
         return encoding
+
+
+class SeamlessM4TTextProcessorMulti:
+    """Text only stand-in for SeamlessM4TProcessorMulti. Holds just the tokenizer, so
+    the audio feature extractor is never loaded, and tokenizes a batch with a list of
+    `src_lang`s the same way."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, **kwargs):
+        tokenizer = AutoTokenizer.from_pretrained(
+            pretrained_model_name_or_path, **kwargs
+        )
+        return cls(tokenizer)
+
+    def __call__(self, text, src_lang, **kwargs):
+        def encode(src_lang):
+            self.tokenizer.src_lang = src_lang
+            return self.tokenizer(text, **kwargs)
+
+        if isinstance(src_lang, str):
+            return encode(src_lang)
+        return encode_src_langs(self.tokenizer, encode, text, src_lang)
+
+    def batch_decode(self, *args, **kwargs):
+        return self.tokenizer.batch_decode(*args, **kwargs)
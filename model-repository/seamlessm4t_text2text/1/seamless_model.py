@@ -0,0 +1,66 @@
+import os
+import time
+from typing import List
+
+from seamless_fix import (
+    SeamlessM4TProcessorMulti,
+    SeamlessM4TTextProcessorMulti,
+    SeamlessM4Tv2ForTextToTextMulti,
+)
+from translation_common.precision import apply_cpu_precision
+import triton_python_backend_utils as pb_utils
+
+
+class SeamlessM4TMixin:
+    """Loading and tokenization shared by seamlessm4t_text2text and
+    seamlessm4t_text2text_stream. Comes before the TranslationModelBase subclass in
+    the bases."""
+
+    display_name = "SeamlessM4Tv2"
+    # Language tokens are of the form "__eng__"
+    lang_token_format = "__{}__"
+    language_hint = "(you can leave off the '__' before and after) "
+
+    def load_model(self, args, model_config, torch_dtype, precision) -> None:
+        # Prefer the text only checkpoint and tokenizer written by
+        # export_text_only.py, which skip reading the speech weights and loading the
+        # audio feature extractor. Otherwise use the full checkpoint in HF_HUB_CACHE
+        text_only_dir = os.path.join(
+            args["model_repository"],
+            model_config["parameters"]["text_only_model_dir"]["string_value"],
+        )
+        text_only = os.path.isfile(os.path.join(text_only_dir, "config.json"))
+        start = time.perf_counter()
+        self.model = SeamlessM4Tv2ForTextToTextMulti.from_pretrained(
+            text_only_dir if text_only else "facebook/seamless-m4t-v2-large",
+            device_map="auto",
+            torch_dtype=torch_dtype,
+            local_files_only=True,
+            use_safetensors=True,
+        )
+        self.model = apply_cpu_precision(self.model, precision)
+        if text_only:
+            self.processor = SeamlessM4TTextProcessorMulti.from_pretrained(
+                text_only_dir,
+                local_files_only=True,
+            )
+        else:
+            self.processor = SeamlessM4TProcessorMulti.from_pretrained(
+                "facebook/seamless-m4t-v2-large",
+                local_files_only=True,
+            )
+        self.tokenizer = self.processor.tokenizer
+        pb_utils.Logger.log_info(
+            f"{self.name} running on {self.device} "
+            + f"with {precision} precision. Loaded the "
+            + f"{text_only_dir if text_only else 'full'} checkpoint in "
+            + f"{time.perf_counter() - start:.1f}s"
+        )
+
+    def encode(self, texts: List[str], src_langs: List[str]):
+        # The processor adds the "__" around each src_lang itself
+        return self.processor(
+            text=texts,
+            src_lang=[src.strip("_") for src in src_langs],
+            return_tensors="pt",
+        )
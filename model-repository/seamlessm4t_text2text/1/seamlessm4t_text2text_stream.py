@@ -0,0 +1,18 @@
+from seamless_model import SeamlessM4TMixin
+from translation_common.stream_model import StreamTranslationModel
+
+
+class TritonPythonModel(SeamlessM4TMixin, StreamTranslationModel):
+    """Perform translation using SeamlessM4T-large-v2's Text2Text with continuous
+    (iteration-level) batching. Must be deployed in decoupled mode."""
+
+    name = "seamlessm4t_text2text_stream"
+
+    def load_model(self, args, model_config, torch_dtype, precision) -> None:
+        super().load_model(args, model_config, torch_dtype, precision)
+        self.text_decoder_lang_to_code_id = (
+            self.model.generation_config.text_decoder_lang_to_code_id
+        )
+
+    def tgt_lang_id(self, tgt_lang: str) -> int:
+        return self.text_decoder_lang_to_code_id[tgt_lang.strip("_")]
@@ -0,0 +1,61 @@
+"""Export the text to text weights and the tokenizer of facebook/seamless-m4t-v2-large
+for seamlessm4t_text2text.
+
+The full checkpoint also has the speech encoder, text to unit model, and vocoder,
+which seamlessm4t_text2text reads from disk and then discards every time it starts.
+The processor also loads an audio feature extractor that text translation never uses.
+This writes just the text encoder and decoder weights as safetensors along with the
+tokenizer.
+
+Run from inside the seamlessm4t_text2text conda environment with HF_HUB_CACHE pointing
+at the downloaded models, e.g.,
+
+    HF_HUB_CACHE=./models python model-repository/seamlessm4t_text2text/export_text_only.py
+
+The files are written to model-repository/seamlessm4t_text2text/text_only which is
+where the config.pbtxt's text_only_model_dir looks for them by default. Delete the
+directory to go back to loading the full checkpoint.
+"""
+
+import argparse
+import os
+import sys
+
+from transformers import AutoTokenizer
+
+MODEL_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(MODEL_DIR, "1"))
+
+from seamless_fix import SeamlessM4Tv2ForTextToTextMulti  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--output-dir",
+        default=os.path.join(MODEL_DIR, "text_only"),
+        help="Where to write the checkpoint and tokenizer",
+    )
+    args = parser.parse_args()
+
+    # Weights are kept in the checkpoint's float32 so every cpu_precision, and fp16 on
+    # the GPU, can be loaded from them
+    model = SeamlessM4Tv2ForTextToTextMulti.from_pretrained(
+        "facebook/seamless-m4t-v2-large",
+        local_files_only=True,
+        use_safetensors=True,
+    )
+    model.save_pretrained(args.output_dir, safe_serialization=True)
+    tokenizer = AutoTokenizer.from_pretrained(
+        "facebook/seamless-m4t-v2-large", local_files_only=True
+    )
+    tokenizer.save_pretrained(args.output_dir)
+    n_bytes = sum(
+        os.path.getsize(os.path.join(args.output_dir, name))
+        for name in os.listdir(args.output_dir)
+    )
+    print(f"Wrote {n_bytes / 2**30:.2f}GiB to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,7 @@ from datasets import load_dataset
 import json
 import requests
 from sacrebleu.metrics import CHRF
+import time
 
 
 def get_translations(
@@ -58,8 +59,9 @@ def get_translations(
     return results
 
 
-def test_pair(src, tgt):
-    flores = load_dataset("facebook/flores", "all", split="devtest")
+def test_pair(flores, src, tgt):
+    """chrF2++ of translating flores from src to tgt, the number of sentences
+    translated, and the seconds spent waiting on the translations"""
     chrf = CHRF(word_order=2, eps_smoothing=True)
     if src == "cmn_Hant":
         flores_src = "zho_Hant"
@@ -91,16 +93,20 @@ def test_pair(src, tgt):
 
     tgt_texts = []
     translations = []
+    seconds = 0.0
     for batch in flores.iter(batch_size=60):
         n_batch = len(batch["id"])
         src_langs = [src] * n_batch
         tgt_langs = [tgt] * n_batch
         texts = batch[src_sentence]
         tgt_texts += batch[tgt_sentence]
-        for t in get_translations(texts, src_langs, tgt_langs):
-            translations.append(t)
+        start = time.perf_counter()
+        batch_translations = get_translations(texts, src_langs, tgt_langs)
+        seconds += time.perf_counter() - start
+        translations += batch_translations
 
-    return chrf.corpus_score(translations, [tgt_texts]).score
+    score = chrf.corpus_score(translations, [tgt_texts]).score
+    return score, len(translations), seconds
 
 
 def main():
@@ -207,22 +213,29 @@ def main():
         "zul",
     ]
 
+    flores = load_dataset("facebook/flores", "all", split="devtest")
     errors = []
     chrf2 = []
-    print(f"| Language | chrF2++ |")
-    print(f"| :------: | :-----: |")
+    n_sentences = 0
+    total_seconds = 0.0
+    print(f"| Language | chrF2++ | Sentences/sec |")
+    print(f"| :------: | :-----: | :-----------: |")
     for src in language_codes:
         try:
-            triton_score = test_pair(src, "eng")
+            triton_score, n_translated, seconds = test_pair(flores, src, "eng")
             chrf2.append(triton_score)
         except Exception as exc:
             errors.append((src, exc))
             continue
-        print(f"| {src} | {triton_score:.1f} |")
+        n_sentences += n_translated
+        total_seconds += seconds
+        print(f"| {src} | {triton_score:.1f} | {n_translated / seconds:.2f} |")
 
     mean_score = sum(chrf2) / len(chrf2)
-    print(f"| **Mean** | **{mean_score:.2f}**")
+    throughput = n_sentences / total_seconds
+    print(f"| **Mean** | **{mean_score:.2f}** | **{throughput:.2f}** |")
     print(f"\n\nMean = {mean_score:.2f}")
+    print(f"Translated {n_sentences} sentences in {total_seconds:.1f} seconds")
 
     for src, exc in errors:
         print(f"{src} threw {exc}")
@@ -0,0 +1,78 @@
+from typing import List
+
+import numpy as np
+
+# Hugging Face model of each translation model that accepts INPUT_IDS
+HF_MODEL_IDS = {
+    "seamlessm4t_text2text": "facebook/seamless-m4t-v2-large",
+    "nllb_200_distilled_600M": "facebook/nllb-200-distilled-600M",
+}
+
+
+class TranslationTokenizer:
+    """Tokenize sentences and decode translations for a translation model the same
+    way the translation model does itself, so that translate can send it INPUT_IDS
+    and decode its OUTPUT_IDS.
+
+    A batch may mix src_langs. Like SeamlessM4TProcessorMulti and
+    NllbTokenizerFastMulti, the batch is tokenized once and the first token of each
+    row is replaced by its own src_lang token. Only needs transformers' tokenizers, not
+    torch.
+
+    Parameters
+    ----------
+    translation_model : str
+        One of the keys of HF_MODEL_IDS
+    """
+
+    def __init__(self, translation_model: str):
+        # Optional dependency. Only needed when tokenize_in_translate is enabled
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            HF_MODEL_IDS[translation_model], local_files_only=True
+        )
+        # SeamlessM4T's language tokens are of the form "__eng__"
+        self.lang_token_format = (
+            "__{}__" if translation_model == "seamlessm4t_text2text" else "{}"
+        )
+
+    def encode(self, texts: List[str], src_langs: List[str]) -> List[List[int]]:
+        """Token ids of each text, starting with its src_lang's token
+
+        Raises
+        ------
+        ValueError
+            If a src_lang isn't one of the tokenizer's language tokens. The tokenizer
+            would give it the unknown token id, which the translation model can't
+            tell apart from a real language.
+        """
+        src_lang_ids = self.tokenizer.convert_tokens_to_ids(
+            [self.lang_token_format.format(src.strip("_")) for src in src_langs]
+        )
+        for src, src_lang_id in zip(src_langs, src_lang_ids):
+            if src_lang_id == self.tokenizer.unk_token_id:
+                raise ValueError(
+                    f"src_lang {src} is not supported by the translation model's "
+                    + "tokenizer"
+                )
+        input_ids = self.tokenizer(texts, padding=False)["input_ids"]
+        for ids, src_lang_id in zip(input_ids, src_lang_ids):
+            ids[0] = src_lang_id
+        return input_ids
+
+    def decode(self, output_ids: np.ndarray) -> List[str]:
+        """Translations of the rows of generated token ids, padding included"""
+        return self.tokenizer.batch_decode(
+            output_ids.tolist(), skip_special_tokens=True
+        )
+
+    @staticmethod
+    def pad(input_ids: List[List[int]]) -> tuple:
+        """Stack the rows into an INPUT_IDS [n, max_length] array padded with 0s and
+        their INPUT_LENGTHS [n, 1]"""
+        lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+        padded = np.zeros((len(input_ids), lengths.max()), dtype=np.int64)
+        for k, ids in enumerate(input_ids):
+            padded[k, : len(ids)] = ids
+        return padded, lengths.reshape(-1, 1)
@@ -1,9 +1,11 @@
 import asyncio
-from collections import defaultdict
+import itertools
 import json
 import numpy as np
 from typing import List
 
+from tokenization import HF_MODEL_IDS
+from translation_cache import TranslationCache
 import triton_python_backend_utils as pb_utils
 
 
@@ -35,6 +37,23 @@ class TritonPythonModel:
             translated_text_config["data_type"]
         )
 
+        # Get ERROR configuration
+        error_config = pb_utils.get_output_config_by_name(model_config, "ERROR")
+        self.error_dtype = pb_utils.triton_string_to_numpy(error_config["data_type"])
+
+        # In decoupled mode (translate_stream), each translated chunk is sent back as
+        # soon as it is ready along with its DOCUMENT_ID and CHUNK_ID
+        self.decoupled = pb_utils.using_decoupled_model_transaction_policy(
+            model_config
+        )
+        if self.decoupled:
+            chunk_id_config = pb_utils.get_output_config_by_name(
+                model_config, "CHUNK_ID"
+            )
+            self.chunk_id_dtype = pb_utils.triton_string_to_numpy(
+                chunk_id_config["data_type"]
+            )
+
         # Get default values
         self.default_language_id_model = model_config["parameters"][
             "default_language_id_model"
@@ -48,129 +67,237 @@ class TritonPythonModel:
         self.default_language_id_threshold = float(
             model_config["parameters"]["default_language_id_threshold"]["string_value"]
         )
+        # Maximum number of sentences sent in a single request to the translation
+        # model. Each sentence has a row for each of the tgt_langs
+        self.max_sentences_per_request = int(
+            model_config["parameters"]["max_sentences_per_request"]["string_value"]
+        )
+        # Maximum number of (sentence, tgt_lang) rows sent in a single request to the
+        # translation model. Must not exceed the translation model's max_batch_size
+        self.max_rows_per_request = int(
+            model_config["parameters"]["max_rows_per_request"]["string_value"]
+        )
+        # Maximum number of documents of a single request that are in the pipeline at
+        # the same time
+        self.max_concurrent_documents = int(
+            model_config["parameters"]["max_concurrent_documents"]["string_value"]
+        )
+        # Maximum number of sentences sent in a single request to the language id
+        # model. Must not exceed the language id model's max_batch_size
+        self.max_texts_per_language_id_request = int(
+            model_config["parameters"]["max_texts_per_language_id_request"][
+                "string_value"
+            ]
+        )
 
-        # Batch convenient collections
-        self.responses = [None] * 0
-        self.is_ok = [True] * 0
+        # Consecutive sentences with the same src_lang are packed into a single chunk
+        # for translation as long as the chunk has at most this many characters.
+        # Tunable per translation model; 0 disables packing.
+        self.max_packed_chars = {
+            translation_model: int(
+                model_config["parameters"][f"max_packed_chars_{translation_model}"][
+                    "string_value"
+                ]
+            )
+            for translation_model in ["seamlessm4t_text2text", "nllb_200_distilled_600M"]
+        }
 
-    def reset_responses_is_ok(self, batch_size: int):
-        self.responses = [None] * batch_size
-        self.is_ok = [True] * batch_size
+        # Optionally tokenize the sentences and decode the translations here instead
+        # of in the translation model, which then only runs the model. Needs an
+        # execution environment with transformers. Tokenizers are loaded on first use.
+        self.tokenize_in_translate = (
+            model_config["parameters"]["tokenize_in_translate"]["string_value"].lower()
+            == "true"
+        )
+        self.tokenizers = {}
 
-    def process_request_data(self, requests: list, requests_data: dict) -> None:
-        """_summary_
+        # Sentence level translation cache. Each model instance has its own cache
+        self.translation_cache = TranslationCache(
+            max_entries=int(
+                model_config["parameters"]["translation_cache_max_entries"][
+                    "string_value"
+                ]
+            ),
+            max_bytes=int(
+                model_config["parameters"]["translation_cache_max_bytes"][
+                    "string_value"
+                ]
+            ),
+        )
+        self.cache_metric_families = {
+            event: pb_utils.MetricFamily(
+                name=f"translate_cache_{event}_total",
+                description=f"Number of translation cache {event} by translation model",
+                kind=pb_utils.MetricFamily.COUNTER,
+            )
+            for event in ["hits", "misses", "evictions"]
+        }
+        self.cache_metrics = {}
+        self.deduplicated_metric = pb_utils.MetricFamily(
+            name="translate_deduplicated_sentences_total",
+            description="Number of sentence translations saved by deduplicating "
+            + "identical sentences within a dynamic batch",
+            kind=pb_utils.MetricFamily.COUNTER,
+        ).Metric(labels={"model": model_config["name"]})
+
+    def increment_cache_metric(self, event: str, translation_model: str, value: int):
+        if value == 0:
+            return
+        if (event, translation_model) not in self.cache_metrics:
+            self.cache_metrics[(event, translation_model)] = self.cache_metric_families[
+                event
+            ].Metric(labels={"translation_model": translation_model})
+        self.cache_metrics[(event, translation_model)].increment(value)
+
+    def process_request_data(self, request) -> dict:
+        """Get the input documents and any optional request parameters for a request
 
         Parameters
         ----------
-        requests : list
-            _description_
-        responses : list
-            _description_
-        is_ok: list
-            _description_
-        requests_data: dict
-            _description_
+        request : pb_utils.InferenceRequest
+            Request submitted by a client. INPUT_TEXT is an array of documents, with
+            an optional SRC_LANG array of the same shape giving each document's
+            src_lang ("" to use the language id model).
 
         Returns
         -------
+        dict
+            {
+                "shape": (1, n_docs),
+                "input_texts": [doc_0, ..., doc_n],
+                "src_langs": [None, ..., "fra"],
+                "tgt_langs": ["eng", "deu"],
+                "language_id_threshold": 0.30,
+                "language_id_model": "fasttext_language_identification",
+                "sentence_segmenter": "sentencex",
+                "translation_model": "seamlessm4t_text2text",
+                "decoding_profile": None,
+                "use_cache": True,
+            }
+
+        Raises
+        ------
+        ValueError
+            If the INPUT_TEXT is missing or the inputs/request parameters are invalid
         """
-        for batch_id, request in enumerate(requests):
-            try:
-                input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
-            except Exception as exc:
-                response = pb_utils.InferenceResponse(
-                    error=pb_utils.TritonError(
-                        f"{exc}", pb_utils.TritonError.INVALID_ARG
-                    )
-                )
-                if self.responses[batch_id] is None:
-                    self.responses[batch_id] = response
-                self.is_ok[batch_id] = False
-                continue
-            requests_data[batch_id]["input_text_tt"] = input_text_tt
+        request_data = {}
+        input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
+        if input_text_tt is None:
+            raise ValueError("INPUT_TEXT is missing from the request")
+        input_texts = input_text_tt.as_numpy()
+        request_data["shape"] = input_texts.shape
+        request_data["input_texts"] = list(input_texts.reshape(-1))
+        n_docs = len(request_data["input_texts"])
+        if n_docs == 0:
+            raise ValueError("INPUT_TEXT has no documents")
 
-            # Get any optional parameters passed in.
-            request_params = json.loads(request.parameters())
-            ## Pipeline Stages
-            requests_data[batch_id]["language_id_model"] = request_params.get(
-                "language_id_model", self.default_language_id_model
-            )
-            requests_data[batch_id]["sentence_segmenter"] = request_params.get(
-                "sentence_segmenter", self.default_sentence_segmenter
-            )
-            requests_data[batch_id]["translation_model"] = request_params.get(
-                "translation_model", self.default_translation_model
-            )
-            translation_model = request_params.get("translation_model", None)
-            if translation_model is None:
-                requests_data[batch_id]["translation_model"] = self.default_translation_model
-            elif translation_model.lower() == "seamlessm4t":
-                requests_data[batch_id]["translation_model"] = "seamlessm4t_text2text"
-            elif translation_model.lower() == "nllb":
-                requests_data[batch_id]["translation_model"] = "nllb_200_distilled_600M"
-            else:
-                self.error_response(batch_id, f"Invalid translation model: {translation_model}")
-                return None
-            ## src_lang
-            requests_data[batch_id]["src_lang"] = request_params.get("src_lang", None)
-            ## tgt_lang, planning for adding NLLB which has different codes
-            if requests_data[batch_id]["translation_model"] == "seamlessm4t_text2text":
-                default_tgt_lang = "eng"
-            elif requests_data[batch_id]["translation_model"] == "nllb_200_distilled_600M":
-                default_tgt_lang = "eng_Latn"
-            requests_data[batch_id]["tgt_lang"] = request_params.get(
-                "tgt_lang", default_tgt_lang
-            )
-            ## Language ID Threshold
-            requests_data[batch_id]["language_id_threshold"] = request_params.get(
+        # Get any optional parameters passed in.
+        request_params = json.loads(request.parameters())
+        ## Pipeline Stages
+        request_data["language_id_model"] = request_params.get(
+            "language_id_model", self.default_language_id_model
+        )
+        request_data["sentence_segmenter"] = request_params.get(
+            "sentence_segmenter", self.default_sentence_segmenter
+        )
+        translation_model = request_params.get("translation_model", None)
+        if translation_model is None:
+            request_data["translation_model"] = self.default_translation_model
+        elif translation_model.lower() == "seamlessm4t":
+            request_data["translation_model"] = "seamlessm4t_text2text"
+        elif translation_model.lower() == "nllb":
+            request_data["translation_model"] = "nllb_200_distilled_600M"
+        else:
+            raise ValueError(f"Invalid translation model: {translation_model}")
+        ## Decoding profile, e.g., "fast", of the translation model. None uses the
+        ## translation model's default_decoding_profile
+        request_data["decoding_profile"] = request_params.get("decoding_profile", None)
+        ## src_lang. Per document SRC_LANG input takes precedence over the src_lang
+        ## request parameter which applies to every document
+        src_lang = request_params.get("src_lang", None)
+        src_lang_tt = pb_utils.get_input_tensor_by_name(request, "SRC_LANG")
+        if src_lang_tt is None:
+            request_data["src_langs"] = [src_lang] * n_docs
+        else:
+            src_langs = src_lang_tt.as_numpy().reshape(-1)
+            if len(src_langs) != n_docs:
+                raise ValueError(
+                    f"SRC_LANG has {len(src_langs)} elements, but INPUT_TEXT has "
+                    + f"{n_docs} documents"
+                )
+            request_data["src_langs"] = [
+                b.decode("utf-8") if b else src_lang for b in src_langs
+            ]
+        ## tgt_lang, SeamlessM4T and NLLB have different codes
+        if request_data["translation_model"] == "seamlessm4t_text2text":
+            default_tgt_lang = "eng"
+        elif request_data["translation_model"] == "nllb_200_distilled_600M":
+            default_tgt_lang = "eng_Latn"
+        ## Several tgt_langs may be given as a comma separated list, e.g., "eng,deu"
+        tgt_langs = request_params.get("tgt_lang", default_tgt_lang)
+        if isinstance(tgt_langs, str):
+            tgt_langs = tgt_langs.split(",")
+        request_data["tgt_langs"] = [t.strip() for t in tgt_langs if t.strip()]
+        if not request_data["tgt_langs"]:
+            raise ValueError("tgt_lang is empty")
+        if len(set(request_data["tgt_langs"])) != len(request_data["tgt_langs"]):
+            raise ValueError(f"tgt_lang has duplicates: {tgt_langs}")
+        ## Language ID Threshold
+        request_data["language_id_threshold"] = float(
+            request_params.get(
                 "language_id_threshold", self.default_language_id_threshold
             )
-            self.logger.log_info(f"{requests_data[batch_id]=}")
+        )
+        ## Use the translation cache. Clients may opt out with use_cache=false
+        use_cache = request_params.get("use_cache", True)
+        if isinstance(use_cache, str):
+            use_cache = use_cache.lower() not in ["false", "0", "no"]
+        request_data["use_cache"] = bool(use_cache) and self.translation_cache.enabled
 
-        return None
+        return request_data
 
     def submit_inference_request(
-        self, model_name: str, requested_output_names: list, inputs_tt: list
+        self,
+        model_name: str,
+        requested_output_names: list,
+        inputs_tt: list,
+        parameters: dict = None,
     ):
-        # logger = pb_utils.Logger
-        try:
-            infer_request = pb_utils.InferenceRequest(
-                model_name=model_name,
-                requested_output_names=requested_output_names,
-                inputs=inputs_tt,
-            )
-        except Exception as exc:
-            self.logger.log_error(f"{exc}")
-        return infer_request
+        return pb_utils.InferenceRequest(
+            model_name=model_name,
+            requested_output_names=requested_output_names,
+            inputs=inputs_tt,
+            parameters=parameters or {},
+        )
 
     def get_inference_response(
         self,
         infer_response,
-        batch_id: int,
         requested_output_names: list,
         error_msg: str = "",
     ) -> list:
-        # logger = pb_utils.Logger
+        """Get the requested output tensors from a BLS response
+
+        Raises
+        ------
+        RuntimeError
+            If the response has an error
+        """
         if infer_response.has_error():
-            error_msg += f" {batch_id=:} threw {infer_response.error().message()}"
-            self.error_response(batch_id, error_msg)
-            raise RuntimeError()
-        else:
-            outputs_tt = []
-            for output_name in requested_output_names:
-                try:
-                    output_tt = pb_utils.get_output_tensor_by_name(
-                        infer_response, output_name
-                    )
-                except Exception as exc:
-                    self.logger.log_error(f"{output_name=:} threw {exc}")
-                outputs_tt.append(output_tt)
-            return outputs_tt
+            raise RuntimeError(
+                f"{error_msg} threw {infer_response.error().message()}"
+            )
+        outputs_tt = []
+        for output_name in requested_output_names:
+            outputs_tt.append(
+                pb_utils.get_output_tensor_by_name(infer_response, output_name)
+            )
+        return outputs_tt
 
-    def get_src_lang(self, src_lang_tt, src_script_tt, translation_model:str):
-        """Get source language tensor formatted accordingly to the translation model
+    def get_src_lang(self, src_lang_tt, src_script_tt, translation_model: str) -> str:
+        """Get source language formatted accordingly to the translation model
         requirements
-        
+
         Parameters
         ----------
         src_lang_tt: pb_utils.Tensor
@@ -179,330 +306,1160 @@ class TritonPythonModel:
             Tensor containing the script code, if available
         translation_model: str
             Name of the translation model being used
-        
+
         Returns
         -------
-        pb_utils.Tensor
-            Properly formatted source language tensor for the specified model
+        str
+            Properly formatted source language for the specified model
         """
         src_lang = src_lang_tt.as_numpy().reshape(-1)[0].decode("utf-8")
-        
+
         if src_script_tt is not None:
             src_script = src_script_tt.as_numpy().reshape(-1)[0].decode("utf-8")
         else:
             src_script = ""
-        
+
+        return self.format_src_lang(src_lang, src_script, translation_model)
+
+    @staticmethod
+    def format_src_lang(src_lang: str, src_script: str, translation_model: str) -> str:
+        """Format a language id model's language & script for the translation model
+
+        Parameters
+        ----------
+        src_lang: str
+            Source language code, e.g., "zho"
+        src_script: str
+            Script code, e.g., "Hant". Empty string if not available
+        translation_model: str
+            Name of the translation model being used
+
+        Returns
+        -------
+        str
+            Properly formatted source language for the specified model
+        """
         if translation_model == "seamlessm4t_text2text":
             if src_lang == "zho":
                 src_lang = "cmn_Hant" if src_script == "Hant" else "cmn"
-            return pb_utils.Tensor(
-                "SRC_LANG", np.array([src_lang], dtype=np.object_).reshape(-1, 1)
-            )
         elif translation_model == "nllb_200_distilled_600M":
             if src_script:
                 src_lang = f"{src_lang}_{src_script}"
-            return pb_utils.Tensor(
-                "SRC_LANG", np.array([src_lang], dtype=np.object_).reshape(-1,1)
-            )
-        else:
-            return src_lang_tt
-            
-
-    def error_response(self, batch_id: int, error_msg: str):
-        response = pb_utils.InferenceResponse(error=pb_utils.TritonError(error_msg))
-        if self.responses[batch_id] is None:
-            self.responses[batch_id] = response
-        self.is_ok[batch_id] = False
-        self.logger.log_error(error_msg)
+        return src_lang
 
-    async def execute(self, requests: List) -> List:
+    @staticmethod
+    def is_same_language(src_lang: str, tgt_lang: str, translation_model: str) -> bool:
+        """Whether the (formatted) src_lang is already the tgt_lang. SeamlessM4T codes
+        may be given with "__" before and after. NLLB codes include the script, but
+        a client provided src_lang may not, e.g., "eng" vs "eng_Latn".
         """
-        Each request is one document that a client has submitted for translation
+        src_lang = src_lang.replace("__", "")
+        tgt_lang = tgt_lang.replace("__", "")
+        if src_lang == tgt_lang:
+            return True
+        if translation_model == "nllb_200_distilled_600M" and "_" not in src_lang:
+            return src_lang == tgt_lang.split("_")[0]
+        return False
+
+    def mark_passthrough(self, doc_inputs: dict, request_data: dict) -> None:
+        """Sentences already in the tgt_lang are returned verbatim instead of being
+        sent to the translation model"""
+        for doc_input in doc_inputs.values():
+            if self.is_same_language(
+                doc_input["src_lang"],
+                request_data["tgt_lang"],
+                request_data["translation_model"],
+            ):
+                doc_input["translated_text"] = doc_input["input_text"].decode("utf-8")
+                doc_input["passthrough"] = True
+        return None
+
+    def pack_sentences(self, doc_inputs: dict, translation_model: str) -> dict:
+        """Merge consecutive sentences with the same src_lang into a single chunk as
+        long as the chunk does not exceed the translation model's
+        `max_packed_chars`. Sentences longer than the budget are left alone. This cuts
+        down on the number of (very short) sequences sent to the translation model.
+
+        Only the sentences given are packed. Sentences are consecutive if their
+        chunk_ids are, so a sentence left out, e.g., cached or passed through, ends the
+        chunk being packed.
 
         Parameters
         ----------
-        requests : List[pb_utils.InferenceRequest]
-            List of request submitted by clients. In this simple example, this should
-            have a length of just one since dynamic batching is not enabled.
+        doc_inputs: dict
+            {<chunk_id>: {"input_text": bytes, "src_lang": str}} of the sentences to
+            pack
+        translation_model: str
+            Name of the translation model being used
 
         Returns
         -------
-        List[pb_utils.InferenceResponse]
-            Each response is the translated document for a given client's request
+        dict
+            {<chunk_id>: {"input_text": bytes, "src_lang": str, "chunk_ids": list}}
+            where the chunk_id is that of the first sentence in the packed chunk and
+            "chunk_ids" are those of all its sentences. Translating the packed chunks
+            in chunk_id order preserves the order of the document.
         """
-        logger = pb_utils.Logger
-        batch_size = len(requests)
-        logger.log_info(f"`translate` received {batch_size} requests in dynamic batch")
-        self.reset_responses_is_ok(batch_size)
-        requests_data = defaultdict(dict)
-        # requests_data = {
-        # ----<batch_id>: {
-        # --------"input_text_tt": input_text_tt,
-        # --------"src_lang": None,
-        # --------"tgt_lang": "eng",
-        # --------"language_id_threshold": 0.95,
-        # --------"language_id_model": "fasttext_language_identification",
-        # --------"sentence_segmenter": "sentencex",
-        # --------"translation_model": "seamlessm4t_text2text"
-        # ----}
-        # }
-        translate_inputs = defaultdict(dict)
-        # translate_inputs = {
-        # ----<batch_id>: {
-        # --------<chunk_id>: {
-        # ------------"input_text_tt": input_text_tt,
-        # ------------"src_lang_tt": src_lang_tt,
-        # ------------"tgt_lang_tt": tgt_lang_tt,
-        # --------}
-        # ----}
-        # }
-
-        # Get input data and request parameters for all requests
-        self.process_request_data(requests, requests_data)
-
-        # Submit valid requests for document level identification. Needed for
-        # sentence segmentation
-        # **NOTE** See if pb_utils.InferenceResponse(warnings=) is a thing
-        # Would be nice to send a warning back if client provided src_lang
-        # but it conflicted with language id model. Don't want to override
-        # a client since the language id model could be wrong.
-        doc_lang_await = []
-        doc_lang_batch_ids = []
-        src_lang_doc_tts = {}
-        src_script_doc_tts = {}
-        prob_docs = {}
-        for batch_id, request_data in requests_data.items():
-            # Should all be ok at this point
-            if not self.is_ok[batch_id]:
-                continue
-            src_lang = request_data["src_lang"]
-            if src_lang:
-                src_lang_doc_tts[batch_id] = pb_utils.Tensor(
-                    "SRC_LANG",
-                    np.array([src_lang.encode("utf-8")], np.object_).reshape(-1, 1),
-                )
-                src_script_doc_tts[batch_id] = None
-                prob_docs[batch_id] = 1.0
+        max_packed_chars = self.max_packed_chars.get(translation_model, 0)
+        if max_packed_chars <= 0:
+            return {
+                chunk_id: dict(doc_input, chunk_ids=[chunk_id])
+                for chunk_id, doc_input in doc_inputs.items()
+            }
+
+        packed_inputs = {}
+        packed_chunk_id = None
+        packed_sentences = []
+        packed_len = 0
+        for chunk_id in sorted(doc_inputs):
+            sentence = doc_inputs[chunk_id]["input_text"].decode("utf-8").strip()
+            src_lang = doc_inputs[chunk_id]["src_lang"]
+            if (
+                packed_sentences
+                and chunk_id == packed_inputs[packed_chunk_id]["chunk_ids"][-1] + 1
+                and src_lang == packed_inputs[packed_chunk_id]["src_lang"]
+                and packed_len + 1 + len(sentence) <= max_packed_chars
+            ):
+                packed_sentences.append(sentence)
+                packed_inputs[packed_chunk_id]["chunk_ids"].append(chunk_id)
+                packed_len += 1 + len(sentence)
             else:
-                doc_lang_batch_ids.append(batch_id)
-                doc_lang_await.append(
-                    self.submit_inference_request(
-                        model_name=request_data["language_id_model"],
-                        requested_output_names=[
-                            "SRC_LANG",
-                            "SRC_SCRIPT",
-                            "PROBABILITY",
-                        ],
-                        inputs_tt=[request_data["input_text_tt"]],
-                    ).async_exec()
-                )
+                if len(packed_sentences) > 1:
+                    packed_inputs[packed_chunk_id]["input_text"] = " ".join(
+                        packed_sentences
+                    ).encode("utf-8")
+                packed_chunk_id = chunk_id
+                packed_inputs[packed_chunk_id] = {
+                    "input_text": doc_inputs[chunk_id]["input_text"],
+                    "src_lang": src_lang,
+                    "chunk_ids": [chunk_id],
+                }
+                packed_sentences = [sentence]
+                packed_len = len(sentence)
+        if len(packed_sentences) > 1:
+            packed_inputs[packed_chunk_id]["input_text"] = " ".join(
+                packed_sentences
+            ).encode("utf-8")
+        return packed_inputs
 
-        # Now submit those with a src_lang to be split into sentences
-        # While the language_id_model works on those without.
-        sentence_segmenter_await = []
-        sentence_segmenter_batch_ids = []
-        for batch_id, src_lang_doc_tt in src_lang_doc_tts.items():
-            if not self.is_ok[batch_id]:
-                continue
-            sentence_segmenter_batch_ids.append(batch_id)
-            sentence_segmenter_await.append(
-                self.submit_inference_request(
-                    model_name=requests_data[batch_id]["sentence_segmenter"],
-                    requested_output_names=["SENTENCES"],
-                    inputs_tt=[
-                        src_lang_doc_tt,
-                        requests_data[batch_id]["input_text_tt"],
-                    ],
-                ).async_exec()
-            )
+    def get_tokenizer(self, translation_model: str):
+        """Tokenizer for the translation model if tokenize_in_translate is enabled and
+        the translation model accepts INPUT_IDS. Otherwise None."""
+        if not self.tokenize_in_translate or translation_model not in HF_MODEL_IDS:
+            return None
+        if translation_model not in self.tokenizers:
+            from tokenization import TranslationTokenizer
 
-        # Wait for language detection on the docs to finish
-        doc_lang_responses = await asyncio.gather(*doc_lang_await)
-        for batch_id, doc_response in zip(doc_lang_batch_ids, doc_lang_responses):
-            try:
-                src_lang_doc_tt, src_script_doc_tt, prob_doc_tt = (
-                    self.get_inference_response(
-                        doc_response,
-                        batch_id,
-                        requested_output_names=[
-                            "SRC_LANG",
-                            "SRC_SCRIPT",
-                            "PROBABILITY",
+            self.tokenizers[translation_model] = TranslationTokenizer(translation_model)
+        return self.tokenizers[translation_model]
+
+    def make_translate_requests(self, targets: dict, rows: list, request_data: dict):
+        """Bundle the sentences of a single document, for all of its tgt_langs, into
+        as few translation requests as possible. Each (sentence, tgt_lang) is a row
+        along the batch dimension, with matching SRC_LANG and TGT_LANG, so that the
+        translation model encodes each sentence once for all of the tgt_langs. Each
+        request carries at most `max_sentences_per_request` sentences and at most
+        `max_rows_per_request` rows. The rows of a sentence are only split across
+        requests if there are more tgt_langs than `max_rows_per_request`.
+
+        Parameters
+        ----------
+        targets: dict
+            {<tgt_lang>: {<chunk_id>: {"input_text": bytes, "src_lang": str}}} for
+            the document
+        rows: list[tuple[str, int]]
+            The (tgt_lang, chunk_id) to be sent for translation, grouped by chunk_id
+        request_data: dict
+            Request data for the document as made by `process_request_data`
+
+        Returns
+        -------
+        list[tuple[list[tuple[str, int]], pb_utils.InferenceRequest]]
+            The (tgt_lang, chunk_id) rows contained in each request along with the
+            request itself
+
+        If the translation model's tokenizer is loaded, see `get_tokenizer`, the
+        sentences are sent as INPUT_IDS and INPUT_LENGTHS and OUTPUT_IDS is requested
+        instead of TRANSLATED_TEXT.
+        """
+        rows_slices = []
+        n_sentences = 0
+        for _, sentence_rows in itertools.groupby(rows, key=lambda row: row[1]):
+            sentence_rows = list(sentence_rows)
+            if (
+                not rows_slices
+                or n_sentences >= self.max_sentences_per_request
+                or len(rows_slices[-1]) + len(sentence_rows) > self.max_rows_per_request
+            ):
+                rows_slices.append([])
+                n_sentences = 0
+            n_sentences += 1
+            for row in sentence_rows:
+                if len(rows_slices[-1]) >= self.max_rows_per_request:
+                    # More tgt_langs than max_rows_per_request
+                    rows_slices.append([])
+                    n_sentences = 1
+                rows_slices[-1].append(row)
+
+        translate_requests = []
+        tokenizer = self.get_tokenizer(request_data["translation_model"])
+        parameters = {}
+        if request_data["decoding_profile"] is not None:
+            parameters["decoding_profile"] = request_data["decoding_profile"]
+        for rows_slice in rows_slices:
+            doc_inputs = [
+                targets[tgt_lang][chunk_id] for tgt_lang, chunk_id in rows_slice
+            ]
+            src_langs = [doc_input["src_lang"] for doc_input in doc_inputs]
+            if tokenizer is not None:
+                input_ids, input_lengths = tokenizer.pad(
+                    tokenizer.encode(
+                        [
+                            doc_input["input_text"].decode("utf-8")
+                            for doc_input in doc_inputs
                         ],
-                        error_msg=f"{requests_data[batch_id]['language_id_model']}",
+                        src_langs,
                     )
                 )
-            except Exception as exc:
-                self.error_response(
-                    batch_id, f"Gathering doc_lang_responses threw {exc}"
-                )
+                input_tts = [
+                    pb_utils.Tensor("INPUT_IDS", input_ids),
+                    pb_utils.Tensor("INPUT_LENGTHS", input_lengths),
+                ]
+                requested_output_names = ["OUTPUT_IDS"]
             else:
-                src_lang_doc_tts[batch_id] = src_lang_doc_tt
-                src_script_doc_tts[batch_id] = src_script_doc_tt
-                prob_docs[batch_id] = prob_doc_tt.as_numpy().reshape(-1)[0]
+                input_tts = [
+                    pb_utils.Tensor(
+                        "INPUT_TEXT",
+                        np.array(
+                            [doc_input["input_text"] for doc_input in doc_inputs],
+                            dtype=np.object_,
+                        ).reshape(-1, 1),
+                    )
+                ]
+                requested_output_names = ["TRANSLATED_TEXT"]
+            src_lang_tt = pb_utils.Tensor(
+                "SRC_LANG", np.array(src_langs, dtype=np.object_).reshape(-1, 1)
+            )
+            tgt_lang_tt = pb_utils.Tensor(
+                "TGT_LANG",
+                np.array(
+                    [tgt_lang for tgt_lang, _ in rows_slice], dtype=np.object_
+                ).reshape(-1, 1),
+            )
+            translate_requests.append(
+                (
+                    rows_slice,
+                    self.submit_inference_request(
+                        model_name=request_data["translation_model"],
+                        requested_output_names=requested_output_names,
+                        inputs_tt=input_tts + [src_lang_tt, tgt_lang_tt],
+                        parameters=parameters,
+                    ),
+                )
+            )
+        return translate_requests
+
+    def cache_key(self, doc_input: dict, request_data: dict) -> tuple:
+        return self.translation_cache.make_key(
+            request_data["translation_model"],
+            request_data["decoding_profile"],
+            doc_input["src_lang"],
+            request_data["tgt_lang"],
+            doc_input["input_text"].decode("utf-8"),
+        )
 
-        # Submit these for sentence segmentation now too
-        for batch_id in doc_lang_batch_ids:
-            if not self.is_ok[batch_id]:
+    def lookup_cache(self, doc_inputs: dict, request_data: dict) -> None:
+        """Fill in the "translated_text" for any chunks of the document that are
+        already in the translation cache.
+
+        Parameters
+        ----------
+        doc_inputs: dict
+            {<chunk_id>: {"input_text": bytes, "src_lang": str}} for the document
+        request_data: dict
+            Request data for the document as made by `process_request_data`
+        """
+        if not request_data["use_cache"]:
+            return None
+        n_hits = 0
+        n_lookups = 0
+        for doc_input in doc_inputs.values():
+            if "translated_text" in doc_input:
                 continue
-            src_lang_doc_tt = src_lang_doc_tts[batch_id]
-            input_text_tt = requests_data[batch_id]["input_text_tt"]
-            sentence_segmenter_batch_ids.append(batch_id)
-            sentence_segmenter_await.append(
-                self.submit_inference_request(
-                    model_name=requests_data[batch_id]["sentence_segmenter"],
-                    requested_output_names=["SENTENCES"],
-                    inputs_tt=[src_lang_doc_tt, input_text_tt],
-                ).async_exec()
+            n_lookups += 1
+            translated_text = self.translation_cache.get(
+                self.cache_key(doc_input, request_data)
             )
+            if translated_text is not None:
+                doc_input["translated_text"] = translated_text
+                n_hits += 1
+        translation_model = request_data["translation_model"]
+        self.increment_cache_metric("hits", translation_model, n_hits)
+        self.increment_cache_metric("misses", translation_model, n_lookups - n_hits)
+        return None
 
-        # Await for all the sentence splitting
-        translate_inputs = defaultdict(dict)
-        sentence_segmenter_responses = await asyncio.gather(*sentence_segmenter_await)
-        for batch_id, sentences_response in zip(
-            sentence_segmenter_batch_ids, sentence_segmenter_responses
-        ):
-            if not self.is_ok[batch_id]:
-                continue
-            try:
-                (sentences_tt,) = self.get_inference_response(
-                    sentences_response,
-                    batch_id,
-                    requested_output_names=["SENTENCES"],
-                    error_msg=f"{requests_data[batch_id]['sentence_segmenter']}",
+    def update_cache(self, doc_input: dict, request_data: dict) -> None:
+        if not request_data["use_cache"]:
+            return None
+        evicted = self.translation_cache.put(
+            self.cache_key(doc_input, request_data), doc_input["translated_text"]
+        )
+        for translation_model, *_ in evicted:
+            self.increment_cache_metric("evictions", translation_model, 1)
+        return None
+
+    def send_chunk(
+        self,
+        response_sender,
+        doc_id: int,
+        tgt_lang: str,
+        chunk_id: int,
+        translated_text: str,
+        passthrough: bool = False,
+    ) -> None:
+        """In decoupled mode, stream a translated chunk back to the client along with
+        its DOCUMENT_ID, TGT_LANG and CHUNK_ID. The response parameter `passthrough`
+        is true if the chunk was already in the tgt_lang and returned verbatim. Does
+        nothing otherwise."""
+        if response_sender is None:
+            return None
+        translated_text_tt = pb_utils.Tensor(
+            "TRANSLATED_TEXT",
+            np.array([translated_text], dtype=self.translated_text_dtype).reshape(
+                -1, 1
+            ),
+        )
+        doc_id_tt = pb_utils.Tensor(
+            "DOCUMENT_ID", np.array([doc_id], dtype=self.chunk_id_dtype).reshape(-1, 1)
+        )
+        tgt_lang_tt = pb_utils.Tensor(
+            "TGT_LANG", np.array([tgt_lang], dtype=np.object_).reshape(-1, 1)
+        )
+        chunk_id_tt = pb_utils.Tensor(
+            "CHUNK_ID", np.array([chunk_id], dtype=self.chunk_id_dtype).reshape(-1, 1)
+        )
+        response_sender.send(
+            pb_utils.InferenceResponse(
+                output_tensors=[
+                    translated_text_tt,
+                    doc_id_tt,
+                    tgt_lang_tt,
+                    chunk_id_tt,
+                ],
+                parameters={"passthrough": passthrough},
+            )
+        )
+        return None
+
+    def error_response(self, error_msg: str, code=None):
+        self.logger.log_error(error_msg)
+        if code is None:
+            error = pb_utils.TritonError(error_msg)
+        else:
+            error = pb_utils.TritonError(error_msg, code)
+        return pb_utils.InferenceResponse(error=error)
+
+    async def identify_document_language(
+        self, request_data: dict, input_text_tt, src_lang: str
+    ) -> tuple:
+        """Document level language identification. Skipped if the client provided
+        the src_lang.
+
+        Returns
+        -------
+        tuple[pb_utils.Tensor, pb_utils.Tensor | None, float]
+            SRC_LANG, SRC_SCRIPT, and the probability of the top prediction
+        """
+        if src_lang:
+            src_lang_doc_tt = pb_utils.Tensor(
+                "SRC_LANG",
+                np.array([src_lang.encode("utf-8")], np.object_).reshape(-1, 1),
+            )
+            return src_lang_doc_tt, None, 1.0
+
+        # **NOTE** See if pb_utils.InferenceResponse(warnings=) is a thing
+        # Would be nice to send a warning back if client provided src_lang
+        # but it conflicted with language id model. Don't want to override
+        # a client since the language id model could be wrong.
+        doc_response = await self.submit_inference_request(
+            model_name=request_data["language_id_model"],
+            requested_output_names=["SRC_LANG", "SRC_SCRIPT", "PROBABILITY"],
+            inputs_tt=[input_text_tt],
+        ).async_exec()
+        try:
+            src_lang_doc_tt, src_script_doc_tt, prob_doc_tt = (
+                self.get_inference_response(
+                    doc_response,
+                    requested_output_names=["SRC_LANG", "SRC_SCRIPT", "PROBABILITY"],
+                    error_msg=f"{request_data['language_id_model']}",
                 )
-                for chunk_id, sentence in enumerate(
-                    sentences_tt.as_numpy().reshape(-1)
-                ):
-                    translate_inputs[batch_id][chunk_id] = {
-                        "input_text_tt": pb_utils.Tensor(
+            )
+        except Exception as exc:
+            raise RuntimeError(f"Gathering doc_lang_responses threw {exc}")
+        prob_doc = prob_doc_tt.as_numpy().reshape(-1)[0]
+        return src_lang_doc_tt, src_script_doc_tt, prob_doc
+
+    async def segment_sentences(
+        self, request_data: dict, input_text_tt, src_lang_doc_tt
+    ) -> dict:
+        """Split the document into sentences
+
+        Returns
+        -------
+        dict
+            {<chunk_id>: {"input_text": sentence}}
+        """
+        sentences_response = await self.submit_inference_request(
+            model_name=request_data["sentence_segmenter"],
+            requested_output_names=["SENTENCES"],
+            inputs_tt=[src_lang_doc_tt, input_text_tt],
+        ).async_exec()
+        try:
+            (sentences_tt,) = self.get_inference_response(
+                sentences_response,
+                requested_output_names=["SENTENCES"],
+                error_msg=f"{request_data['sentence_segmenter']}",
+            )
+        except Exception as exc:
+            raise RuntimeError(f"Gathering sentence_segmenter_responses threw {exc}")
+        doc_inputs = {}
+        for chunk_id, sentence in enumerate(sentences_tt.as_numpy().reshape(-1)):
+            doc_inputs[chunk_id] = {"input_text": sentence}
+        return doc_inputs
+
+    async def identify_sentence_languages(
+        self, doc_inputs: dict, request_data: dict, doc_src_lang: str
+    ) -> None:
+        """Language identification of each sentence. The sentences of the document are
+        sent together, at most `max_texts_per_language_id_request` per request, and
+        the "src_lang" of each of the doc_inputs is filled in from the returned
+        SRC_LANG and SRC_SCRIPT arrays. A sentence without a prediction, "", gets the
+        document's `doc_src_lang` instead.
+
+        Raises
+        ------
+        ValueError
+            If neither a sentence nor its document has a predicted language
+        """
+        chunk_ids = sorted(doc_inputs)
+        chunk_ids_slices = [
+            chunk_ids[start : start + self.max_texts_per_language_id_request]
+            for start in range(
+                0, len(chunk_ids), self.max_texts_per_language_id_request
+            )
+        ]
+        sentence_lang_id_responses = await asyncio.gather(
+            *[
+                self.submit_inference_request(
+                    model_name=request_data["language_id_model"],
+                    requested_output_names=["SRC_LANG", "SRC_SCRIPT"],
+                    inputs_tt=[
+                        pb_utils.Tensor(
                             "INPUT_TEXT",
-                            np.array([sentence], dtype=np.object_).reshape(-1, 1),
+                            np.array(
+                                [
+                                    doc_inputs[chunk_id]["input_text"]
+                                    for chunk_id in chunk_ids_slice
+                                ],
+                                dtype=np.object_,
+                            ).reshape(-1, 1),
                         )
-                    }
-            except Exception as exc:
-                self.error_response(
-                    f"Gathering sentence_segmenter_responses threw {exc}"
-                )
-        # For those that have prob_doc < langauge_id_threshold, we need to do language
-        # identification for each of the sentences. Let's submit those now
-        sentence_lang_id_await = []
-        sentence_lang_id_batch_chunk_ids = []
-        translate_await = []
-        translate_batch_chunk_ids = []
-        for batch_id in translate_inputs:
-            if not self.is_ok[batch_id]:
-                continue
-            if prob_docs[batch_id] < requests_data[batch_id]["language_id_threshold"]:
-                for chunk_id in translate_inputs[batch_id]:
-                    sentence_tt = translate_inputs[batch_id][chunk_id]["input_text_tt"]
-                    sentence_lang_id_batch_chunk_ids.append((batch_id, chunk_id))
-                    sentence_lang_id_await.append(
-                        self.submit_inference_request(
-                            model_name=requests_data[batch_id]["language_id_model"],
-                            requested_output_names=["SRC_LANG", "SRC_SCRIPT"],
-                            inputs_tt=[sentence_tt],
-                        ).async_exec()
-                    )
-            else:
-                # Submit these for translation
-                for chunk_id in translate_inputs[batch_id]:
-                    sentence_tt = translate_inputs[batch_id][chunk_id]["input_text_tt"]
-                    src_lang_tt = self.get_src_lang(
-                        src_lang_doc_tts[batch_id],
-                        src_script_doc_tts[batch_id],
-                        requests_data[batch_id]["translation_model"]
-                    )
-                    tgt_lang_tt = pb_utils.Tensor(
-                        "TGT_LANG",
-                        np.array(
-                            [requests_data[batch_id]["tgt_lang"]], dtype=np.object_
-                        ).reshape(-1, 1),
-                    )
-                    translate_batch_chunk_ids.append((batch_id, chunk_id))
-                    translate_await.append(
-                        self.submit_inference_request(
-                            model_name=requests_data[batch_id]["translation_model"],
-                            requested_output_names=["TRANSLATED_TEXT"],
-                            inputs_tt=[sentence_tt, src_lang_tt, tgt_lang_tt],
-                        ).async_exec()
-                    )
-        # Await for language detection at sentence level and gather results and
-        # submit these for translation
-        sentence_lang_id_responses = await asyncio.gather(*sentence_lang_id_await)
-        for (batch_id, chunk_id), sentence_lang_id_response in zip(
-            sentence_lang_id_batch_chunk_ids, sentence_lang_id_responses
+                    ],
+                ).async_exec()
+                for chunk_ids_slice in chunk_ids_slices
+            ]
+        )
+        for chunk_ids_slice, sentence_lang_id_response in zip(
+            chunk_ids_slices, sentence_lang_id_responses
         ):
             try:
                 src_lang_tt, src_script_tt = self.get_inference_response(
                     sentence_lang_id_response,
-                    batch_id,
                     requested_output_names=["SRC_LANG", "SRC_SCRIPT"],
-                    error_msg=f"{requests_data[batch_id]['language_id_model']} "
-                    + "on sentences",
+                    error_msg=f"{request_data['language_id_model']} on sentences",
                 )
-                sentence_tt = translate_inputs[batch_id][chunk_id]["input_text_tt"]
-                src_lang_tt = self.get_src_lang(
-                    src_lang_tt,
-                    src_script_tt,
-                    requests_data[batch_id]["translation_model"],
+            except Exception as exc:
+                raise RuntimeError(
+                    f"Gathering sentence-level lang_id for translation threw {exc}"
                 )
-                tgt_lang_tt = pb_utils.Tensor(
-                    "TGT_LANG",
-                    np.array(
-                        [requests_data[batch_id]["tgt_lang"]], dtype=np.object_
-                    ).reshape(-1, 1),
+            # One row per sentence. First column is the top prediction
+            src_langs = src_lang_tt.as_numpy().reshape(len(chunk_ids_slice), -1)
+            src_scripts = src_script_tt.as_numpy().reshape(len(chunk_ids_slice), -1)
+            for chunk_id, src_lang, src_script in zip(
+                chunk_ids_slice, src_langs[:, 0], src_scripts[:, 0]
+            ):
+                src_lang = src_lang.decode("utf-8")
+                if not src_lang and not doc_src_lang:
+                    raise ValueError(
+                        f"{request_data['language_id_model']} didn't identify the "
+                        + f"language of sentence {chunk_id} or of its document"
+                    )
+                doc_inputs[chunk_id]["src_lang"] = (
+                    self.format_src_lang(
+                        src_lang,
+                        src_script.decode("utf-8"),
+                        request_data["translation_model"],
+                    )
+                    if src_lang
+                    else doc_src_lang
                 )
-                translate_batch_chunk_ids.append((batch_id, chunk_id))
-                translate_await.append(
-                    self.submit_inference_request(
-                        model_name=requests_data[batch_id]["translation_model"],
-                        requested_output_names=["TRANSLATED_TEXT"],
-                        inputs_tt=[sentence_tt, src_lang_tt, tgt_lang_tt],
-                    ).async_exec()
+        return None
+
+    def claim_sentences(
+        self, doc_inputs: dict, request_data: dict, inflight: dict
+    ) -> tuple:
+        """Claim the sentences of the document that no one else in the batch is
+        already translating and pack them with `pack_sentences`, replacing them in
+        doc_inputs with their packed chunks. Sentences repeated within the document
+        aren't packed so that their later occurrences can wait on the first. Packed
+        chunks found in the translation cache get their "translated_text" and are
+        neither sent nor waited on.
+
+        Parameters
+        ----------
+        doc_inputs: dict
+            {<chunk_id>: {"input_text": bytes, "src_lang": str}} for the document
+        request_data: dict
+            Request data for the document with the "tgt_lang" being translated into
+        inflight: dict
+            {<key>: asyncio.Future} of the sentences being translated in the batch
+
+        Returns
+        -------
+        tuple[dict, dict]
+            {<chunk_id>: asyncio.Future} of the chunks to send to the translation
+            model and of the chunks to wait on
+        """
+        owned_keys = {}
+        waiting_keys = {}
+        for chunk_id in sorted(doc_inputs):
+            if "translated_text" in doc_inputs[chunk_id]:
+                continue
+            key = self.cache_key(doc_inputs[chunk_id], request_data)
+            if key in inflight or key in owned_keys.values():
+                waiting_keys[chunk_id] = key
+            else:
+                owned_keys[chunk_id] = key
+        repeated_keys = set(waiting_keys.values())
+        packed_inputs = self.pack_sentences(
+            {
+                chunk_id: doc_inputs[chunk_id]
+                for chunk_id, key in owned_keys.items()
+                if key not in repeated_keys
+            },
+            request_data["translation_model"],
+        )
+        for chunk_id, key in owned_keys.items():
+            if key in repeated_keys:
+                packed_inputs[chunk_id] = dict(
+                    doc_inputs[chunk_id], chunk_ids=[chunk_id]
                 )
-            except Exception as exc:
-                self.error_response(
-                    batch_id,
-                    f"Gathering sentence-level lang_id for translation threw {exc}",
+
+        packed_chunk_ids = []
+        for chunk_id in sorted(packed_inputs):
+            packed_input = packed_inputs[chunk_id]
+            chunk_ids = packed_input.pop("chunk_ids")
+            for packed_chunk_id in chunk_ids[1:]:
+                del doc_inputs[packed_chunk_id]
+            doc_inputs[chunk_id] = packed_input
+            if len(chunk_ids) > 1:
+                packed_chunk_ids.append(chunk_id)
+        # Packed chunks are cached under their joined text, so the same sentences
+        # packed the same way, e.g., a repeated document, are found in the cache
+        if packed_chunk_ids:
+            self.lookup_cache(
+                {chunk_id: doc_inputs[chunk_id] for chunk_id in packed_chunk_ids},
+                request_data,
+            )
+
+        owned_futures = {}
+        for chunk_id in sorted(packed_inputs):
+            packed_input = doc_inputs[chunk_id]
+            if "translated_text" in packed_input:
+                continue
+            key = self.cache_key(packed_input, request_data)
+            if key in inflight:
+                waiting_keys[chunk_id] = key
+            else:
+                inflight[key] = asyncio.get_running_loop().create_future()
+                owned_futures[chunk_id] = inflight[key]
+        waiting_futures = {
+            chunk_id: inflight[key] for chunk_id, key in sorted(waiting_keys.items())
+        }
+        return owned_futures, waiting_futures
+
+    async def translate_sentences(
+        self,
+        targets: dict,
+        request_data: dict,
+        batch_state: dict,
+        doc_id: int = 0,
+        response_sender=None,
+    ) -> dict:
+        """Translate each of the sentences of the document into each of the tgt_langs,
+        filling in the "translated_text" of each of the targets' doc_inputs. Cached
+        translations are used when available and chunks that already have a
+        "translated_text", e.g., passed through, are left alone. If `response_sender`
+        is given, each translated chunk is streamed back as soon as it is ready.
+
+        Identical (translation_model, src_lang, tgt_lang, sentence) sentences, whether
+        within this document or in another document of the same dynamic batch, are
+        only sent to the translation model once. The first document to need it sends
+        it and the others wait on its result, see `claim_sentences`. The sentences
+        left for every tgt_lang are sent together, see `make_translate_requests`.
+
+        Parameters
+        ----------
+        targets: dict
+            {<tgt_lang>: {<chunk_id>: {"input_text": bytes, "src_lang": str}}}, a copy
+            of the document's doc_inputs for each tgt_lang
+        request_data: dict
+            Request data for the document as made by `process_request_data`
+        batch_state: dict
+            Shared by all the requests in the dynamic batch.
+            {"inflight": {<key>: asyncio.Future}, "n_deduplicated": int}
+        doc_id: int
+            Index of the document within its request
+        response_sender: pb_utils.InferenceResponseSender, optional
+            Only given in decoupled mode
+
+        Returns
+        -------
+        dict
+            {<tgt_lang>: Exception} for each of the tgt_langs that failed
+        """
+        inflight = batch_state["inflight"]
+        tgt_request_data = {}
+        owned_futures = {}
+        waiting_futures = {}
+        try:
+            for tgt_lang, doc_inputs in targets.items():
+                tgt_request_data[tgt_lang] = dict(request_data, tgt_lang=tgt_lang)
+                self.lookup_cache(doc_inputs, tgt_request_data[tgt_lang])
+                tgt_owned_futures, tgt_waiting_futures = self.claim_sentences(
+                    doc_inputs, tgt_request_data[tgt_lang], inflight
                 )
+                for chunk_id in sorted(doc_inputs):
+                    if "translated_text" in doc_inputs[chunk_id]:
+                        self.send_chunk(
+                            response_sender,
+                            doc_id,
+                            tgt_lang,
+                            chunk_id,
+                            doc_inputs[chunk_id]["translated_text"],
+                            doc_inputs[chunk_id].get("passthrough", False),
+                        )
+                for chunk_id, future in tgt_owned_futures.items():
+                    owned_futures[tgt_lang, chunk_id] = future
+                for chunk_id, future in tgt_waiting_futures.items():
+                    waiting_futures[tgt_lang, chunk_id] = future
+        except Exception as exc:
+            # Don't leave any other document waiting on our sentences
+            for future in owned_futures.values():
+                future.set_exception(exc)
+                future.exception()
+            raise
+        batch_state["n_deduplicated"] += len(waiting_futures)
+
+        errors = {}
 
-        # Gather the translation results
-        translate_responses = await asyncio.gather(*translate_await)
+        def fail_target(tgt_lang: str, exc: Exception) -> None:
+            """Don't leave any other document waiting on the tgt_lang's sentences"""
+            errors.setdefault(tgt_lang, exc)
+            for (tgt, _), future in owned_futures.items():
+                if tgt == tgt_lang and not future.done():
+                    future.set_exception(exc)
+                    # Mark as retrieved in case no one else was waiting on it
+                    future.exception()
 
-        results = defaultdict(dict)
-        for (batch_id, chunk_id), translate_response in zip(
-            translate_batch_chunk_ids, translate_responses
+        # Rows of the same sentence are next to each other so that they are sent in
+        # the same request
+        tgt_order = {tgt_lang: k for k, tgt_lang in enumerate(targets)}
+        rows = sorted(owned_futures, key=lambda row: (row[1], tgt_order[row[0]]))
+        try:
+            translate_requests = self.make_translate_requests(
+                targets, rows, request_data
+            )
+        except Exception as exc:
+            for tgt_lang in targets:
+                fail_target(tgt_lang, exc)
+            translate_requests = []
+        for translate_done in asyncio.as_completed(
+            [
+                self.tag_awaitable(rows_slice, translate_request.async_exec())
+                for rows_slice, translate_request in translate_requests
+            ]
         ):
             try:
-                (translated_chunk_tt,) = self.get_inference_response(
-                    translate_response,
-                    batch_id,
-                    requested_output_names=["TRANSLATED_TEXT"],
-                    error_msg=f"{requests_data[batch_id]['translation_model']} threw",
+                rows_slice, translate_response = await translate_done
+            except Exception as exc:
+                # Not known which rows the request had
+                for tgt_lang in targets:
+                    fail_target(tgt_lang, exc)
+                continue
+            try:
+                translated_chunks = self.get_translations(
+                    translate_response, request_data["translation_model"]
                 )
-                translated_chunk = (
-                    translated_chunk_tt.as_numpy().reshape(-1)[0].decode("utf-8")
+            except Exception as exc:
+                exc = RuntimeError(f"Gathering translated results threw {exc}")
+                for tgt_lang in {tgt_lang for tgt_lang, _ in rows_slice}:
+                    fail_target(tgt_lang, exc)
+                continue
+            for (tgt_lang, chunk_id), translated_chunk in zip(
+                rows_slice, translated_chunks
+            ):
+                if tgt_lang in errors:
+                    continue
+                doc_input = targets[tgt_lang][chunk_id]
+                doc_input["translated_text"] = translated_chunk
+                owned_futures[tgt_lang, chunk_id].set_result(translated_chunk)
+                self.update_cache(doc_input, tgt_request_data[tgt_lang])
+                self.send_chunk(
+                    response_sender,
+                    doc_id,
+                    tgt_lang,
+                    chunk_id,
+                    doc_input["translated_text"],
                 )
-                results[batch_id][chunk_id] = translated_chunk
+        for tgt_lang in targets:
+            missing_chunk_ids = [
+                chunk_id
+                for (tgt, chunk_id), future in owned_futures.items()
+                if tgt == tgt_lang and not future.done()
+            ]
+            if missing_chunk_ids:
+                fail_target(
+                    tgt_lang,
+                    RuntimeError(
+                        f"{request_data['translation_model']} did not return "
+                        + f"translations for chunks {missing_chunk_ids}"
+                    ),
+                )
+
+        for (tgt_lang, chunk_id), future in waiting_futures.items():
+            if tgt_lang in errors:
+                continue
+            try:
+                translated_text = await future
             except Exception as exc:
-                self.error_response(
-                    batch_id, f"Gathering translated results threw {exc}"
+                fail_target(tgt_lang, exc)
+                continue
+            doc_input = targets[tgt_lang][chunk_id]
+            doc_input["translated_text"] = translated_text
+            self.send_chunk(
+                response_sender,
+                doc_id,
+                tgt_lang,
+                chunk_id,
+                doc_input["translated_text"],
+            )
+        return errors
+
+    def get_translations(self, translate_response, translation_model: str) -> list:
+        """Translations in a translation model's response, decoding its OUTPUT_IDS if
+        the request was tokenized here"""
+        tokenizer = self.get_tokenizer(translation_model)
+        if tokenizer is not None:
+            (output_ids_tt,) = self.get_inference_response(
+                translate_response,
+                requested_output_names=["OUTPUT_IDS"],
+                error_msg=f"{translation_model}",
+            )
+            return tokenizer.decode(output_ids_tt.as_numpy())
+        (translated_chunks_tt,) = self.get_inference_response(
+            translate_response,
+            requested_output_names=["TRANSLATED_TEXT"],
+            error_msg=f"{translation_model}",
+        )
+        return [b.decode("utf-8") for b in translated_chunks_tt.as_numpy().reshape(-1)]
+
+    @staticmethod
+    async def tag_awaitable(tag, awaitable):
+        return tag, await awaitable
+
+    async def translate_document(
+        self,
+        request_data: dict,
+        doc_id: int,
+        batch_state: dict,
+        semaphore: asyncio.Semaphore,
+        response_sender=None,
+    ) -> list:
+        """Run a single document through the whole pipeline. Each document moves on to
+        the next stage as soon as its own previous stage has finished, independent
+        of the other documents in the request and the dynamic batch. Language id and
+        sentence segmentation are done once and then the sentences are translated
+        into all of the tgt_langs together.
+
+        Parameters
+        ----------
+        request_data : dict
+            Request data as made by `process_request_data`
+        doc_id : int
+            Index of the document within the request
+        batch_state : dict
+            State shared by all the requests in the dynamic batch. Used to translate
+            identical sentences only once. See `translate_sentences`
+        semaphore : asyncio.Semaphore
+            Limits the number of documents of a request in flight at once
+        response_sender : pb_utils.InferenceResponseSender, optional
+            Only given in decoupled mode. Translated chunks are streamed through it.
+
+        Returns
+        -------
+        list[tuple[dict, bool] | Exception]
+            For each of the tgt_langs, the doc_inputs,
+            {<chunk_id>: {"translated_text": str, ...}}, and whether the whole
+            document was passed through verbatim, or the exception raised while
+            translating into that tgt_lang
+
+        Raises
+        ------
+        Exception
+            If language identification of the document fails
+        """
+        async with semaphore:
+            input_text = request_data["input_texts"][doc_id]
+            input_text_tt = pb_utils.Tensor(
+                "INPUT_TEXT", np.array([input_text], dtype=np.object_).reshape(-1, 1)
+            )
+            # Document level language identification. Needed for sentence
+            # segmentation
+            src_lang_doc_tt, src_script_doc_tt, prob_doc = (
+                await self.identify_document_language(
+                    request_data, input_text_tt, request_data["src_langs"][doc_id]
                 )
+            )
+            src_lang = self.get_src_lang(
+                src_lang_doc_tt, src_script_doc_tt, request_data["translation_model"]
+            )
+            tgt_results = {}
+            for tgt_lang in request_data["tgt_langs"]:
+                if prob_doc >= request_data[
+                    "language_id_threshold"
+                ] and self.is_same_language(
+                    src_lang, tgt_lang, request_data["translation_model"]
+                ):
+                    # Whole document is already in the tgt_lang. Return it verbatim
+                    doc_inputs = {
+                        0: {
+                            "input_text": input_text,
+                            "src_lang": src_lang,
+                            "translated_text": input_text.decode("utf-8"),
+                            "passthrough": True,
+                        }
+                    }
+                    self.send_chunk(
+                        response_sender,
+                        doc_id,
+                        tgt_lang,
+                        0,
+                        doc_inputs[0]["translated_text"],
+                        True,
+                    )
+                    tgt_results[tgt_lang] = (doc_inputs, True)
+            tgt_langs = [t for t in request_data["tgt_langs"] if t not in tgt_results]
+            if tgt_langs:
+                try:
+                    doc_inputs = await self.segment_sentences(
+                        request_data, input_text_tt, src_lang_doc_tt
+                    )
+                    if not doc_inputs:
+                        raise ValueError("No sentences found in INPUT_TEXT")
+                    # For those that have prob_doc < language_id_threshold, we need to
+                    # do language identification for each of the sentences
+                    if prob_doc < request_data["language_id_threshold"]:
+                        await self.identify_sentence_languages(
+                            doc_inputs, request_data, src_lang
+                        )
+                    else:
+                        for doc_input in doc_inputs.values():
+                            doc_input["src_lang"] = src_lang
+                except Exception as exc:
+                    tgt_results.update({tgt_lang: exc for tgt_lang in tgt_langs})
+                else:
+                    tgt_results.update(
+                        await self.translate_targets(
+                            doc_inputs,
+                            request_data,
+                            tgt_langs,
+                            batch_state,
+                            doc_id,
+                            response_sender,
+                        )
+                    )
+        return [tgt_results[tgt_lang] for tgt_lang in request_data["tgt_langs"]]
+
+    async def translate_targets(
+        self,
+        doc_inputs: dict,
+        request_data: dict,
+        tgt_langs: list,
+        batch_state: dict,
+        doc_id: int,
+        response_sender=None,
+    ) -> dict:
+        """Translate the segmented sentences of a document into each of the
+        tgt_langs. Works on a copy of the doc_inputs for each tgt_lang since
+        passthrough and packing depend on the tgt_lang.
+
+        Returns
+        -------
+        dict[str, tuple[dict, bool] | Exception]
+            For each tgt_lang, the doc_inputs,
+            {<chunk_id>: {"translated_text": str, ...}}, and False since the whole
+            document was not passed through verbatim, or the exception raised while
+            translating into that tgt_lang
+        """
+        targets = {}
+        for tgt_lang in tgt_langs:
+            targets[tgt_lang] = {
+                chunk_id: dict(doc_input) for chunk_id, doc_input in doc_inputs.items()
+            }
+            self.mark_passthrough(
+                targets[tgt_lang], dict(request_data, tgt_lang=tgt_lang)
+            )
+        errors = await self.translate_sentences(
+            targets, request_data, batch_state, doc_id, response_sender
+        )
+        return {
+            tgt_lang: errors.get(tgt_lang, (targets[tgt_lang], False))
+            for tgt_lang in tgt_langs
+        }
 
-        for batch_id in sorted(results):
-            if self.is_ok[batch_id]:
-                result = results[batch_id]
-                translated_chunks = [result[chunk_id] for chunk_id in sorted(result)]
-                translated_doc = " ".join(translated_chunks)
-                translated_doc_tt = pb_utils.Tensor(
-                    "TRANSLATED_TEXT",
-                    np.array([translated_doc], dtype=self.translated_text_dtype),
+    async def translate_request(
+        self, request, batch_state: dict, response_sender=None
+    ):
+        """Translate each of the documents in a request concurrently, at most
+        `max_concurrent_documents` at a time, into each of the tgt_langs.
+
+        Parameters
+        ----------
+        request : pb_utils.InferenceRequest
+            Request submitted by a client
+        batch_state : dict
+            State shared by all the requests in the dynamic batch
+        response_sender : pb_utils.InferenceResponseSender, optional
+            Only given in decoupled mode. Translated chunks are streamed through it
+            followed by a final flag.
+
+        Returns
+        -------
+        pb_utils.InferenceResponse | None
+            The translated documents, or an error if the request is invalid or every
+            document failed. None in decoupled mode.
+        """
+        try:
+            request_data = self.process_request_data(request)
+        except Exception as exc:
+            response = self.error_response(f"{exc}", pb_utils.TritonError.INVALID_ARG)
+            return self.finish_response(response, response_sender)
+        n_docs = len(request_data["input_texts"])
+        self.logger.log_info(
+            f"`translate` request with {n_docs} documents, "
+            + f"tgt_lang={','.join(request_data['tgt_langs'])}, "
+            + f"translation_model={request_data['translation_model']}"
+        )
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_documents)
+        doc_results = await asyncio.gather(
+            *[
+                self.translate_document(
+                    request_data, doc_id, batch_state, semaphore, response_sender
                 )
-                # Create the response
-                inference_response = pb_utils.InferenceResponse(
-                    output_tensors=[translated_doc_tt]
+                for doc_id in range(n_docs)
+            ],
+            return_exceptions=True,
+        )
+        # Result, or exception, for each document and tgt_lang
+        results = []
+        errors = []
+        for doc_id, doc_result in enumerate(doc_results):
+            if isinstance(doc_result, BaseException):
+                doc_result = [doc_result] * len(request_data["tgt_langs"])
+            results.append(doc_result)
+            errors.append([])
+            for tgt_lang, tgt_result in zip(request_data["tgt_langs"], doc_result):
+                if isinstance(tgt_result, BaseException):
+                    errors[-1].append(f"{tgt_result}")
+                    self.logger.log_error(
+                        f"Document {doc_id} into {tgt_lang} threw {tgt_result}"
+                    )
+                else:
+                    errors[-1].append("")
+        if all(all(doc_errors) for doc_errors in errors):
+            # Nothing was translated. Send back an error like a single document
+            # request would.
+            response = self.error_response(
+                "; ".join(sorted(set(e for doc_errors in errors for e in doc_errors)))
+            )
+            return self.finish_response(response, response_sender)
+
+        if response_sender is not None:
+            # Translated chunks have been streamed. Send back any document errors
+            for doc_id, doc_errors in enumerate(errors):
+                for tgt_lang, error in zip(request_data["tgt_langs"], doc_errors):
+                    if error:
+                        self.send_document_error(
+                            response_sender, doc_id, tgt_lang, error
+                        )
+            return self.finish_response(None, response_sender)
+
+        return self.make_request_response(request_data, results, errors)
+
+    def make_request_response(self, request_data: dict, results: list, errors: list):
+        """Join the translated chunks of each document into the translated document.
+
+        The outputs TRANSLATED_TEXT and ERROR have the shape of the INPUT_TEXT with an
+        extra last axis for the tgt_langs, in the order requested. A document that
+        failed has "" as its TRANSLATED_TEXT and the error message in ERROR. The
+        response parameters `passthrough_documents` (JSON list, per document, of the
+        tgt_langs the whole document was returned verbatim for) and
+        `passthrough_chunk_ids` (JSON list, per document and tgt_lang, of chunk ids)
+        give the documents and sentences that were already in the tgt_lang and
+        returned verbatim.
+        """
+        translated_docs = []
+        passthrough_documents = []
+        passthrough_chunk_ids = []
+        for doc_results, doc_errors in zip(results, errors):
+            passthrough_documents.append([])
+            passthrough_chunk_ids.append([])
+            for tgt_lang, tgt_result, error in zip(
+                request_data["tgt_langs"], doc_results, doc_errors
+            ):
+                if error:
+                    translated_docs.append("")
+                    passthrough_chunk_ids[-1].append([])
+                    continue
+                doc_inputs, passthrough_document = tgt_result
+                translated_chunks = [
+                    doc_inputs[chunk_id]["translated_text"]
+                    for chunk_id in sorted(doc_inputs)
+                ]
+                translated_docs.append(" ".join(translated_chunks))
+                if passthrough_document:
+                    passthrough_documents[-1].append(tgt_lang)
+                passthrough_chunk_ids[-1].append(
+                    [
+                        chunk_id
+                        for chunk_id in sorted(doc_inputs)
+                        if doc_inputs[chunk_id].get("passthrough", False)
+                    ]
                 )
-                self.responses[batch_id] = inference_response
+        output_shape = tuple(request_data["shape"]) + (len(request_data["tgt_langs"]),)
+        translated_docs_tt = pb_utils.Tensor(
+            "TRANSLATED_TEXT",
+            np.array(translated_docs, dtype=self.translated_text_dtype).reshape(
+                output_shape
+            ),
+        )
+        errors_tt = pb_utils.Tensor(
+            "ERROR",
+            np.array(
+                [e for doc_errors in errors for e in doc_errors], dtype=self.error_dtype
+            ).reshape(output_shape),
+        )
+        return pb_utils.InferenceResponse(
+            output_tensors=[translated_docs_tt, errors_tt],
+            parameters={
+                "passthrough_documents": json.dumps(passthrough_documents),
+                "passthrough_chunk_ids": json.dumps(passthrough_chunk_ids),
+            },
+        )
+
+    def send_document_error(
+        self, response_sender, doc_id: int, tgt_lang: str, error: str
+    ) -> None:
+        """In decoupled mode, send back the error for a document that failed to be
+        translated into tgt_lang"""
+        doc_id_tt = pb_utils.Tensor(
+            "DOCUMENT_ID", np.array([doc_id], dtype=self.chunk_id_dtype).reshape(-1, 1)
+        )
+        tgt_lang_tt = pb_utils.Tensor(
+            "TGT_LANG", np.array([tgt_lang], dtype=np.object_).reshape(-1, 1)
+        )
+        error_tt = pb_utils.Tensor(
+            "ERROR", np.array([error], dtype=self.error_dtype).reshape(-1, 1)
+        )
+        response_sender.send(
+            pb_utils.InferenceResponse(
+                output_tensors=[doc_id_tt, tgt_lang_tt, error_tt]
+            )
+        )
+        return None
+
+    def finish_response(self, response, response_sender=None):
+        """Return the response, or in decoupled mode send it with the final flag"""
+        if response_sender is None:
+            return response
+        if response is None:
+            response_sender.send(flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL)
+        else:
+            response_sender.send(
+                response, flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL
+            )
+        return None
+
+    async def respond(self, request, batch_state: dict) -> None:
+        """Translate a request and send back its response as soon as it is done,
+        instead of waiting for the rest of the dynamic batch.
+
+        Parameters
+        ----------
+        request : pb_utils.InferenceRequest
+            Request submitted by a client
+        batch_state : dict
+            State shared by all the requests in the dynamic batch
+        """
+        response_sender = request.get_response_sender()
+        try:
+            response = await self.translate_request(
+                request, batch_state, response_sender if self.decoupled else None
+            )
+        except Exception as exc:
+            response = self.error_response(f"{exc}")
+        else:
+            if self.decoupled:
+                # translate_request already sent the final flag
+                return None
+        self.finish_response(response, response_sender)
+        return None
+
+    async def execute(self, requests: List) -> None:
+        """
+        Each request contains one or more documents that a client has submitted for
+        translation. Each document is run through its own pipeline (language id,
+        sentence segmentation, sentence-level language id, translation) concurrently
+        with the other documents in the request and the dynamic batch.
+
+        Parameters
+        ----------
+        requests : List[pb_utils.InferenceRequest]
+            List of request submitted by clients.
 
-        return self.responses
+        Returns
+        -------
+        None
+            Each request's response is sent through its response sender, flagged as
+            final, as soon as that request is done so that a short request isn't held
+            back by a long one in the same dynamic batch. In decoupled mode, the
+            translated chunks are streamed before the final flag.
+        """
+        batch_size = len(requests)
+        self.logger.log_info(
+            f"`translate` received {batch_size} requests in dynamic batch"
+        )
+        batch_state = {"inflight": {}, "n_deduplicated": 0}
+        await asyncio.gather(
+            *[self.respond(request, batch_state) for request in requests]
+        )
+        n_deduplicated = batch_state["n_deduplicated"]
+        if n_deduplicated > 0:
+            self.deduplicated_metric.increment(n_deduplicated)
+        self.logger.log_info(
+            f"`translate` saved {n_deduplicated} sentence translations by "
+            + "deduplicating the dynamic batch"
+        )
+        return None
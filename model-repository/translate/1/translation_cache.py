@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import re
+import unicodedata
+
+
+class TranslationCache:
+    """Bounded, in-memory LRU cache of translated sentences.
+
+    Entries are keyed on (translation_model, decoding_profile, src_lang, tgt_lang,
+    sentence) where the sentence has been normalized (NFC + collapsed whitespace) so
+    that trivially different copies of the same boilerplate share an entry. The cache is bounded by
+    both the number of entries and the total number of UTF-8 bytes of the sentences
+    and translations stored. The least recently used entries are evicted first.
+
+    Parameters
+    ----------
+    max_entries : int
+        Maximum number of sentences to keep. A value <= 0 disables the cache.
+    max_bytes : int
+        Maximum number of bytes (sentence + translation) to keep. A value <= 0 means
+        there is no limit on the number of bytes.
+    """
+
+    WHITESPACE = re.compile(r"\s+")
+
+    def __init__(self, max_entries: int, max_bytes: int = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @classmethod
+    def normalize(cls, sentence: str) -> str:
+        return cls.WHITESPACE.sub(" ", unicodedata.normalize("NFC", sentence)).strip()
+
+    def make_key(
+        self,
+        translation_model: str,
+        decoding_profile: str,
+        src_lang: str,
+        tgt_lang: str,
+        sentence: str,
+    ) -> tuple:
+        return (
+            translation_model,
+            decoding_profile,
+            src_lang,
+            tgt_lang,
+            self.normalize(sentence),
+        )
+
+    def get(self, key: tuple):
+        """Return the cached translation for `key`, or None if it is not cached"""
+        translated_text = self._entries.get(key, None)
+        if translated_text is not None:
+            self._entries.move_to_end(key)
+        return translated_text
+
+    def put(self, key: tuple, translated_text: str) -> list:
+        """Store a translation and return the list of keys evicted to make room"""
+        if not self.enabled:
+            return []
+        if key in self._entries:
+            self.n_bytes -= self._size(key, self._entries.pop(key))
+        size = self._size(key, translated_text)
+        if self.max_bytes > 0 and size > self.max_bytes:
+            # Would evict everything and still not fit
+            return []
+        self._entries[key] = translated_text
+        self.n_bytes += size
+
+        evicted = []
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes > 0 and self.n_bytes > self.max_bytes
+        ):
+            evicted_key, evicted_text = self._entries.popitem(last=False)
+            self.n_bytes -= self._size(evicted_key, evicted_text)
+            evicted.append(evicted_key)
+        return evicted
+
+    @staticmethod
+    def _size(key: tuple, translated_text: str) -> int:
+        return len(key[-1].encode("utf-8")) + len(translated_text.encode("utf-8"))
@@ -0,0 +1,7 @@
+"""Code shared by the seamlessm4t_text2text and nllb_200_distilled_600M deployments,
+and their _stream variants.
+
+This is not a model. Each translation model's version directory has a
+`translation_common` symlink to this directory so that the Python backend can import
+it as a package, e.g., `from translation_common.compilation import compile_model`.
+"""
@@ -0,0 +1,64 @@
+import os
+from typing import List
+
+import torch
+import torch._inductor.config
+
+
+def enable_compile_cache(cache_dir: str) -> None:
+    """Persist torch.compile's artifacts to `cache_dir` so that a restart reuses the
+    compiled graphs and kernels instead of compiling them again. Must be called before
+    the first compiled forward pass."""
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = cache_dir
+    # Kernels generated for the GPU are compiled by Triton, which has its own cache
+    os.environ["TRITON_CACHE_DIR"] = os.path.join(cache_dir, "triton")
+    torch._inductor.config.fx_graph_cache = True
+
+
+def compile_model(model) -> None:
+    """Compile the encoder and the decoder, which generate() calls once per
+    decoding step, in place. Shapes are marked dynamic so that the batch size and the
+    growing KV cache don't each trigger a recompilation."""
+    model.get_encoder().compile(dynamic=True)
+    model.get_decoder().compile(dynamic=True)
+
+
+def parse_length_buckets(length_buckets: str) -> List[int]:
+    """Parse a comma separated list of token lengths, e.g., "16,32,64", into a
+    sorted list"""
+    return sorted(int(b) for b in length_buckets.split(",") if b.strip())
+
+
+def bucket_length(length: int, length_buckets: List[int]) -> int:
+    """Smallest bucket that fits `length` tokens. Longer inputs are rounded up to a
+    multiple of the largest bucket."""
+    for bucket in length_buckets:
+        if length <= bucket:
+            return bucket
+    largest = length_buckets[-1]
+    return -(-length // largest) * largest
+
+
+def pad_encoding(
+    encoding, length: int, pad_token_id: int, padding_side: str = "right"
+) -> dict:
+    """Pad the tokenized batch with padding columns up to `length` tokens. The
+    attention_mask is padded with 0 and the input_ids with `pad_token_id`."""
+    n_columns = encoding["input_ids"].shape[1]
+    if n_columns >= length:
+        return encoding
+    padded = {}
+    for key, value in encoding.items():
+        pad_value = pad_token_id if key == "input_ids" else 0
+        padding = torch.full(
+            (value.shape[0], length - n_columns),
+            pad_value,
+            dtype=value.dtype,
+            device=value.device,
+        )
+        if padding_side == "left":
+            padded[key] = torch.cat([padding, value], dim=1)
+        else:
+            padded[key] = torch.cat([value, padding], dim=1)
+    return padded
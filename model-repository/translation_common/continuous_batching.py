@@ -0,0 +1,550 @@
+from collections import deque
+import queue
+import threading
+from typing import Callable, List, Optional
+
+import torch
+from transformers.generation.logits_process import NoRepeatNGramLogitsProcessor
+from transformers.modeling_outputs import BaseModelOutput
+
+from translation_common.generation_limits import repeating_rows
+
+
+class GenerationJob:
+    """The rows of a single request to be translated by the engine.
+
+    Parameters
+    ----------
+    input_ids : List[torch.Tensor]
+        Token ids, without padding, of each row to be encoded
+    decoder_prefixes : List[List[int]]
+        Decoder tokens that each row starts with, e.g., [decoder_start, tgt_lang].
+        Every row must have a prefix of the same length.
+    on_complete : Callable[[List[torch.Tensor]], None]
+        Called with the generated token ids, prefix removed, of every row once the
+        last row of the job has finished
+    on_error : Callable[[Exception], None]
+        Called if the job failed before completing. Called at most once.
+    on_step : Callable[[Dict[int, torch.Tensor]], None], optional
+        If given, called after every decoding step with the tokens generated so far,
+        prefix removed, of each of the job's rows that is still being decoded, keyed
+        by row. Used to stream partial translations.
+    max_new_tokens : List[int], optional
+        Maximum number of tokens to generate for each row. Capped by the engine's
+        `max_new_tokens`, which is used for every row if not given.
+    """
+
+    def __init__(
+        self,
+        input_ids: List[torch.Tensor],
+        decoder_prefixes: List[List[int]],
+        on_complete: Callable,
+        on_error: Callable,
+        on_step: Optional[Callable] = None,
+        max_new_tokens: Optional[List[int]] = None,
+    ):
+        self.input_ids = input_ids
+        self.decoder_prefixes = decoder_prefixes
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.on_step = on_step
+        self.n_rows = len(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.output_ids = [None] * self.n_rows
+        self.n_remaining = self.n_rows
+        self.failed = False
+
+    def finish_row(self, row: int, output_ids: torch.Tensor) -> None:
+        self.output_ids[row] = output_ids
+        self.n_remaining -= 1
+        if self.n_remaining == 0 and not self.failed:
+            self.on_complete(self.output_ids)
+
+    def fail(self, exc: Exception) -> None:
+        if not self.failed and self.n_remaining > 0:
+            self.failed = True
+            self.on_error(exc)
+
+
+def pad_to(
+    tensor: torch.Tensor, length: int, dim: int, left: bool, value: int = 0
+) -> torch.Tensor:
+    """Pad the tensor with `value` up to `length` along `dim`, on the left or right"""
+    n_padding = length - tensor.shape[dim]
+    if n_padding <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = n_padding
+    padding = tensor.new_full(shape, value)
+    return torch.cat([padding, tensor] if left else [tensor, padding], dim=dim)
+
+
+class Cohort:
+    """Rows that are decoded together. They share the encoder outputs and decoder KV
+    cache and so are decoded in lock step. A new cohort runs its first step, the
+    decoder prefixes, on its own and is then merged into the running cohort. Rows
+    that started at an earlier step have more decoder tokens, so the decoder tokens
+    and self attention cache are left padded up to the longest row and masked out.
+    Finished rows are dropped from the tensors after every decoding step."""
+
+    def __init__(self, jobs: List[GenerationJob], engine: "ContinuousBatchingEngine"):
+        self.engine = engine
+        self.jobs = jobs
+        # (job, row) of each active row of the batch
+        self.rows = [(job, row) for job in jobs for row in range(job.n_rows)]
+        input_ids = [job.input_ids[row] for job, row in self.rows]
+        decoder_prefixes = [job.decoder_prefixes[row] for job, row in self.rows]
+
+        input_ids = torch.nn.utils.rnn.pad_sequence(
+            input_ids, batch_first=True, padding_value=engine.pad_token_id
+        )
+        lengths = torch.tensor([len(job.input_ids[row]) for job, row in self.rows])
+        self.attention_mask = (
+            (torch.arange(input_ids.shape[1])[None, :] < lengths[:, None])
+            .long()
+            .to(engine.device)
+        )
+        input_ids = input_ids.to(engine.device)
+        self.encoder_hidden_states = engine.model.get_encoder()(
+            input_ids=input_ids, attention_mask=self.attention_mask, return_dict=True
+        ).last_hidden_state
+        self.decoder_input_ids = torch.tensor(
+            decoder_prefixes, dtype=torch.long, device=engine.device
+        )
+        self.generated_ids = self.decoder_input_ids
+        # 0 for the left padding of rows that joined at a later step
+        self.decoder_attention_mask = torch.ones_like(self.generated_ids)
+        self.past_key_values = None
+        # Number of tokens generated by each row and its limit
+        self.n_new_tokens = [0] * len(self.rows)
+        self.max_new_tokens = [
+            engine.max_new_tokens
+            if job.max_new_tokens is None
+            else min(job.max_new_tokens[row], engine.max_new_tokens)
+            for job, row in self.rows
+        ]
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.rows)
+
+    def step(self) -> None:
+        """Generate the next token of every active row, hand finished rows back to
+        their job, and drop them from the batch"""
+        engine = self.engine
+        # Read by the decoder's positional embedding hook
+        engine.decoder_attention_mask = self.decoder_attention_mask
+        try:
+            outputs = engine.model(
+                attention_mask=self.attention_mask,
+                encoder_outputs=BaseModelOutput(
+                    last_hidden_state=self.encoder_hidden_states
+                ),
+                decoder_input_ids=self.decoder_input_ids,
+                decoder_attention_mask=self.decoder_attention_mask,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+        finally:
+            engine.decoder_attention_mask = None
+        scores = outputs.logits[:, -1, :]
+        if engine.no_repeat_ngram is not None:
+            # The left padding comes before the decoder prefix, so it never matches
+            # the n-gram ending at a row's last token
+            scores = engine.no_repeat_ngram(self.generated_ids, scores)
+        next_tokens = scores.argmax(dim=-1)
+        self.generated_ids = torch.cat(
+            [self.generated_ids, next_tokens[:, None]], dim=-1
+        )
+        self.decoder_attention_mask = torch.cat(
+            [
+                self.decoder_attention_mask,
+                torch.ones_like(self.decoder_attention_mask[:, :1]),
+            ],
+            dim=-1,
+        )
+        self.past_key_values = outputs.past_key_values
+        self.n_new_tokens = [n_new_tokens + 1 for n_new_tokens in self.n_new_tokens]
+
+        is_eos = torch.isin(next_tokens, engine.eos_token_ids).tolist()
+        length_limited = [
+            not is_eos[i] and n_new_tokens >= max_new_tokens
+            for i, (n_new_tokens, max_new_tokens) in enumerate(
+                zip(self.n_new_tokens, self.max_new_tokens)
+            )
+        ]
+        repetition_limited = [False] * self.n_rows
+        window = engine.repetition_window
+        if window > 0 and max(self.n_new_tokens) >= window:
+            # Only rows with a full window of generated tokens, no prefix or padding
+            repeating = repeating_rows(
+                self.generated_ids[:, -window:], engine.min_unique_tokens
+            ).tolist()
+            repetition_limited = [
+                repeating[i]
+                and not is_eos[i]
+                and not length_limited[i]
+                and self.n_new_tokens[i] >= window
+                for i in range(self.n_rows)
+            ]
+        if engine.on_limited is not None and (
+            any(length_limited) or any(repetition_limited)
+        ):
+            engine.on_limited(sum(length_limited), sum(repetition_limited))
+        finished = [
+            is_eos[i] or length_limited[i] or repetition_limited[i]
+            for i in range(self.n_rows)
+        ]
+        for i, is_finished in enumerate(finished):
+            if is_finished:
+                job, row = self.rows[i]
+                job.finish_row(row, self.new_tokens(i))
+        self.stream(finished)
+
+        keep = [i for i, is_finished in enumerate(finished) if not is_finished]
+        if len(keep) < len(finished):
+            self.select(keep)
+        self.decoder_input_ids = self.generated_ids[:, -1:]
+
+    def new_tokens(self, i: int) -> torch.Tensor:
+        """Tokens generated so far by row i, without its decoder prefix"""
+        return self.generated_ids[i, -self.n_new_tokens[i] :].cpu()
+
+    def stream(self, finished: List[bool]) -> None:
+        """Hand the tokens generated so far by unfinished rows to the jobs that
+        stream them. Finished rows are sent with the job's on_complete instead."""
+        step_ids = {}
+        for i, (job, row) in enumerate(self.rows):
+            if job.on_step is None or finished[i] or job.failed:
+                continue
+            step_ids.setdefault(job, {})[row] = self.new_tokens(i)
+        for job, row_ids in step_ids.items():
+            job.on_step(row_ids)
+
+    def select(self, keep: List[int]) -> None:
+        """Keep only the given rows of the batch, and drop the columns that are
+        padding for all of them"""
+        self.rows = [self.rows[i] for i in keep]
+        self.n_new_tokens = [self.n_new_tokens[i] for i in keep]
+        self.max_new_tokens = [self.max_new_tokens[i] for i in keep]
+        if not keep:
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.engine.device)
+        attention_mask = self.attention_mask[index]
+        decoder_attention_mask = self.decoder_attention_mask[index]
+        # Encoder outputs are right padded and decoder tokens left padded
+        encoder_length = int(attention_mask.sum(dim=1).max())
+        n_left_padding = decoder_attention_mask.shape[1] - int(
+            decoder_attention_mask.sum(dim=1).max()
+        )
+        self.attention_mask = attention_mask[:, :encoder_length]
+        self.encoder_hidden_states = self.encoder_hidden_states[index][
+            :, :encoder_length
+        ]
+        self.generated_ids = self.generated_ids[index][:, n_left_padding:]
+        self.decoder_attention_mask = decoder_attention_mask[:, n_left_padding:]
+        # Each layer caches the self attention keys and values of the decoder tokens
+        # followed by the cross attention keys and values of the encoder outputs
+        self.past_key_values = tuple(
+            (
+                self_key[index][:, :, n_left_padding:],
+                self_value[index][:, :, n_left_padding:],
+                cross_key[index][:, :, :encoder_length],
+                cross_value[index][:, :, :encoder_length],
+            )
+            for self_key, self_value, cross_key, cross_value in self.past_key_values
+        )
+
+    def merge(self, other: "Cohort") -> None:
+        """Add the rows of another cohort that has taken at least one step. The
+        decoder tokens and self attention cache of the cohort with fewer tokens are
+        left padded, and the shorter encoder outputs and cross attention cache are
+        right padded."""
+        cohorts = [self, other]
+        n_columns = max(cohort.generated_ids.shape[1] for cohort in cohorts)
+        encoder_length = max(cohort.attention_mask.shape[1] for cohort in cohorts)
+
+        def concat(tensors, length, dim, left, value=0):
+            return torch.cat(
+                [pad_to(tensor, length, dim, left, value) for tensor in tensors]
+            )
+
+        # Build everything before changing this cohort, so that it is left as is if
+        # anything throws
+        attention_mask = concat(
+            [cohort.attention_mask for cohort in cohorts], encoder_length, 1, False
+        )
+        encoder_hidden_states = concat(
+            [cohort.encoder_hidden_states for cohort in cohorts],
+            encoder_length,
+            1,
+            False,
+        )
+        generated_ids = concat(
+            [cohort.generated_ids for cohort in cohorts],
+            n_columns,
+            1,
+            True,
+            self.engine.pad_token_id,
+        )
+        decoder_attention_mask = concat(
+            [cohort.decoder_attention_mask for cohort in cohorts], n_columns, 1, True
+        )
+        # The cache holds every decoder token except the last one generated
+        past_key_values = tuple(
+            (
+                concat([self_layer[0], other_layer[0]], n_columns - 1, 2, True),
+                concat([self_layer[1], other_layer[1]], n_columns - 1, 2, True),
+                concat([self_layer[2], other_layer[2]], encoder_length, 2, False),
+                concat([self_layer[3], other_layer[3]], encoder_length, 2, False),
+            )
+            for self_layer, other_layer in zip(
+                self.past_key_values, other.past_key_values
+            )
+        )
+
+        self.jobs = self.jobs + other.jobs
+        self.rows = self.rows + other.rows
+        self.n_new_tokens = self.n_new_tokens + other.n_new_tokens
+        self.max_new_tokens = self.max_new_tokens + other.max_new_tokens
+        self.attention_mask = attention_mask
+        self.encoder_hidden_states = encoder_hidden_states
+        self.generated_ids = generated_ids
+        self.decoder_attention_mask = decoder_attention_mask
+        self.past_key_values = past_key_values
+        self.decoder_input_ids = self.generated_ids[:, -1:]
+
+    def fail(self, exc: Exception) -> None:
+        for job in self.jobs:
+            job.fail(exc)
+
+
+class ContinuousBatchingEngine:
+    """Iteration-level (continuous) batching of greedy decoding for encoder-decoder
+    translation models.
+
+    Instead of running `model.generate()` to completion on a fixed batch, a
+    background thread owns the encoder outputs and decoder KV caches of every row in
+    flight and runs one decoding step at a time. Rows that generate the eos token
+    are returned immediately and dropped from the batch. Jobs submitted while the
+    engine is running are admitted at the next step boundary as a new cohort, which
+    decodes its prefixes on its own and then joins the running cohort, so all rows
+    in flight share a single forward pass per step.
+
+    Like `GenerationLimits` does for `generate()`, a row also finishes once it
+    reaches its own output length limit or its last `repetition_window` tokens have
+    fewer than `min_unique_token_ratio * repetition_window` distinct tokens.
+
+    Rows that joined later have fewer decoder tokens than the rows they join and are
+    left padded. The decoder of these models numbers the positions of the new tokens
+    from the length of the KV cache, padding included, so a forward hook on its
+    sinusoidal positional embedding numbers each row's positions from its own tokens.
+
+    Parameters
+    ----------
+    model : transformers.PreTrainedModel
+        Encoder-decoder model with `get_encoder()` and a forward that accepts
+        `encoder_outputs`, `decoder_attention_mask`, and `past_key_values`. Its
+        decoder's `embed_positions` is a sinusoidal positional embedding, like
+        M2M100's, with `weights` and `padding_idx`.
+    pad_token_id : int
+        Used to pad the input_ids of a cohort
+    eos_token_ids : List[int]
+        Generating any of these finishes a row
+    max_new_tokens : int
+        Maximum number of tokens generated for a row. Jobs may set lower limits for
+        their rows.
+    no_repeat_ngram_size : int
+        If > 0, n-grams of this size can only occur once in the generated tokens
+    max_active_rows : int
+        Maximum number of rows in flight. A job is never split, so a job larger than
+        this runs on its own.
+    device : torch.device
+    logger : pb_utils.Logger
+    repetition_window : int
+        Number of most recently generated tokens checked for looping. 0 disables it.
+    min_unique_token_ratio : float
+        Fraction of the window that must be distinct tokens
+    on_limited : Callable[[int, int], None], optional
+        Called with the number of rows ended at their length limit and for repeating
+        whenever a decoding step ends any
+    over_memory_ceiling : Callable[[int, int], bool], optional
+        Given the longest input, in tokens, and the number of rows in flight, whether
+        their estimated memory is over the ceiling. Jobs are only admitted while it
+        isn't, unless nothing else is in flight.
+    """
+
+    def __init__(
+        self,
+        model,
+        pad_token_id: int,
+        eos_token_ids: List[int],
+        max_new_tokens: int,
+        no_repeat_ngram_size: int,
+        max_active_rows: int,
+        device,
+        logger,
+        repetition_window: int = 0,
+        min_unique_token_ratio: float = 0.0,
+        on_limited: Optional[Callable] = None,
+        over_memory_ceiling: Optional[Callable] = None,
+    ):
+        self.model = model
+        self.pad_token_id = pad_token_id
+        self.eos_token_ids = torch.tensor(
+            eos_token_ids, dtype=torch.long, device=device
+        )
+        self.max_new_tokens = max_new_tokens
+        self.no_repeat_ngram = (
+            NoRepeatNGramLogitsProcessor(no_repeat_ngram_size)
+            if no_repeat_ngram_size > 0
+            else None
+        )
+        self.max_active_rows = max_active_rows
+        self.device = device
+        self.logger = logger
+        self.repetition_window = repetition_window
+        self.min_unique_tokens = min_unique_token_ratio * repetition_window
+        self.on_limited = on_limited
+        self.over_memory_ceiling = over_memory_ceiling
+        # Decoder attention mask of the cohort being stepped
+        self.decoder_attention_mask = None
+        model.get_decoder().embed_positions.register_forward_hook(
+            self.row_positions
+        )
+
+        self.submitted = queue.Queue()
+        self.pending = deque()
+        self.cohorts = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop the engine after the current step. Jobs still in flight fail."""
+        self.submitted.put(None)
+        self.thread.join()
+
+    def submit(self, job: GenerationJob) -> None:
+        self.submitted.put(job)
+
+    @property
+    def n_active_rows(self) -> int:
+        return sum(cohort.n_rows for cohort in self.cohorts)
+
+    def row_positions(self, module, args, positions: torch.Tensor):
+        """Forward hook of the decoder's positional embedding. When the cohort has
+        left padding, replace the positional embeddings, which are numbered from the
+        length of the KV cache, with ones numbered from each row's own tokens."""
+        mask = self.decoder_attention_mask
+        if mask is None or bool(mask.all()):
+            return None
+        n_tokens = positions.shape[1]
+        # Same numbering as the embedding uses for the input_ids, starting after the
+        # padding_idx, but counting only the row's own tokens
+        position_ids = (mask.cumsum(dim=1) * mask)[:, -n_tokens:] + module.padding_idx
+        return (
+            module.weights.index_select(0, position_ids.reshape(-1))
+            .view(positions.shape)
+            .to(positions.dtype)
+        )
+
+    def run(self) -> None:
+        # Grad mode is thread local
+        with torch.inference_mode():
+            while self.collect(block=not (self.cohorts or self.pending)):
+                self.admit()
+                self.step()
+                self.merge()
+        exc = RuntimeError("Translation engine was stopped")
+        for cohort in self.cohorts:
+            cohort.fail(exc)
+        for job in self.pending:
+            job.fail(exc)
+
+    def collect(self, block: bool) -> bool:
+        """Move newly submitted jobs to pending. Waits for one if `block`. Returns
+        False once the engine has been stopped."""
+        while True:
+            try:
+                job = self.submitted.get(block=block)
+            except queue.Empty:
+                return True
+            if job is None:
+                return False
+            self.pending.append(job)
+            block = False
+
+    def admit(self) -> None:
+        """Start a new cohort with as many pending jobs as fit within
+        `max_active_rows` and the memory ceiling"""
+        if not self.pending:
+            return
+        n_active_rows = self.n_active_rows
+        # Cohorts are trimmed to their longest input and merged cohorts padded to it
+        length = max([cohort.attention_mask.shape[1] for cohort in self.cohorts] + [0])
+        jobs = []
+        n_rows = 0
+        while self.pending:
+            job = self.pending[0]
+            n_total_rows = n_active_rows + n_rows + job.n_rows
+            job_length = max(length, max(len(ids) for ids in job.input_ids))
+            over_budget = n_total_rows > self.max_active_rows or (
+                self.over_memory_ceiling is not None
+                and self.over_memory_ceiling(job_length, n_total_rows)
+            )
+            if over_budget and n_active_rows + n_rows > 0:
+                break
+            if over_budget:
+                self.logger.log_warn(
+                    f"Request of {job.n_rows} rows of up to {job_length} tokens is "
+                    + "over the budget on its own. Running it anyway"
+                )
+            jobs.append(self.pending.popleft())
+            n_rows += job.n_rows
+            length = job_length
+        if not jobs:
+            return
+        try:
+            self.cohorts.append(Cohort(jobs, self))
+        except Exception as exc:
+            self.logger.log_error(f"Starting a cohort of {n_rows} rows threw {exc}")
+            for job in jobs:
+                job.fail(exc)
+            return
+        self.logger.log_info(
+            f"Admitted {n_rows} rows from {len(jobs)} requests. "
+            + f"{n_active_rows + n_rows} rows active"
+        )
+
+    def step(self) -> None:
+        """Run one decoding step of every cohort"""
+        for cohort in list(self.cohorts):
+            try:
+                cohort.step()
+            except Exception as exc:
+                self.logger.log_error(
+                    f"Decoding a cohort of {cohort.n_rows} rows threw {exc}"
+                )
+                cohort.fail(exc)
+                self.cohorts.remove(cohort)
+                continue
+            if cohort.n_rows == 0:
+                self.cohorts.remove(cohort)
+
+    def merge(self) -> None:
+        """Merge the cohorts that took their first step into the running cohort. If
+        merging throws, e.g., runs out of memory, they are decoded separately and
+        merging is tried again after the next step."""
+        while len(self.cohorts) > 1:
+            cohort = self.cohorts[-1]
+            try:
+                self.cohorts[0].merge(cohort)
+            except Exception as exc:
+                self.logger.log_warn(
+                    f"Merging a cohort of {cohort.n_rows} rows threw {exc}"
+                )
+                return
+            self.cohorts.pop()
@@ -0,0 +1,100 @@
+from typing import List
+
+import torch
+from transformers.generation.logits_process import LogitsProcessor
+
+
+def repeating_rows(
+    window: torch.LongTensor, min_unique_tokens: float
+) -> torch.BoolTensor:
+    """Rows of the window, the most recently generated tokens of each row, that have
+    fewer than `min_unique_tokens` distinct tokens"""
+    window = window.sort(dim=1).values
+    n_unique = 1 + (window[:, 1:] != window[:, :-1]).sum(dim=1)
+    return n_unique < min_unique_tokens
+
+
+class GenerationLimits(LogitsProcessor):
+    """End rows early by forcing the eos token once they reach their own output
+    length limit or start looping.
+
+    `generate()` only stops once every row of the batch is finished, so a single row
+    that keeps generating holds up the whole batch until `max_new_tokens`. Stopping
+    criteria can't end individual hypotheses during beam search, so the eos token is
+    forced instead, which ends the row for greedy decoding and finalizes the
+    hypothesis for beam search.
+
+    A row is looping if the last `repetition_window` generated tokens contain fewer
+    than `min_unique_token_ratio * repetition_window` distinct tokens. Exact repeats
+    of a span are already blocked by `no_repeat_ngram_size`, so degenerate output
+    shows up as a small set of tokens cycling with slight variations instead.
+
+    Parameters
+    ----------
+    max_new_tokens : List[int]
+        Maximum number of tokens to generate for each row of the batch (not counting
+        beams)
+    eos_token_id : int
+    num_beams : int
+        Each row of the batch has `num_beams` consecutive rows in `input_ids`
+    repetition_window : int
+        Number of most recently generated tokens checked for looping. 0 disables it.
+    min_unique_token_ratio : float
+        Fraction of the window that must be distinct tokens
+    """
+
+    def __init__(
+        self,
+        max_new_tokens: List[int],
+        eos_token_id: int,
+        num_beams: int,
+        repetition_window: int,
+        min_unique_token_ratio: float,
+    ):
+        self.max_new_tokens = torch.tensor(max_new_tokens, dtype=torch.long)
+        self.eos_token_id = eos_token_id
+        self.num_beams = num_beams
+        self.repetition_window = repetition_window
+        self.min_unique_tokens = min_unique_token_ratio * repetition_window
+        self.prefix_length = None
+        self.finished = None
+        # Rows of the batch that were ended by each limit
+        self.length_limited_rows = set()
+        self.repetition_limited_rows = set()
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        # The first call sees just the decoder's prefix, e.g., [decoder_start]
+        if self.prefix_length is None:
+            self.prefix_length = input_ids.shape[1]
+            self.max_new_tokens = self.max_new_tokens.to(input_ids.device)
+            self.max_new_tokens = self.max_new_tokens.repeat_interleave(self.num_beams)
+            self.finished = torch.zeros_like(self.max_new_tokens, dtype=torch.bool)
+        n_generated = input_ids.shape[1] - self.prefix_length
+        # Greedy decoding keeps padding rows that already generated eos. Beam search
+        # never keeps a hypothesis that ended with eos in input_ids.
+        if n_generated > 0:
+            self.finished |= input_ids[:, -1] == self.eos_token_id
+
+        length_limited = (n_generated >= self.max_new_tokens) & ~self.finished
+        repetition_limited = torch.zeros_like(length_limited)
+        if self.repetition_window > 0 and n_generated >= self.repetition_window:
+            repetition_limited = (
+                repeating_rows(
+                    input_ids[:, -self.repetition_window :], self.min_unique_tokens
+                )
+                & ~self.finished
+            )
+
+        stop = length_limited | repetition_limited
+        if not stop.any():
+            return scores
+        for i in length_limited.nonzero().flatten().tolist():
+            self.length_limited_rows.add(i // self.num_beams)
+        for i in (repetition_limited & ~length_limited).nonzero().flatten().tolist():
+            self.repetition_limited_rows.add(i // self.num_beams)
+        scores = scores.clone()
+        scores[stop] = -float("inf")
+        scores[stop, self.eos_token_id] = 0
+        return scores
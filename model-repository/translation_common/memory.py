@@ -0,0 +1,30 @@
+import os
+import resource
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process right now. 0 if /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return resident_pages * resource.getpagesize()
+
+
+def peak_rss_bytes() -> int:
+    """Largest resident set size this process has had so far. Linux reports
+    ru_maxrss in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_mib(n_bytes: int) -> str:
+    return f"{n_bytes / 2**20:,.0f}MiB"
+
+
+def host_memory_bytes() -> int:
+    """Physical memory of the host. 0 if it can't be determined"""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError):
+        return 0
@@ -0,0 +1,37 @@
+import torch
+
+CPU_PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    # Weights are loaded in float32 and then the nn.Linear layers are dynamically
+    # quantized to int8
+    "int8": torch.float32,
+}
+
+
+def get_cpu_torch_dtype(cpu_precision: str) -> torch.dtype:
+    """The torch_dtype to load the model with for the `cpu_precision` config
+    parameter. One of "fp32", "bf16", or "int8"
+
+    Raises
+    ------
+    ValueError
+        If cpu_precision is not one of the supported values
+    """
+    if cpu_precision not in CPU_PRECISIONS:
+        raise ValueError(
+            f"cpu_precision {cpu_precision} is not supported. Needs to be one of "
+            + f"{list(CPU_PRECISIONS)}"
+        )
+    return CPU_PRECISIONS[cpu_precision]
+
+
+def apply_cpu_precision(model, cpu_precision: str):
+    """Quantize the model's nn.Linear layers to int8 if cpu_precision is "int8".
+    Activations are quantized on the fly at inference time. Otherwise the model is
+    returned as is."""
+    if cpu_precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
@@ -0,0 +1,266 @@
+from functools import partial
+import json
+import numpy as np
+from typing import List
+
+from translation_common.continuous_batching import (
+    ContinuousBatchingEngine,
+    GenerationJob,
+)
+from translation_common.translation_model import TranslationModelBase
+import triton_python_backend_utils as pb_utils
+
+
+class StreamTranslationModel(TranslationModelBase):
+    """Translate with continuous (iteration-level) batching. Must be deployed in
+    decoupled mode. Subclasses implement `load_model` and `tgt_lang_id`."""
+
+    def initialize(self, args):
+        self.model_config = model_config = json.loads(args["model_config"])
+        if not pb_utils.using_decoupled_model_transaction_policy(model_config):
+            raise pb_utils.TritonModelException(
+                f"{model_config['name']} must use the decoupled transaction policy"
+            )
+        # Get TRANSLATED_TEXT configuration
+        translated_text_config = pb_utils.get_output_config_by_name(
+            model_config, "TRANSLATED_TEXT"
+        )
+        # Convert Triton types to numpy types
+        self.translated_text_dtype = pb_utils.triton_string_to_numpy(
+            translated_text_config["data_type"]
+        )
+
+        torch_dtype, precision = self.select_device(args, model_config)
+        self.load_model(args, model_config, torch_dtype, precision)
+        self.model.eval()
+        self.supported_languages = set(self.tokenizer.additional_special_tokens)
+
+        # Decoder starts with [decoder_start_token_id, tgt_lang_id] like generate()
+        generation_config = self.model.generation_config
+        self.decoder_start_token_id = generation_config.decoder_start_token_id
+        eos_token_ids = generation_config.eos_token_id
+        if isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+
+        params = model_config["parameters"]
+        # Greedy decoding only. Rows are also ended early like the non-stream model's
+        self.decoding_profile = {
+            "num_beams": 1,
+            "max_new_tokens": int(params["max_new_tokens"]["string_value"]),
+        }
+        self.load_generation_limits(model_config)
+        self.load_memory_ceiling(model_config)
+        self.engine = ContinuousBatchingEngine(
+            self.model,
+            pad_token_id=self.tokenizer.pad_token_id,
+            eos_token_ids=eos_token_ids,
+            max_new_tokens=self.decoding_profile["max_new_tokens"],
+            no_repeat_ngram_size=3,
+            max_active_rows=int(params["max_active_rows"]["string_value"]),
+            device=self.device,
+            logger=pb_utils.Logger,
+            repetition_window=self.repetition_window,
+            min_unique_token_ratio=self.min_unique_token_ratio,
+            on_limited=self.record_generation_limits,
+            over_memory_ceiling=partial(
+                self.over_memory_ceiling, decoding_profile=self.decoding_profile
+            ),
+        )
+        self.engine.start()
+
+    def execute(self, requests: List) -> None:
+        """
+        Each request is sent by a client and represents appropriately chunked text
+        for translation. A request may contain several chunks along the batch
+        dimension, i.e., INPUT_TEXT, SRC_LANG, and TGT_LANG have shape [n, 1] with one
+        row per chunk.
+
+        Requests are tokenized and handed to the continuous batching engine, which
+        sends a final response per request, TRANSLATED_TEXT with shape [n, 1], once
+        all of its rows have been translated. Requests arriving while others are being
+        decoded join the running batch at the next decoding step.
+
+        If the request parameter `stream` is true, a response is also sent after
+        every decoding step that added text. Its TRANSLATED_TEXT, shape [n, 1], holds
+        the text added to each row since the previous response ("" for rows without
+        new text) and its response parameter `partial` is true. The final response
+        still holds the complete translations.
+
+        Parameters
+        ----------
+        requests : List[pb_utils.InferenceRequest]
+
+        Returns
+        -------
+        None
+            Responses are sent through each request's response sender
+        """
+        logger = pb_utils.Logger
+        batch_size = len(requests)
+        logger.log_info(f"{self.name}.execute received {batch_size} requests")
+        for request in requests:
+            response_sender = request.get_response_sender()
+            try:
+                input_text, src_lang, tgt_lang, stream = self.parse_request(request)
+            except Exception as exc:
+                self.send_error(
+                    response_sender, exc, pb_utils.TritonError.INVALID_ARG
+                )
+                continue
+
+            ## Tokenize
+            try:
+                encoding = self.encode(input_text, src_lang)
+            except Exception as exc:
+                self.send_error(
+                    response_sender,
+                    f"{self.name}.tokenizer threw error tokenizing the request: "
+                    + f"{exc}",
+                )
+                continue
+            # Engine pads the rows of each cohort itself
+            input_ids = [
+                ids[mask.bool()]
+                for ids, mask in zip(encoding["input_ids"], encoding["attention_mask"])
+            ]
+            decoder_prefixes = [
+                [self.decoder_start_token_id, self.tgt_lang_id(tgt)]
+                for tgt in tgt_lang
+            ]
+            on_step = None
+            if stream:
+                on_step = partial(
+                    self.send_partial, response_sender, [""] * len(input_ids)
+                )
+            self.engine.submit(
+                GenerationJob(
+                    input_ids,
+                    decoder_prefixes,
+                    on_complete=partial(self.send_translations, response_sender),
+                    on_error=partial(self.send_error, response_sender),
+                    on_step=on_step,
+                    max_new_tokens=[
+                        self.max_new_tokens_for_length(len(ids), self.decoding_profile)
+                        for ids in input_ids
+                    ],
+                )
+            )
+
+        return None
+
+    def parse_request(self, request) -> tuple:
+        """Get INPUT_TEXT, SRC_LANG, and TGT_LANG as lists of str along with the
+        `stream` request parameter
+
+        Raises
+        ------
+        ValueError
+            If the inputs have different lengths or a language is not supported
+        """
+        # Get the input data as Triton Tensors
+        input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
+        src_lang_tt = pb_utils.get_input_tensor_by_name(request, "SRC_LANG")
+        tgt_lang_tt = pb_utils.get_input_tensor_by_name(request, "TGT_LANG")
+
+        # Convert TritonTensor -> numpy -> python str
+        # NOTE: Triton converts your input string to bytes so you need to decode
+        input_text = [b.decode("utf-8") for b in input_text_tt.as_numpy().reshape(-1)]
+        src_lang = [b.decode("utf-8") for b in src_lang_tt.as_numpy().reshape(-1)]
+        tgt_lang = [b.decode("utf-8") for b in tgt_lang_tt.as_numpy().reshape(-1)]
+
+        if not len(input_text) == len(src_lang) == len(tgt_lang):
+            raise ValueError(
+                f"INPUT_TEXT, SRC_LANG, and TGT_LANG must have the same number "
+                + f"of elements. Got {len(input_text)}, {len(src_lang)}, and "
+                + f"{len(tgt_lang)}"
+            )
+        self.check_langs(src_lang, tgt_lang)
+        stream = json.loads(request.parameters()).get("stream", False)
+        if isinstance(stream, str):
+            stream = stream.lower() in ["true", "1", "yes"]
+        return input_text, src_lang, tgt_lang, bool(stream)
+
+    def send_translations(self, response_sender, output_ids: List) -> None:
+        """Decode the generated tokens of a request and send them as the final
+        response. Called from the engine's thread."""
+        try:
+            translated_texts = self.tokenizer.batch_decode(
+                output_ids, skip_special_tokens=True
+            )
+        except Exception as exc:
+            self.send_error(
+                response_sender,
+                f"{self.name}.tokenizer.batch_decode threw: {exc}",
+            )
+            return None
+        translated_text_tt = pb_utils.Tensor(
+            "TRANSLATED_TEXT",
+            np.array(translated_texts, dtype=self.translated_text_dtype).reshape(
+                -1, 1
+            ),
+        )
+        response_sender.send(
+            pb_utils.InferenceResponse(
+                output_tensors=[translated_text_tt], parameters={"partial": False}
+            ),
+            flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL,
+        )
+        return None
+
+    def send_partial(self, response_sender, sent_texts: List[str], row_ids) -> None:
+        """Send the text each row added since the last response. Called from the
+        engine's thread after every decoding step.
+
+        Parameters
+        ----------
+        response_sender : pb_utils.InferenceResponseSender
+        sent_texts : List[str]
+            Text already sent for each row of the request. Updated in place.
+        row_ids : Dict[int, torch.Tensor]
+            Tokens generated so far for each row still being decoded
+        """
+        new_texts = [""] * len(sent_texts)
+        for row, output_ids in row_ids.items():
+            try:
+                text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            except Exception as exc:
+                pb_utils.Logger.log_warn(
+                    f"{self.name}.tokenizer.decode threw while streaming: {exc}"
+                )
+                continue
+            # Hold back an incomplete multi-byte character, or text that changed
+            # once more tokens were added, until it settles
+            if text.endswith("\ufffd") or not text.startswith(sent_texts[row]):
+                continue
+            new_texts[row] = text[len(sent_texts[row]) :]
+            sent_texts[row] = text
+        if not any(new_texts):
+            return None
+        translated_text_tt = pb_utils.Tensor(
+            "TRANSLATED_TEXT",
+            np.array(new_texts, dtype=self.translated_text_dtype).reshape(-1, 1),
+        )
+        response_sender.send(
+            pb_utils.InferenceResponse(
+                output_tensors=[translated_text_tt], parameters={"partial": True}
+            )
+        )
+        return None
+
+    def send_error(self, response_sender, error_msg, code=None) -> None:
+        if code is None:
+            error = pb_utils.TritonError(f"{error_msg}")
+        else:
+            error = pb_utils.TritonError(f"{error_msg}", code)
+        response_sender.send(
+            pb_utils.InferenceResponse(error=error),
+            flags=pb_utils.TRITONSERVER_RESPONSE_COMPLETE_FINAL,
+        )
+        return None
+
+    def tgt_lang_id(self, tgt_lang: str) -> int:
+        """Token id the decoder starts the translation into `tgt_lang` with"""
+        raise NotImplementedError
+
+    def finalize(self):
+        self.engine.stop()
@@ -0,0 +1,100 @@
+from typing import Callable, List
+
+
+def make_sub_batches(
+    lengths: List[int],
+    n_targets: List[int],
+    decoding_profiles: List[str],
+    max_padding_waste: float,
+    over_budget: Callable[[int, int, int, str], bool],
+) -> List[List[int]]:
+    """Group the rows of a batch into sub-batches of a single decoding profile and
+    similar token length.
+
+    Rows are sorted by their decoding profile and then number of tokens and added to
+    the current sub-batch until the next (longer) row has a different decoding
+    profile, would make the fraction of padding tokens in the sub-batch exceed
+    `max_padding_waste`, or push the sub-batch over budget. A row that is over budget
+    on its own is sent by itself.
+
+    Parameters
+    ----------
+    lengths : List[int]
+        Number of tokens, excluding padding, of each row in the batch
+    n_targets : List[int]
+        Number of tgt_langs each row is decoded into
+    decoding_profiles : List[str]
+        Name of the decoding profile of each row
+    max_padding_waste : float
+        Largest fraction of a sub-batch's input tokens that may be padding
+    over_budget : Callable[[int, int, int, str], bool]
+        Given the length of the longest row, the number of input tokens including
+        padding, the number of output rows, and the decoding profile of a sub-batch,
+        whether it is over budget
+
+    Returns
+    -------
+    List[List[int]]
+        Row indices of each sub-batch, shortest sub-batch of each decoding profile
+        first
+    """
+    sub_batches = []
+    sub_batch = []
+    n_tokens = 0
+    n_decoded = 0
+    order = sorted(
+        range(len(lengths)), key=lambda i: (decoding_profiles[i], lengths[i])
+    )
+    for i in order:
+        # Rows are sorted, so row i would be the longest in the sub-batch
+        n_padded = (len(sub_batch) + 1) * lengths[i]
+        waste = 1.0 - (n_tokens + lengths[i]) / n_padded
+        if sub_batch and (
+            decoding_profiles[i] != decoding_profiles[sub_batch[0]]
+            or waste > max_padding_waste
+            or over_budget(
+                lengths[i], n_padded, n_decoded + n_targets[i], decoding_profiles[i]
+            )
+        ):
+            sub_batches.append(sub_batch)
+            sub_batch = []
+            n_tokens = 0
+            n_decoded = 0
+        sub_batch.append(i)
+        n_tokens += lengths[i]
+        n_decoded += n_targets[i]
+    if sub_batch:
+        sub_batches.append(sub_batch)
+    return sub_batches
+
+
+def retry_in_halves(
+    sub_batches: List[List[int]],
+    run: Callable[[List[int]], None],
+    on_failure: Callable[[List[int], Exception, bool], None],
+) -> None:
+    """Run each sub-batch in order. A sub-batch that throws, e.g., runs out of
+    memory, is split in half and each half is retried, down to single rows, so that
+    only the rows that actually fail are given up on.
+
+    Parameters
+    ----------
+    sub_batches : List[List[int]]
+        Row indices of each sub-batch
+    run : Callable[[List[int]], None]
+        Runs a sub-batch
+    on_failure : Callable[[List[int], Exception, bool], None]
+        Called with the sub-batch, the exception it threw, and whether its halves
+        will be retried. If not, the sub-batch is a single row that failed.
+    """
+    pending = sub_batches[::-1]
+    while pending:
+        sub_batch = pending.pop()
+        try:
+            run(sub_batch)
+        except Exception as exc:
+            retrying = len(sub_batch) > 1
+            on_failure(sub_batch, exc, retrying)
+            if retrying:
+                half = len(sub_batch) // 2
+                pending += [sub_batch[half:], sub_batch[:half]]
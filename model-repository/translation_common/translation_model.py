@@ -0,0 +1,1000 @@
+import itertools
+import json
+import math
+import numpy as np
+import os
+import time
+import torch
+from transformers.generation.logits_process import LogitsProcessorList
+from transformers.modeling_outputs import BaseModelOutput
+from typing import List
+
+from translation_common.compilation import (
+    bucket_length,
+    compile_model,
+    enable_compile_cache,
+    pad_encoding,
+    parse_length_buckets,
+)
+from translation_common.generation_limits import GenerationLimits
+from translation_common.memory import (
+    current_rss_bytes,
+    format_mib,
+    host_memory_bytes,
+    peak_rss_bytes,
+)
+from translation_common.precision import get_cpu_torch_dtype
+from translation_common.sub_batches import make_sub_batches, retry_in_halves
+import triton_python_backend_utils as pb_utils
+
+
+class TranslationModelBase:
+    """Device selection, output limits, memory ceiling, and language checks shared
+    by the translation models and their _stream variants. Subclasses set the class
+    attributes and implement `load_model`, which sets `self.model` and
+    `self.tokenizer`."""
+
+    # Prefix of the log messages and metric names, e.g., "nllb_200_distilled_600M"
+    name = None
+    # Name of the model in error messages
+    display_name = None
+    # Format of a language token given its code, e.g., "__{}__" for "__eng__"
+    lang_token_format = "{}"
+    # Added before the supported languages in error messages
+    language_hint = ""
+
+    def select_device(self, args, model_config) -> tuple:
+        """Use the GPU if available, otherwise use the CPU. Sets `self.device`
+
+        Returns
+        -------
+        tuple[torch.dtype, str]
+            dtype to load the model with and the name of its precision
+        """
+        if args["model_instance_kind"] == "GPU" and torch.cuda.is_available():
+            self.device = torch.device("cuda")
+            return torch.float16, "fp16"
+        self.device = torch.device("cpu")
+        # CPUs can't handle float16. Choose between fp32, bf16, or int8
+        precision = model_config["parameters"]["cpu_precision"]["string_value"]
+        return get_cpu_torch_dtype(precision), precision
+
+    def load_model(self, args, model_config, torch_dtype, precision) -> None:
+        """Load the model and tokenizer into `self.model` and `self.tokenizer`"""
+        raise NotImplementedError
+
+    def encode(self, texts: List[str], src_langs: List[str]):
+        """Tokenize the texts, each starting with its own src_lang's token"""
+        return self.tokenizer(
+            text=texts, src_lang=src_langs, return_tensors="pt", padding=True
+        )
+
+    def load_generation_limits(self, model_config) -> None:
+        """Rows are ended early once they generate more than max(ratio * input
+        tokens, floor) tokens, or their recent tokens are just a few repeating ones"""
+        self.max_output_tokens_per_input_token = float(
+            model_config["parameters"]["max_output_tokens_per_input_token"][
+                "string_value"
+            ]
+        )
+        self.max_output_tokens_floor = int(
+            model_config["parameters"]["max_output_tokens_floor"]["string_value"]
+        )
+        self.repetition_window = int(
+            model_config["parameters"]["repetition_window"]["string_value"]
+        )
+        self.min_unique_token_ratio = float(
+            model_config["parameters"]["min_unique_token_ratio"]["string_value"]
+        )
+        self.length_limited_metric = pb_utils.MetricFamily(
+            name=f"{self.name}_length_limited_rows_total",
+            description="Number of rows ended early at their output length limit",
+            kind=pb_utils.MetricFamily.COUNTER,
+        ).Metric(labels={"model": model_config["name"]})
+        self.repetition_limited_metric = pb_utils.MetricFamily(
+            name=f"{self.name}_repetition_limited_rows_total",
+            description="Number of rows ended early for repeating a few tokens",
+            kind=pb_utils.MetricFamily.COUNTER,
+        ).Metric(labels={"model": model_config["name"]})
+
+    def load_memory_ceiling(self, model_config) -> None:
+        """On the CPU, a generate() call's peak memory is estimated from its rows,
+        beams, and input and output limits, and kept under a ceiling so that the host
+        doesn't run out of memory and kill the server. The costs are calibrated per
+        model. Unlike the GPU, running out of host memory can't be retried."""
+        self.memory_bytes_per_token = int(
+            model_config["parameters"]["memory_bytes_per_token"]["string_value"]
+        )
+        self.memory_bytes_per_row = int(
+            model_config["parameters"]["memory_bytes_per_row"]["string_value"]
+        )
+        self.memory_ceiling_bytes = 0
+        if self.device.type == "cpu":
+            self.memory_ceiling_bytes = (
+                int(
+                    model_config["parameters"]["cpu_generate_memory_ceiling_mb"][
+                        "string_value"
+                    ]
+                )
+                * 2**20
+            )
+            host_memory = host_memory_bytes()
+            model_memory = current_rss_bytes()
+            if host_memory and model_memory + self.memory_ceiling_bytes > host_memory:
+                pb_utils.Logger.log_warn(
+                    f"{self.name} cpu_generate_memory_ceiling_mb of "
+                    + f"{format_mib(self.memory_ceiling_bytes)} plus the model's "
+                    + f"{format_mib(model_memory)} is more than the host's "
+                    + f"{format_mib(host_memory)}"
+                )
+
+    def estimate_generate_memory(
+        self, length: int, n_decoded: int, decoding_profile: dict
+    ) -> int:
+        """Estimated peak memory, in bytes, of a generate() call on `n_decoded`
+        output rows whose longest input has `length` tokens.
+
+        Every beam of every row keeps the keys and values of the input tokens, for
+        cross attention, and of the tokens generated so far, for self attention. The
+        batch decodes until the longest row's output limit, so each beam is counted at
+        the longest input plus its output limit, times `memory_bytes_per_token`. Each
+        beam also gets `memory_bytes_per_row` for the logits and scores over the
+        vocabulary.
+        """
+        n_beams = n_decoded * decoding_profile["num_beams"]
+        n_tokens = length + self.max_new_tokens_for_length(length, decoding_profile)
+        return n_beams * (
+            n_tokens * self.memory_bytes_per_token + self.memory_bytes_per_row
+        )
+
+    def over_memory_ceiling(
+        self, length: int, n_decoded: int, decoding_profile: dict
+    ) -> bool:
+        if self.memory_ceiling_bytes <= 0:
+            return False
+        return (
+            self.estimate_generate_memory(length, n_decoded, decoding_profile)
+            > self.memory_ceiling_bytes
+        )
+
+    def max_new_tokens_for_length(self, length: int, decoding_profile: dict) -> int:
+        """Maximum number of tokens to generate for a row of `length` input tokens.
+        At least `max_output_tokens_floor` and at most the decoding profile's
+        `max_new_tokens`. A ratio <= 0 leaves just the profile's limit."""
+        max_new_tokens = decoding_profile["max_new_tokens"]
+        if self.max_output_tokens_per_input_token <= 0:
+            return max_new_tokens
+        return min(
+            max_new_tokens,
+            max(
+                self.max_output_tokens_floor,
+                math.ceil(length * self.max_output_tokens_per_input_token),
+            ),
+        )
+
+    def record_generation_limits(
+        self, n_length_limited: int, n_repetition_limited: int
+    ) -> None:
+        """Log and count the rows that were ended early"""
+        if n_length_limited == 0 and n_repetition_limited == 0:
+            return
+        self.length_limited_metric.increment(n_length_limited)
+        self.repetition_limited_metric.increment(n_repetition_limited)
+        pb_utils.Logger.log_info(
+            f"{self.name} ended {n_length_limited} rows at their length limit "
+            + f"and {n_repetition_limited} rows that were repeating"
+        )
+
+    def lang_token(self, lang_id: str) -> str:
+        return self.lang_token_format.format(lang_id.strip("_"))
+
+    def unsupported_lang(self, lang_id: str) -> bool:
+        return self.lang_token(lang_id) not in self.supported_languages
+
+    def check_langs(self, src_lang: List[str], tgt_lang: List[str]) -> None:
+        """
+        Raises
+        ------
+        ValueError
+            If a src_lang or tgt_lang is not supported by the model
+        """
+        for kind, langs in [("src_lang", src_lang), ("tgt_lang", tgt_lang)]:
+            for lang in set(langs):
+                if self.unsupported_lang(lang):
+                    raise ValueError(
+                        f"{kind} {lang} is not supported by {self.display_name}. "
+                        + f"Needs to be one of {self.language_hint}"
+                        + f"{self.tokenizer.additional_special_tokens}"
+                    )
+
+
+class TranslationModel(TranslationModelBase):
+    """Translate the rows of the dynamic batch in sub-batches of similar length,
+    retrying failed sub-batches in halves. Subclasses may override `generate` to
+    use another engine and set the warmup languages."""
+
+    # Supported by the "transformers" engine only. Subclasses with other engines set
+    # it in load_model()
+    engine = "transformers"
+    warmup_src_lang = None
+    warmup_tgt_lang = None
+
+    def initialize(self, args):
+        self.model_config = model_config = json.loads(args["model_config"])
+        # Get TRANSLATED_TEXT configuration
+        translated_text_config = pb_utils.get_output_config_by_name(
+            model_config, "TRANSLATED_TEXT"
+        )
+        # Convert Triton types to numpy types
+        self.translated_text_dtype = pb_utils.triton_string_to_numpy(
+            translated_text_config["data_type"]
+        )
+        # Get OUTPUT_IDS configuration
+        output_ids_config = pb_utils.get_output_config_by_name(
+            model_config, "OUTPUT_IDS"
+        )
+        self.output_ids_dtype = pb_utils.triton_string_to_numpy(
+            output_ids_config["data_type"]
+        )
+
+        torch_dtype, precision = self.select_device(args, model_config)
+        self.load_model(args, model_config, torch_dtype, precision)
+        self.supported_languages = set(self.tokenizer.additional_special_tokens)
+
+        # Sub-batches of similar length are sent to generate() so that a single long
+        # sentence doesn't make the rest of the dynamic batch pad up to its length
+        self.max_padding_waste = float(
+            model_config["parameters"]["max_padding_waste"]["string_value"]
+        )
+        # Named decoding settings that requests choose from with the decoding_profile
+        # request parameter, e.g., greedy decoding for latency sensitive callers
+        self.decoding_profiles = self.load_decoding_profiles(
+            model_config["parameters"]["decoding_profiles"]["string_value"]
+        )
+        self.default_decoding_profile = model_config["parameters"][
+            "default_decoding_profile"
+        ]["string_value"]
+        if self.default_decoding_profile not in self.decoding_profiles:
+            raise ValueError(
+                f"default_decoding_profile {self.default_decoding_profile} is not "
+                + f"one of the decoding_profiles {list(self.decoding_profiles)}"
+            )
+        # Token budgets for a single generate() call. The output tokens of a row are
+        # estimated from its input length and counted once per beam
+        self.max_input_tokens_per_generate = int(
+            model_config["parameters"]["max_input_tokens_per_generate"]["string_value"]
+        )
+        self.max_output_tokens_per_generate = int(
+            model_config["parameters"]["max_output_tokens_per_generate"]["string_value"]
+        )
+        self.output_tokens_per_input_token = float(
+            model_config["parameters"]["output_tokens_per_input_token"]["string_value"]
+        )
+        self.load_memory_ceiling(model_config)
+        self.load_generation_limits(model_config)
+        retries_family = pb_utils.MetricFamily(
+            name=f"{self.name}_batch_retries_total",
+            description="Number of times a failed batch was split in half and retried",
+            kind=pb_utils.MetricFamily.COUNTER,
+        )
+        self.retries_metrics = {
+            reason: retries_family.Metric(
+                labels={"model": model_config["name"], "reason": reason}
+            )
+            for reason in ["out_of_memory", "error"]
+        }
+        self.input_tokens_metric = pb_utils.MetricFamily(
+            name=f"{self.name}_input_tokens_total",
+            description="Number of input tokens sent to generate(), excluding padding",
+            kind=pb_utils.MetricFamily.COUNTER,
+        ).Metric(labels={"model": model_config["name"]})
+        self.padded_input_tokens_metric = pb_utils.MetricFamily(
+            name=f"{self.name}_padded_input_tokens_total",
+            description="Number of input tokens sent to generate(), including padding",
+            kind=pb_utils.MetricFamily.COUNTER,
+        ).Metric(labels={"model": model_config["name"]})
+
+        # Optionally compile the encoder and decoder with torch.compile. Inputs are
+        # padded up to a length bucket so only a few input shapes are ever compiled,
+        # and the compiled artifacts are cached in the model's directory for restarts
+        self.compile = (
+            model_config["parameters"]["compile"]["string_value"].lower() == "true"
+        )
+        if self.compile and self.engine != "transformers":
+            pb_utils.Logger.log_warn(
+                f"{self.name} compile is ignored by the {self.engine} engine"
+            )
+            self.compile = False
+        self.length_buckets = []
+        if self.compile:
+            enable_compile_cache(
+                os.path.join(
+                    args["model_repository"],
+                    model_config["parameters"]["compile_cache_dir"]["string_value"],
+                )
+            )
+            compile_model(self.model)
+            self.length_buckets = parse_length_buckets(
+                model_config["parameters"]["compile_length_buckets"]["string_value"]
+            )
+        # Run the hot path before reporting ready so the first requests don't pay for
+        # lazy initialization or compilation
+        warmup_batch_size = int(
+            model_config["parameters"]["warmup_batch_size"]["string_value"]
+        )
+        if warmup_batch_size > 0:
+            self.warmup(warmup_batch_size)
+
+    def execute(self, requests: List) -> List:
+        """
+        Each request is sent by a client and represents appropriately chunked text
+        for translation. A request may contain several chunks along the batch
+        dimension, i.e., INPUT_TEXT, SRC_LANG, and TGT_LANG have shape [n, 1] with one
+        row per chunk. The TRANSLATED_TEXT returned has the same shape with the
+        translations in the same order. The optional `decoding_profile` request
+        parameter selects one of the config's `decoding_profiles`.
+
+        Instead of INPUT_TEXT, a caller that already tokenized the text, e.g.,
+        translate, may send INPUT_IDS with shape [n, max_length], padded with any
+        value, along with the number of tokens of each row in INPUT_LENGTHS [n, 1].
+        Requesting OUTPUT_IDS returns the generated token ids [n, max_length], padded
+        with the pad token, and leaving out TRANSLATED_TEXT skips decoding them.
+
+        Parameters
+        ----------
+        requests : List[pb_utils.InferenceRequest]
+
+        Returns
+        -------
+        responses: List[pb_utils.InferenceResponse]
+        """
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger = pb_utils.Logger
+        batch_size = len(requests)
+        logger.log_info(f"{self.name}.execute received {batch_size} requests")
+        responses = [None] * batch_size
+        valid_requests = []
+        request_sizes = []
+        batch_input_text = []
+        batch_src_lang = []
+        batch_tgt_lang = []
+        batch_decoding_profile = []
+        batch_requested_outputs = []
+        for batch_id, request in enumerate(requests):
+            try:
+                # Get the input data as Triton Tensors
+                input_text_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_TEXT")
+                input_ids_tt = pb_utils.get_input_tensor_by_name(request, "INPUT_IDS")
+                src_lang_tt = pb_utils.get_input_tensor_by_name(request, "SRC_LANG")
+                tgt_lang_tt = pb_utils.get_input_tensor_by_name(request, "TGT_LANG")
+
+                # Convert TritonTensor -> numpy -> python str
+                # NOTE: Triton converts your input string to bytes so you need to decode
+                if input_ids_tt is not None:
+                    # Tokenized by the caller. Each row is kept as a tuple of its ids
+                    input_text = self.parse_input_ids(
+                        input_ids_tt,
+                        pb_utils.get_input_tensor_by_name(request, "INPUT_LENGTHS"),
+                    )
+                elif input_text_tt is not None:
+                    input_text = [
+                        b.decode("utf-8") for b in input_text_tt.as_numpy().reshape(-1)
+                    ]
+                else:
+                    raise ValueError("Either INPUT_TEXT or INPUT_IDS is required")
+                src_lang = [
+                    b.decode("utf-8") for b in src_lang_tt.as_numpy().reshape(-1)
+                ]
+                tgt_lang = [
+                    b.decode("utf-8") for b in tgt_lang_tt.as_numpy().reshape(-1)
+                ]
+
+                if not len(input_text) == len(src_lang) == len(tgt_lang):
+                    raise ValueError(
+                        f"INPUT_TEXT (or INPUT_IDS), SRC_LANG, and TGT_LANG must have "
+                        + f"the same number of elements. Got {len(input_text)}, "
+                        + f"{len(src_lang)}, and {len(tgt_lang)}"
+                    )
+                self.check_langs(src_lang, tgt_lang)
+                if input_ids_tt is not None:
+                    self.check_src_lang_ids(input_text, src_lang)
+
+                request_params = json.loads(request.parameters())
+                decoding_profile = request_params.get(
+                    "decoding_profile", self.default_decoding_profile
+                )
+                if decoding_profile not in self.decoding_profiles:
+                    raise ValueError(
+                        f"decoding_profile {decoding_profile} is not supported. "
+                        + f"Needs to be one of {list(self.decoding_profiles)}"
+                    )
+
+                batch_input_text.append(input_text)
+                batch_src_lang.append(src_lang)
+                batch_tgt_lang.append(tgt_lang)
+                batch_decoding_profile.append([decoding_profile] * len(input_text))
+                batch_requested_outputs.append(request.requested_output_names())
+            except Exception as exc:
+                response = pb_utils.InferenceResponse(
+                    error=pb_utils.TritonError(
+                        f"{exc}", pb_utils.TritonError.INVALID_ARG
+                    )
+                )
+                responses[batch_id] = response
+                continue
+            else:
+                valid_requests.append(batch_id)
+                request_sizes.append(len(input_text))
+
+        input_texts = list(itertools.chain.from_iterable(batch_input_text))
+        src_langs = list(itertools.chain.from_iterable(batch_src_lang))
+        tgt_langs = list(itertools.chain.from_iterable(batch_tgt_lang))
+        decoding_profiles = list(itertools.chain.from_iterable(batch_decoding_profile))
+        if not input_texts:
+            return responses
+
+        # Rows with the same INPUT_TEXT, SRC_LANG, and decoding profile, e.g., the same
+        # sentence going to several tgt_langs, are encoded once and the encoder output
+        # is shared by each of their tgt_langs when decoding
+        source_ids = {}
+        row_sources = []
+        for source in zip(input_texts, src_langs, decoding_profiles):
+            row_sources.append(source_ids.setdefault(source, len(source_ids)))
+        sources = list(source_ids)
+        source_rows = [[] for _ in sources]
+        for i, source_id in enumerate(row_sources):
+            source_rows[source_id].append(i)
+
+        translated_texts = [None] * len(input_texts)
+        output_ids = [None] * len(input_texts)
+        errors = [None] * len(input_texts)
+        # Only decode the rows of requests that want TRANSLATED_TEXT
+        decode = list(
+            itertools.chain.from_iterable(
+                ["TRANSLATED_TEXT" in requested_outputs] * request_size
+                for requested_outputs, request_size in zip(
+                    batch_requested_outputs, request_sizes
+                )
+            )
+        )
+
+        # Run through the model for translation
+        ## Tokenize
+        try:
+            encoding = self.tokenize(sources)
+        except Exception:
+            # Only the sentences the tokenizer fails on get an error. Be careful error
+            # msg doesn't cross contaminate user data
+            failed = self.find_untokenizable(sources, list(range(len(sources))))
+            for source_id, exc in failed.items():
+                for i in source_rows[source_id]:
+                    errors[i] = (
+                        f"{self.name}.tokenizer threw error tokenizing the sentence: "
+                        + f"{exc}"
+                    )
+            self.retries_metrics["error"].increment(1)
+            sources = [
+                source for k, source in enumerate(sources) if k not in failed
+            ]
+            source_rows = [
+                rows for k, rows in enumerate(source_rows) if k not in failed
+            ]
+            try:
+                encoding = self.tokenize(sources) if sources else None
+            except Exception as exc:
+                for rows in source_rows:
+                    for i in rows:
+                        errors[i] = (
+                            f"{self.name}.tokenizer threw error tokenizing the batch: "
+                            + f"{exc}"
+                        )
+                encoding = None
+
+        if encoding is not None:
+            ## Split into sub-batches of a single decoding profile and similar length
+            lengths = encoding["attention_mask"].sum(dim=1).tolist()
+            n_targets = [len(rows) for rows in source_rows]
+            source_profiles = [profile for _, _, profile in sources]
+            sub_batches = self.make_sub_batches(lengths, n_targets, source_profiles)
+            self.record_padding(lengths, sub_batches, len(input_texts))
+
+            def run(sub_batch: List[int]) -> None:
+                # Rows of the batch decoded from this sub-batch's sources
+                rows = [i for source_id in sub_batch for i in source_rows[source_id]]
+                sub_output_ids, sub_translated_texts = self.translate_sub_batch(
+                    encoding,
+                    sub_batch,
+                    lengths,
+                    source_rows,
+                    [tgt_langs[i] for i in rows],
+                    self.decoding_profiles[source_profiles[sub_batch[0]]],
+                    [decode[i] for i in rows],
+                )
+                for i, ids, translated_text in zip(
+                    rows, sub_output_ids, sub_translated_texts
+                ):
+                    output_ids[i] = ids
+                    translated_texts[i] = translated_text
+
+            def on_failure(sub_batch: List[int], exc: Exception, retrying: bool):
+                out_of_memory = self.is_out_of_memory(exc)
+                if out_of_memory and torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                if retrying:
+                    reason = "out_of_memory" if out_of_memory else "error"
+                    self.retries_metrics[reason].increment(1)
+                    logger.log_warn(
+                        f"{self.name} splitting a sub-batch of {len(sub_batch)} "
+                        + f"sentences in half and retrying after {reason}"
+                    )
+                    return
+                for source_id in sub_batch:
+                    for i in source_rows[source_id]:
+                        errors[i] = f"{exc}"
+
+            # A sub-batch that fails, e.g., runs out of memory, is split in half and
+            # each half is retried, down to single sentences, so that only the
+            # sentences that actually fail get an error
+            retry_in_halves(sub_batches, run, on_failure)
+
+        # Split the flattened translations back into their requests
+        start = 0
+        for batch_id, request_size, requested_outputs in zip(
+            valid_requests, request_sizes, batch_requested_outputs
+        ):
+            request_rows = slice(start, start + request_size)
+            request_errors = [e for e in errors[request_rows] if e]
+            start += request_size
+            if request_errors:
+                responses[batch_id] = pb_utils.InferenceResponse(
+                    error=pb_utils.TritonError(request_errors[0])
+                )
+                continue
+            # Convert to TritonTensor & make the TritonInferenceResponse
+            output_tensors = []
+            if "TRANSLATED_TEXT" in requested_outputs:
+                output_tensors.append(
+                    pb_utils.Tensor(
+                        "TRANSLATED_TEXT",
+                        np.array(
+                            translated_texts[request_rows],
+                            dtype=self.translated_text_dtype,
+                        ).reshape(-1, 1),
+                    )
+                )
+            if "OUTPUT_IDS" in requested_outputs:
+                output_tensors.append(
+                    pb_utils.Tensor(
+                        "OUTPUT_IDS", self.pad_ids(output_ids[request_rows])
+                    )
+                )
+            inference_response = pb_utils.InferenceResponse(
+                output_tensors=output_tensors,
+            )
+            responses[batch_id] = inference_response
+
+        return responses
+
+    def tokenize(self, sources: List[tuple]):
+        """Tokenize the (input_text, src_lang, decoding_profile) sources. Sources
+        whose input_text is a tuple of token ids were tokenized by the caller and are
+        only padded."""
+        text_sources = [
+            k for k, (text, _, _) in enumerate(sources) if isinstance(text, str)
+        ]
+        if len(text_sources) == len(sources):
+            return self.encode(
+                [text for text, _, _ in sources], [src for _, src, _ in sources]
+            )
+        input_ids = [list(text) for text, _, _ in sources]
+        if text_sources:
+            encoding = self.encode(
+                [sources[k][0] for k in text_sources],
+                [sources[k][1] for k in text_sources],
+            )
+            for k, ids, mask in zip(
+                text_sources, encoding["input_ids"], encoding["attention_mask"]
+            ):
+                input_ids[k] = ids[mask.bool()].tolist()
+        return self.tokenizer.pad(
+            {"input_ids": input_ids}, return_tensors="pt"
+        )
+
+    def parse_input_ids(self, input_ids_tt, input_lengths_tt) -> List[tuple]:
+        """Get each row's token ids, dropping the padding after INPUT_LENGTHS tokens
+
+        Raises
+        ------
+        ValueError
+            If INPUT_LENGTHS is missing or doesn't match, or a token id isn't in the
+            vocabulary
+        """
+        if input_lengths_tt is None:
+            raise ValueError("INPUT_LENGTHS is required with INPUT_IDS")
+        input_ids = input_ids_tt.as_numpy()
+        input_lengths = input_lengths_tt.as_numpy().reshape(-1)
+        if input_ids.ndim != 2 or len(input_lengths) != input_ids.shape[0]:
+            raise ValueError(
+                f"INPUT_IDS must have shape [n, max_length] and INPUT_LENGTHS [n, 1]. "
+                + f"Got {list(input_ids.shape)} and {len(input_lengths)} lengths"
+            )
+        rows = []
+        for ids, length in zip(input_ids, input_lengths):
+            if not 0 < length <= len(ids):
+                raise ValueError(
+                    f"INPUT_LENGTHS {length} is not between 1 and {len(ids)}"
+                )
+            ids = ids[:length]
+            if ids.min() < 0 or ids.max() >= len(self.tokenizer):
+                raise ValueError(
+                    f"INPUT_IDS has token ids outside of the vocabulary of "
+                    + f"{len(self.tokenizer)} tokens"
+                )
+            rows.append(tuple(ids.tolist()))
+        return rows
+
+    def check_src_lang_ids(self, input_ids: List[tuple], src_lang: List[str]) -> None:
+        """Check that each tokenized row starts with its SRC_LANG's token, like
+        the tokenizer's output does
+
+        Raises
+        ------
+        ValueError
+            If a row starts with a different token
+        """
+        for ids, src in zip(input_ids, src_lang):
+            src_lang_id = self.tokenizer.convert_tokens_to_ids(self.lang_token(src))
+            if ids[0] != src_lang_id:
+                raise ValueError(
+                    f"INPUT_IDS row starts with token id {ids[0]}, but SRC_LANG "
+                    + f"{src} is token id {src_lang_id}"
+                )
+
+    def pad_ids(self, rows: List[List[int]]) -> np.ndarray:
+        """Stack the token ids of the rows into an array, padding them with the pad
+        token"""
+        max_length = max(len(ids) for ids in rows)
+        padded = np.full(
+            (len(rows), max_length),
+            self.tokenizer.pad_token_id,
+            dtype=self.output_ids_dtype,
+        )
+        for k, ids in enumerate(rows):
+            padded[k, : len(ids)] = ids
+        return padded
+
+    def find_untokenizable(self, sources: List[tuple], source_ids: List[int]) -> dict:
+        """Bisect the sources to find the ones the tokenizer fails on
+
+        Returns
+        -------
+        dict
+            {source_id: exception} for every source that failed on its own
+        """
+        try:
+            self.tokenize([sources[k] for k in source_ids])
+            return {}
+        except Exception as exc:
+            if len(source_ids) == 1:
+                return {source_ids[0]: exc}
+        half = len(source_ids) // 2
+        return {
+            **self.find_untokenizable(sources, source_ids[:half]),
+            **self.find_untokenizable(sources, source_ids[half:]),
+        }
+
+    def translate_sub_batch(
+        self,
+        encoding,
+        sub_batch: List[int],
+        lengths: List[int],
+        source_rows: List[List[int]],
+        tgt_lang: List[str],
+        decoding_profile: dict,
+        decode: List[bool],
+    ) -> tuple:
+        """Generate the translations of a sub-batch's output rows and decode the
+        ones marked in `decode`
+
+        Returns
+        -------
+        tuple[List[List[int]], List[str | None]]
+            Generated token ids of each output row and its translation, or None if it
+            wasn't decoded
+
+        Raises
+        ------
+        RuntimeError
+            If generate() or batch_decode threw. The original exception is the cause.
+        """
+        sub_encoding = self.slice_encoding(encoding, sub_batch, lengths)
+        expand = torch.tensor(
+            [k for k, source_id in enumerate(sub_batch) for _ in source_rows[source_id]],
+            dtype=torch.long,
+            device=self.device,
+        )
+        ## Generate output tokens
+        rss_before = current_rss_bytes()
+        peak_before = peak_rss_bytes()
+        try:
+            output_tokens = self.generate(
+                sub_encoding, expand, tgt_lang, decoding_profile
+            )
+        except Exception as exc:
+            raise RuntimeError(
+                f"{self.name}.model.generate threw error on batch: {exc}"
+            ) from exc
+        if self.device.type == "cpu":
+            self.log_memory(
+                self.estimate_generate_memory(
+                    sub_encoding["input_ids"].shape[1], len(expand), decoding_profile
+                ),
+                rss_before,
+                peak_before,
+            )
+
+        if isinstance(output_tokens, torch.Tensor):
+            output_tokens = output_tokens.tolist()
+
+        ## Decode tokens to text
+        translated_texts = [None] * len(output_tokens)
+        decode_rows = [k for k, decode_row in enumerate(decode) if decode_row]
+        try:
+            if decode_rows:
+                decoded = self.tokenizer.batch_decode(
+                    [output_tokens[k] for k in decode_rows], skip_special_tokens=True
+                )
+                for k, translated_text in zip(decode_rows, decoded):
+                    translated_texts[k] = translated_text
+        except Exception as exc:
+            raise RuntimeError(
+                f"{self.name}.tokenizer.batch_decode threw on batch: {exc}"
+            ) from exc
+        return output_tokens, translated_texts
+
+    @staticmethod
+    def is_out_of_memory(exc: Exception) -> bool:
+        """True if the exception, or its cause, is the GPU or CPU running out of
+        memory"""
+        cause = exc.__cause__ if exc.__cause__ is not None else exc
+        if isinstance(cause, torch.cuda.OutOfMemoryError):
+            return True
+        message = str(cause).lower()
+        return "out of memory" in message or "can't allocate memory" in message
+
+    def generate(
+        self,
+        encoding: dict,
+        expand: torch.Tensor,
+        tgt_lang: List[str],
+        decoding_profile: dict,
+    ):
+        """Generate the translation tokens of a sub-batch. Each source is encoded once
+        and its encoder output is shared by all of its output rows.
+
+        Parameters
+        ----------
+        encoding : dict
+            Tokenized sources of the sub-batch, on the model's device
+        expand : torch.Tensor
+            Index of the source row that each output row translates
+        tgt_lang : List[str]
+            Target language of each output row
+        decoding_profile : dict
+            {"num_beams": int, "max_new_tokens": int} to decode with
+
+        Returns
+        -------
+        torch.Tensor
+            Generated token ids of each output row
+        """
+        max_new_tokens = self.row_max_new_tokens(
+            encoding["attention_mask"][expand], decoding_profile
+        )
+        generation_limits = GenerationLimits(
+            max_new_tokens,
+            eos_token_id=self.tokenizer.eos_token_id,
+            num_beams=decoding_profile["num_beams"],
+            repetition_window=self.repetition_window,
+            min_unique_token_ratio=self.min_unique_token_ratio,
+        )
+        with torch.no_grad():
+            encoder_outputs = self.model.get_encoder()(**encoding, return_dict=True)
+            output_tokens = self.model.generate(
+                attention_mask=encoding["attention_mask"][expand],
+                encoder_outputs=BaseModelOutput(
+                    last_hidden_state=encoder_outputs.last_hidden_state[expand]
+                ),
+                tgt_lang=tgt_lang,
+                logits_processor=LogitsProcessorList([generation_limits]),
+                num_beams=decoding_profile["num_beams"],  # Massive throughput hit if > 1
+                num_return_sequences=1,
+                max_new_tokens=max(max_new_tokens),
+                no_repeat_ngram_size=3,
+            )
+        self.record_generation_limits(
+            len(generation_limits.length_limited_rows),
+            len(generation_limits.repetition_limited_rows),
+        )
+        return output_tokens
+
+    def row_max_new_tokens(
+        self, attention_mask: torch.Tensor, decoding_profile: dict
+    ) -> List[int]:
+        """Maximum number of tokens to generate for each row given its number of
+        input tokens, see `max_new_tokens_for_length`"""
+        return [
+            self.max_new_tokens_for_length(length, decoding_profile)
+            for length in attention_mask.sum(dim=1).tolist()
+        ]
+
+    def log_memory(self, estimate: int, rss_before: int, peak_before: int) -> None:
+        """Log the estimated memory of a generate() call next to the actual RSS so
+        that `memory_bytes_per_token` and `memory_bytes_per_row` can be checked. The
+        process's peak RSS only moves when a call uses more than any call before it,
+        so the growth is only shown when it does."""
+        peak_after = peak_rss_bytes()
+        message = (
+            f"{self.name} generate() estimated {format_mib(estimate)}, "
+            + f"RSS before {format_mib(rss_before)}, "
+            + f"after {format_mib(current_rss_bytes())}, "
+            + f"peak {format_mib(peak_after)}"
+        )
+        if peak_after > peak_before:
+            message += (
+                f" (peak grew {format_mib(peak_after - rss_before)} over RSS before)"
+            )
+        pb_utils.Logger.log_info(message)
+
+    def warmup(self, batch_size: int) -> None:
+        """Translate a batch of `batch_size` copies of a sentence, padded up to each
+        length bucket when compiled, so that lazy initialization and compilation
+        happen during initialize()"""
+        encoding = self.encode(
+            ["This sentence warms up the model before it serves requests."]
+            * batch_size,
+            [self.warmup_src_lang] * batch_size,
+        )
+        length = encoding["input_ids"].shape[1]
+        rows = list(range(batch_size))
+        expand = torch.arange(batch_size, device=self.device)
+        warmup_lengths = [b for b in self.length_buckets if b >= length] or [length]
+        for warmup_length in warmup_lengths:
+            start = time.perf_counter()
+            # slice_encoding() pads the rows up to warmup_length when compiled
+            self.generate(
+                self.slice_encoding(encoding, rows, [warmup_length] * batch_size),
+                expand,
+                [self.warmup_tgt_lang] * batch_size,
+                self.decoding_profiles[self.default_decoding_profile],
+            )
+            pb_utils.Logger.log_info(
+                f"{self.name} warmup of {batch_size} rows padded to "
+                + f"{warmup_length} tokens took {time.perf_counter() - start:.1f}s"
+            )
+
+    def make_sub_batches(
+        self, lengths: List[int], n_targets: List[int], decoding_profiles: List[str]
+    ) -> List[List[int]]:
+        """Group the rows of the batch into sub-batches of a single decoding profile
+        and similar token length, see `sub_batches.make_sub_batches`. A sub-batch is
+        over budget if it goes over `max_input_tokens_per_generate` or
+        `max_output_tokens_per_generate`, or its estimated memory over the CPU memory
+        ceiling.
+
+        Returns
+        -------
+        List[List[int]]
+            Row indices of each sub-batch, shortest sub-batch of each decoding profile
+            first
+        """
+        sub_batches = make_sub_batches(
+            lengths,
+            n_targets,
+            decoding_profiles,
+            self.max_padding_waste,
+            self.over_generate_budget,
+        )
+        for sub_batch in sub_batches:
+            i = sub_batch[0]
+            if len(sub_batch) == 1 and self.over_memory_ceiling(
+                lengths[i], n_targets[i], self.decoding_profiles[decoding_profiles[i]]
+            ):
+                pb_utils.Logger.log_warn(
+                    f"{self.name} sentence of {lengths[i]} tokens decoded "
+                    + f"into {n_targets[i]} tgt_langs is estimated to need more than "
+                    + f"the memory ceiling on its own. Sending it anyway"
+                )
+        return sub_batches
+
+    def over_generate_budget(
+        self, length: int, n_padded: int, n_decoded: int, decoding_profile: str
+    ) -> bool:
+        """Whether a generate() call on `n_decoded` output rows, whose longest input
+        has `length` tokens and `n_padded` input tokens in all, goes over the token
+        budgets or the memory ceiling"""
+        profile = self.decoding_profiles[decoding_profile]
+        return (
+            n_padded > self.max_input_tokens_per_generate
+            or n_decoded * self.estimate_output_tokens(length, profile)
+            > self.max_output_tokens_per_generate
+            or self.over_memory_ceiling(length, n_decoded, profile)
+        )
+
+    def estimate_output_tokens(self, length: int, decoding_profile: dict) -> int:
+        """Estimated number of tokens generated, over all beams, for an input row
+        of `length` tokens"""
+        n_new_tokens = min(
+            decoding_profile["max_new_tokens"],
+            math.ceil(length * self.output_tokens_per_input_token),
+        )
+        return decoding_profile["num_beams"] * n_new_tokens
+
+    @staticmethod
+    def load_decoding_profiles(decoding_profiles: str) -> dict:
+        """Parse the `decoding_profiles` config parameter, a JSON object mapping each
+        profile's name to its {"num_beams": int, "max_new_tokens": int}
+
+        Raises
+        ------
+        ValueError
+            If a profile is missing a setting or has one that isn't a positive int
+        """
+        profiles = json.loads(decoding_profiles)
+        if not profiles:
+            raise ValueError("decoding_profiles must define at least one profile")
+        for name, profile in profiles.items():
+            for key in ["num_beams", "max_new_tokens"]:
+                value = profile.get(key, None)
+                if not isinstance(value, int) or value < 1:
+                    raise ValueError(
+                        f"decoding_profiles {name} needs {key} to be a positive "
+                        + f"integer. Got {value}"
+                    )
+        return profiles
+
+    def slice_encoding(self, encoding, rows: List[int], lengths: List[int]) -> dict:
+        """Select the rows of the tokenized batch and drop the columns that are
+        padding for all of them, or pad them up to their length bucket when compiled.
+        Moves the result to the model's device."""
+        max_length = max(lengths[i] for i in rows)
+        if self.length_buckets:
+            max_length = bucket_length(max_length, self.length_buckets)
+            encoding = pad_encoding(
+                encoding,
+                max_length,
+                self.tokenizer.pad_token_id,
+                self.tokenizer.padding_side,
+            )
+        n_columns = encoding["input_ids"].shape[1]
+        if self.tokenizer.padding_side == "left":
+            columns = slice(n_columns - max_length, n_columns)
+        else:
+            columns = slice(0, max_length)
+        index = torch.tensor(rows, dtype=torch.long)
+        return {
+            key: value[index][:, columns].to(self.device)
+            for key, value in encoding.items()
+        }
+
+    def record_padding(
+        self, lengths: List[int], sub_batches: List[List[int]], n_rows: int
+    ):
+        """Log and count the padding efficiency achieved by the sub-batches"""
+        n_tokens = sum(lengths)
+        n_padded = sum(
+            len(sub_batch) * max(lengths[i] for i in sub_batch)
+            for sub_batch in sub_batches
+        )
+        n_unsorted = len(lengths) * max(lengths, default=0)
+        if n_padded == 0:
+            return
+        self.input_tokens_metric.increment(n_tokens)
+        self.padded_input_tokens_metric.increment(n_padded)
+        pb_utils.Logger.log_info(
+            f"{self.name} encoded {len(lengths)} distinct rows of "
+            + f"{n_rows} in {len(sub_batches)} sub-batches with padding efficiency "
+            + f"{n_tokens / n_padded:.1%} "
+            + f"(single batch would be {n_tokens / n_unsorted:.1%})"
+        )
@@ -0,0 +1,181 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, MODEL_REPOSITORY)
+
+from translation_common.continuous_batching import (  # noqa: E402
+    ContinuousBatchingEngine,
+    GenerationJob,
+)
+
+EOS_TOKEN_IDS = [2, 21]
+
+
+class Logger:
+    def log_info(self, message):
+        pass
+
+    log_warn = log_error = log_info
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = transformers.M2M100Config(
+        vocab_size=64,
+        d_model=32,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=4,
+        decoder_attention_heads=4,
+        encoder_ffn_dim=64,
+        decoder_ffn_dim=64,
+        max_position_embeddings=128,
+        init_std=0.3,
+        decoder_start_token_id=2,
+        pad_token_id=1,
+        eos_token_id=2,
+    )
+    return transformers.M2M100ForConditionalGeneration(config).eval()
+
+
+def make_jobs(results):
+    generator = torch.Generator().manual_seed(1)
+    jobs = []
+    for j in range(6):
+        n_rows = 1 + j % 3
+        input_ids = [
+            torch.randint(4, 64, (3 + (j + row) % 9,), generator=generator)
+            for row in range(n_rows)
+        ]
+        decoder_prefixes = [[2, 10 + (j + row) % 5] for row in range(n_rows)]
+        jobs.append(
+            GenerationJob(
+                input_ids,
+                decoder_prefixes,
+                on_complete=lambda output_ids, j=j: results.__setitem__(
+                    j, [ids.tolist() for ids in output_ids]
+                ),
+                on_error=lambda exc: pytest.fail(f"{exc}"),
+            )
+        )
+    return jobs
+
+
+def decode(model, arrivals: dict) -> dict:
+    """Step the engine by hand, adding each job at its arrival step"""
+    engine = ContinuousBatchingEngine(
+        model,
+        pad_token_id=1,
+        eos_token_ids=EOS_TOKEN_IDS,
+        max_new_tokens=25,
+        no_repeat_ngram_size=3,
+        max_active_rows=128,
+        device=torch.device("cpu"),
+        logger=Logger(),
+    )
+    results = {}
+    jobs = make_jobs(results)
+    step = 0
+    with torch.inference_mode():
+        while len(results) < len(arrivals):
+            engine.pending.extend(
+                jobs[j] for j, arrival in arrivals.items() if arrival == step
+            )
+            engine.admit()
+            engine.step()
+            engine.merge()
+            assert len(engine.cohorts) <= 1
+            step += 1
+    return results
+
+
+@pytest.mark.parametrize(
+    "arrivals", [[0] * 6, [0, 1, 2, 3, 5, 8], [0, 7, 3, 12, 1, 20]]
+)
+def test_rows_joining_later_match_decoding_alone(model, arrivals):
+    alone = {}
+    for j in range(len(arrivals)):
+        alone.update(decode(model, {j: 0}))
+
+    # Rows finish at different steps, so the cohort is trimmed as well as padded
+    assert len({len(ids) for rows in alone.values() for ids in rows}) > 1
+    assert decode(model, dict(enumerate(arrivals))) == alone
+
+
+def test_rows_end_at_their_own_length_limit(model):
+    unlimited = decode(model, {0: 0, 1: 0, 2: 0})
+    engine = ContinuousBatchingEngine(
+        model,
+        pad_token_id=1,
+        eos_token_ids=EOS_TOKEN_IDS,
+        max_new_tokens=25,
+        no_repeat_ngram_size=3,
+        max_active_rows=128,
+        device=torch.device("cpu"),
+        logger=Logger(),
+        on_limited=lambda n_length, n_repetition: limited.append(n_length),
+    )
+    limited = []
+    results = {}
+    jobs = make_jobs(results)[:3]
+    for job in jobs:
+        job.max_new_tokens = [3] * job.n_rows
+    engine.pending.extend(jobs)
+    with torch.inference_mode():
+        while len(results) < len(jobs):
+            engine.admit()
+            engine.step()
+            engine.merge()
+
+    for j, rows in results.items():
+        for ids, unlimited_ids in zip(rows, unlimited[j]):
+            assert ids == unlimited_ids[:3]
+    # Rows that hadn't generated eos by then were ended at the limit
+    assert limited
+    assert sum(limited) == sum(
+        len(ids) > 3 for rows in unlimited.values() for ids in rows
+    )
+
+
+def test_admission_stays_under_the_memory_ceiling(model):
+    alone = {}
+    for j in range(6):
+        alone.update(decode(model, {j: 0}))
+    n_rows_in_flight = []
+
+    # Every job fits on its own, but not all of them together
+    def over_memory_ceiling(length, n_rows):
+        return length * n_rows > 40
+
+    engine = ContinuousBatchingEngine(
+        model,
+        pad_token_id=1,
+        eos_token_ids=EOS_TOKEN_IDS,
+        max_new_tokens=25,
+        no_repeat_ngram_size=3,
+        max_active_rows=128,
+        device=torch.device("cpu"),
+        logger=Logger(),
+        over_memory_ceiling=over_memory_ceiling,
+    )
+    results = {}
+    engine.pending.extend(make_jobs(results))
+    with torch.inference_mode():
+        while len(results) < len(alone):
+            engine.admit()
+            n_rows_in_flight.append(engine.n_active_rows)
+            length = max(cohort.attention_mask.shape[1] for cohort in engine.cohorts)
+            assert not over_memory_ceiling(length, engine.n_active_rows)
+            engine.step()
+            engine.merge()
+
+    assert results == alone
+    # Jobs waited for rows in flight to finish
+    assert max(n_rows_in_flight) < sum(job.n_rows for job in make_jobs({}))
@@ -0,0 +1,106 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, MODEL_REPOSITORY)
+
+from translation_common.generation_limits import (  # noqa: E402
+    GenerationLimits,
+    repeating_rows,
+)
+
+EOS = 2
+VOCAB_SIZE = 16
+
+
+def run(limits, generated: list, prefix_length: int = 1) -> list:
+    """Feed the generated tokens to the processor one step at a time, like
+    generate() does, and return the scores of each step"""
+    input_ids = torch.tensor(generated)
+    all_scores = []
+    for step in range(prefix_length, input_ids.shape[1] + 1):
+        scores = torch.zeros(input_ids.shape[0], VOCAB_SIZE)
+        all_scores.append(limits(input_ids[:, :step], scores))
+    return all_scores
+
+
+def forced_eos(scores: torch.Tensor) -> list:
+    return (
+        (scores[:, EOS] == 0) & torch.isinf(scores).sum(dim=1).eq(VOCAB_SIZE - 1)
+    ).tolist()
+
+
+def test_each_row_ends_at_its_own_length_limit():
+    limits = GenerationLimits(
+        [2, 4],
+        eos_token_id=EOS,
+        num_beams=1,
+        repetition_window=0,
+        min_unique_token_ratio=0.0,
+    )
+    # decoder_start followed by 4 generated tokens
+    all_scores = run(limits, [[0, 5, 6, 7, 8], [0, 5, 6, 7, 8]])
+    assert [forced_eos(scores) for scores in all_scores] == [
+        [False, False],
+        [False, False],
+        [True, False],
+        [True, False],
+        [True, True],
+    ]
+    assert limits.length_limited_rows == {0, 1}
+    assert limits.repetition_limited_rows == set()
+
+
+def test_finished_rows_are_left_alone():
+    limits = GenerationLimits(
+        [2, 2],
+        eos_token_id=EOS,
+        num_beams=1,
+        repetition_window=0,
+        min_unique_token_ratio=0.0,
+    )
+    # Row 0 generated eos and is padded with it by greedy decoding
+    all_scores = run(limits, [[0, EOS, EOS], [0, 5, 6]])
+    assert forced_eos(all_scores[-1]) == [False, True]
+    assert limits.length_limited_rows == {1}
+
+
+def test_limits_apply_to_every_beam_of_a_row():
+    limits = GenerationLimits(
+        [1, 3],
+        eos_token_id=EOS,
+        num_beams=2,
+        repetition_window=0,
+        min_unique_token_ratio=0.0,
+    )
+    all_scores = run(limits, [[0, 5], [0, 6], [0, 5], [0, 6]])
+    assert forced_eos(all_scores[-1]) == [True, True, False, False]
+    assert limits.length_limited_rows == {0}
+
+
+def test_repeating_row_ends_early():
+    limits = GenerationLimits(
+        [100, 100],
+        eos_token_id=EOS,
+        num_beams=1,
+        repetition_window=6,
+        min_unique_token_ratio=0.5,
+    )
+    # Row 0 cycles through 2 tokens, row 1 through 6
+    all_scores = run(limits, [[0, 5, 6, 5, 6, 5, 6], [0, 5, 6, 7, 8, 9, 10]])
+    # Not checked until a full window has been generated
+    assert not any(any(forced_eos(scores)) for scores in all_scores[:-1])
+    assert forced_eos(all_scores[-1]) == [True, False]
+    assert limits.repetition_limited_rows == {0}
+    assert limits.length_limited_rows == set()
+
+
+def test_repeating_rows():
+    window = torch.tensor([[5, 6, 5, 6], [5, 6, 7, 5], [5, 5, 5, 5]])
+    assert repeating_rows(window, min_unique_tokens=3).tolist() == [True, False, True]
+    assert repeating_rows(window, min_unique_tokens=2).tolist() == [False, False, True]
@@ -0,0 +1,67 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, os.path.join(MODEL_REPOSITORY, "nllb_200_distilled_600M", "1"))
+
+from nllb_fix import LANG_TOKEN_TO_ID, NllbMulti, TgtLangIdsLogitsProcessor  # noqa: E402
+
+TGT_LANGS = ["fra_Latn", "deu_Latn"]
+VOCAB_SIZE = max(LANG_TOKEN_TO_ID.values()) + 1
+
+
+@pytest.mark.parametrize("num_beams", [1, 3])
+def test_tgt_lang_ids_forced_for_every_beam(num_beams):
+    tgt_lang_ids = [LANG_TOKEN_TO_ID[tgt] for tgt in TGT_LANGS]
+    n_rows = len(tgt_lang_ids) * num_beams
+    input_ids = torch.full((n_rows, 1), 2, dtype=torch.long)
+    scores = torch.randn(n_rows, VOCAB_SIZE)
+
+    processed = TgtLangIdsLogitsProcessor(tgt_lang_ids)(input_ids, scores)
+
+    # Rows are laid out as b * num_beams + beam
+    expected = torch.tensor(tgt_lang_ids).repeat_interleave(num_beams)
+    assert torch.equal(processed.argmax(dim=1), expected)
+    assert torch.isfinite(processed).sum() == n_rows
+
+
+def test_generate_with_beams_and_mixed_tgt_langs():
+    torch.manual_seed(0)
+    config = transformers.M2M100Config(
+        vocab_size=VOCAB_SIZE,
+        d_model=16,
+        encoder_layers=1,
+        decoder_layers=1,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=32,
+        decoder_ffn_dim=32,
+        max_position_embeddings=64,
+        decoder_start_token_id=2,
+        pad_token_id=1,
+        eos_token_id=2,
+    )
+    model = NllbMulti(config).eval()
+    input_ids = torch.tensor(
+        [
+            [LANG_TOKEN_TO_ID["eng_Latn"], 10, 11, 2],
+            [LANG_TOKEN_TO_ID["spa_Latn"], 12, 13, 2],
+        ]
+    )
+
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            tgt_lang=TGT_LANGS,
+            num_beams=3,
+            max_new_tokens=4,
+        )
+
+    # [decoder_start_token_id, tgt_lang, ...] for every row
+    assert output[:, 1].tolist() == [LANG_TOKEN_TO_ID[tgt] for tgt in TGT_LANGS]
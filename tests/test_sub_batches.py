@@ -0,0 +1,132 @@
+import os
+import sys
+
+import pytest
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, MODEL_REPOSITORY)
+
+from translation_common.sub_batches import (  # noqa: E402
+    make_sub_batches,
+    retry_in_halves,
+)
+
+
+def never_over_budget(length, n_padded, n_decoded, decoding_profile):
+    return False
+
+
+def test_rows_sorted_by_length():
+    lengths = [10, 3, 9, 4]
+    sub_batches = make_sub_batches(
+        lengths, [1] * 4, ["fast"] * 4, 0.3, never_over_budget
+    )
+    assert sub_batches == [[1, 3], [2, 0]]
+
+
+def test_sub_batches_have_a_single_decoding_profile():
+    sub_batches = make_sub_batches(
+        [5, 5, 5, 5],
+        [1] * 4,
+        ["quality", "fast", "quality", "fast"],
+        1.0,
+        never_over_budget,
+    )
+    assert sub_batches == [[1, 3], [0, 2]]
+
+
+def test_padding_waste():
+    # Adding the 10 token row to [2, 2] would make 2 * 8 / 30 of the tokens padding
+    lengths = [2, 2, 10]
+    assert make_sub_batches(lengths, [1] * 3, ["fast"] * 3, 0.5, never_over_budget) == [
+        [0, 1],
+        [2],
+    ]
+    assert make_sub_batches(lengths, [1] * 3, ["fast"] * 3, 0.6, never_over_budget) == [
+        [0, 1, 2]
+    ]
+
+
+def test_budget_counts_every_output_row():
+    budgets = []
+
+    def over_budget(length, n_padded, n_decoded, decoding_profile):
+        budgets.append((length, n_padded, n_decoded, decoding_profile))
+        return n_decoded > 4
+
+    # Rows decoded into 3, 1, and 2 tgt_langs
+    sub_batches = make_sub_batches(
+        [4, 4, 4], [3, 1, 2], ["fast"] * 3, 0.0, over_budget
+    )
+    assert sub_batches == [[0, 1], [2]]
+    assert budgets == [(4, 8, 4, "fast"), (4, 12, 6, "fast")]
+
+
+def test_row_over_budget_on_its_own_is_sent_alone():
+    sub_batches = make_sub_batches(
+        [2, 50, 2],
+        [1] * 3,
+        ["fast"] * 3,
+        1.0,
+        lambda length, n_padded, n_decoded, decoding_profile: length > 10,
+    )
+    assert sub_batches == [[0, 2], [1]]
+
+
+class Translator:
+    """Fails any sub-batch that contains one of the `failing` rows"""
+
+    def __init__(self, failing):
+        self.failing = set(failing)
+        self.runs = []
+        self.done = []
+        self.retried = []
+        self.failed = {}
+
+    def run(self, sub_batch):
+        self.runs.append(list(sub_batch))
+        if self.failing & set(sub_batch):
+            raise RuntimeError(f"failed on {sorted(self.failing & set(sub_batch))}")
+        self.done.extend(sub_batch)
+
+    def on_failure(self, sub_batch, exc, retrying):
+        if retrying:
+            self.retried.append(list(sub_batch))
+        else:
+            self.failed[sub_batch[0]] = f"{exc}"
+
+
+def test_no_failures_runs_each_sub_batch_once():
+    translator = Translator(failing=[])
+    retry_in_halves([[0, 1], [2]], translator.run, translator.on_failure)
+    assert translator.runs == [[0, 1], [2]]
+    assert translator.retried == []
+
+
+def test_failed_sub_batch_bisected_down_to_the_failing_row():
+    translator = Translator(failing=[5])
+    retry_in_halves(
+        [[0, 1, 2, 3, 4, 5, 6, 7], [8]], translator.run, translator.on_failure
+    )
+    assert sorted(translator.done) == [0, 1, 2, 3, 4, 6, 7, 8]
+    assert translator.failed == {5: "failed on [5]"}
+    # Halves are retried first half first, before the next sub-batch
+    assert translator.runs == [
+        [0, 1, 2, 3, 4, 5, 6, 7],
+        [0, 1, 2, 3],
+        [4, 5, 6, 7],
+        [4, 5],
+        [4],
+        [5],
+        [6, 7],
+        [8],
+    ]
+    assert translator.retried == [[0, 1, 2, 3, 4, 5, 6, 7], [4, 5, 6, 7], [4, 5]]
+
+
+@pytest.mark.parametrize("failing", [[0], [0, 2], [0, 1, 2]])
+def test_every_failing_row_gets_its_own_error(failing):
+    translator = Translator(failing=failing)
+    retry_in_halves([[0, 1, 2]], translator.run, translator.on_failure)
+    assert sorted(translator.failed) == failing
+    assert sorted(translator.done) == [i for i in range(3) if i not in failing]
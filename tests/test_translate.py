@@ -0,0 +1,158 @@
+import asyncio
+import os
+import sys
+import types
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, os.path.join(MODEL_REPOSITORY, "translate", "1"))
+# Only provided inside the Triton Inference Server. Not used by the code under test
+sys.modules.setdefault(
+    "triton_python_backend_utils", types.ModuleType("triton_python_backend_utils")
+)
+
+from translate import TritonPythonModel  # noqa: E402
+from translation_cache import TranslationCache  # noqa: E402
+
+TRANSLATION_MODEL = "nllb_200_distilled_600M"
+REQUEST_DATA = {
+    "translation_model": TRANSLATION_MODEL,
+    "decoding_profile": "balanced",
+    "use_cache": True,
+}
+
+
+class Logger:
+    def log_info(self, message):
+        pass
+
+    log_warn = log_error = log_info
+
+
+class TranslateRequest:
+    """Stands in for the BLS request to the translation model"""
+
+    def __init__(self, model, texts):
+        self.model = model
+        self.texts = texts
+
+    async def async_exec(self):
+        self.model.translated.append(self.texts)
+        # Let the other documents of the batch claim their sentences
+        await asyncio.sleep(0)
+        if any(text in self.model.failing for text in self.texts):
+            raise RuntimeError("translation model failed")
+        return [f"<{text}>" for text in self.texts]
+
+
+def make_model(max_packed_chars: int = 0):
+    model = TritonPythonModel.__new__(TritonPythonModel)
+    model.logger = Logger()
+    model.max_packed_chars = {TRANSLATION_MODEL: max_packed_chars}
+    model.translation_cache = TranslationCache(max_entries=100)
+    model.increment_cache_metric = lambda event, translation_model, value: None
+    model.translated = []
+    model.failing = set()
+
+    def make_translate_requests(targets, rows, request_data):
+        if not rows:
+            return []
+        texts = [
+            targets[tgt_lang][chunk_id]["input_text"].decode("utf-8")
+            for tgt_lang, chunk_id in rows
+        ]
+        return [(rows, TranslateRequest(model, texts))]
+
+    model.make_translate_requests = make_translate_requests
+    model.get_translations = lambda translate_response, translation_model: (
+        translate_response
+    )
+    return model
+
+
+def make_targets(sentences: list, tgt_lang: str = "fra_Latn") -> dict:
+    return {
+        tgt_lang: {
+            chunk_id: {"input_text": sentence.encode("utf-8"), "src_lang": "eng_Latn"}
+            for chunk_id, sentence in enumerate(sentences)
+        }
+    }
+
+
+async def translate_documents(model, documents: list) -> list:
+    """Translate the documents concurrently, as if in the same dynamic batch"""
+    batch_state = {"inflight": {}, "n_deduplicated": 0}
+    errors = await asyncio.gather(
+        *[
+            model.translate_sentences(targets, REQUEST_DATA, batch_state)
+            for targets in documents
+        ]
+    )
+    return errors, batch_state
+
+
+def test_repeated_packed_document_hits_the_cache():
+    model = make_model(max_packed_chars=100)
+    sentences = ["One.", "Two.", "Three."]
+
+    first = make_targets(sentences)
+    errors, _ = asyncio.run(translate_documents(model, [first]))
+    assert errors == [{}]
+    assert model.translated == [["One. Two. Three."]]
+
+    second = make_targets(sentences)
+    errors, _ = asyncio.run(translate_documents(model, [second]))
+    assert errors == [{}]
+    # Nothing more sent to the translation model
+    assert len(model.translated) == 1
+    assert second == first
+    assert second["fra_Latn"][0]["translated_text"] == "<One. Two. Three.>"
+
+
+def test_claim_sentences_waits_on_inflight_sentences():
+    model = make_model()
+    inflight = {}
+    request_data = dict(REQUEST_DATA, tgt_lang="fra_Latn")
+
+    async def claim_twice():
+        first = make_targets(["Hello.", "Bye."])["fra_Latn"]
+        second = make_targets(["Hello.", "Hello.", "New."])["fra_Latn"]
+        return (
+            model.claim_sentences(first, request_data, inflight),
+            model.claim_sentences(second, request_data, inflight),
+        )
+
+    (first_owned, first_waiting), (second_owned, second_waiting) = asyncio.run(
+        claim_twice()
+    )
+    assert sorted(first_owned) == [0, 1] and first_waiting == {}
+    # Both copies of "Hello." wait on the first document's future
+    assert sorted(second_owned) == [2]
+    assert second_waiting == {0: first_owned[0], 1: first_owned[0]}
+    assert len(inflight) == 3
+
+
+def test_duplicates_across_documents_translated_once():
+    model = make_model()
+    documents = [make_targets(["Hello.", "How are you?"]), make_targets(["Hello."])]
+    errors, batch_state = asyncio.run(translate_documents(model, documents))
+
+    assert errors == [{}, {}]
+    assert model.translated == [["Hello.", "How are you?"]]
+    assert batch_state["n_deduplicated"] == 1
+    assert documents[1]["fra_Latn"][0]["translated_text"] == "<Hello.>"
+
+
+def test_failed_owner_fails_its_waiters():
+    model = make_model()
+    model.failing = {"Boom."}
+    documents = [make_targets(["Boom."]), make_targets(["Boom.", "Fine."])]
+
+    async def translate():
+        return await asyncio.wait_for(translate_documents(model, documents), 5)
+
+    errors, _ = asyncio.run(translate())
+    assert [str(doc_errors["fra_Latn"]) for doc_errors in errors] == [
+        "translation model failed"
+    ] * 2
+    # Only the owner sent "Boom." to the translation model
+    assert sum(texts.count("Boom.") for texts in model.translated) == 1
@@ -0,0 +1,92 @@
+import os
+import sys
+
+MODEL_REPOSITORY = os.path.join(os.path.dirname(__file__), "..", "model-repository")
+sys.path.insert(0, os.path.join(MODEL_REPOSITORY, "translate", "1"))
+
+from translation_cache import TranslationCache  # noqa: E402
+
+
+def make_key(cache, sentence, tgt_lang="fra"):
+    return cache.make_key(
+        "seamlessm4t_text2text", "balanced", "eng", tgt_lang, sentence
+    )
+
+
+def test_least_recently_used_evicted_first():
+    cache = TranslationCache(max_entries=2)
+    first, second, third = [make_key(cache, s) for s in ["One.", "Two.", "Three."]]
+    assert cache.put(first, "Un.") == []
+    assert cache.put(second, "Deux.") == []
+    # Reading the first makes the second the least recently used
+    assert cache.get(first) == "Un."
+
+    assert cache.put(third, "Trois.") == [second]
+    assert cache.get(second) is None
+    assert cache.get(first) == "Un."
+    assert cache.get(third) == "Trois."
+    assert len(cache) == 2
+
+
+def test_updating_an_entry_does_not_evict():
+    cache = TranslationCache(max_entries=2)
+    first, second = [make_key(cache, s) for s in ["One.", "Two."]]
+    cache.put(first, "Un.")
+    cache.put(second, "Deux.")
+    assert cache.put(first, "Un !") == []
+    assert cache.get(first) == "Un !"
+    assert len(cache) == 2
+
+
+def test_key_normalizes_unicode_and_whitespace():
+    cache = TranslationCache(max_entries=10)
+    # "é" composed and as "e" + combining acute accent
+    composed = make_key(cache, "Caf\u00e9 ouvert.")
+    decomposed = make_key(cache, "  Cafe\u0301 \t\n ouvert.  ")
+    assert composed == decomposed
+
+    cache.put(composed, "Open café.")
+    assert cache.get(decomposed) == "Open café."
+    # The rest of the key is not normalized away
+    assert cache.get(make_key(cache, "Caf\u00e9 ouvert.", tgt_lang="deu")) is None
+    assert cache.get(make_key(cache, "Café  fermé.")) is None
+
+
+def test_max_entries():
+    cache = TranslationCache(max_entries=3)
+    keys = [make_key(cache, f"Sentence {k}.") for k in range(5)]
+    evicted = []
+    for key in keys:
+        evicted.extend(cache.put(key, "Phrase."))
+    assert evicted == keys[:2]
+    assert len(cache) == 3
+
+
+def test_max_bytes():
+    # Each entry is 4 bytes of sentence + 4 bytes of translation
+    cache = TranslationCache(max_entries=100, max_bytes=20)
+    keys = [make_key(cache, f"S{k:02d}.") for k in range(3)]
+    cache.put(keys[0], "T00.")
+    cache.put(keys[1], "T01.")
+    assert cache.n_bytes == 16
+    assert cache.put(keys[2], "T02.") == [keys[0]]
+    assert cache.n_bytes == 16
+    assert len(cache) == 2
+
+
+def test_entry_larger_than_max_bytes_is_not_stored():
+    cache = TranslationCache(max_entries=100, max_bytes=10)
+    small = make_key(cache, "Hi.")
+    cache.put(small, "Salut.")
+    assert cache.put(make_key(cache, "A much longer sentence."), "Une phrase.") == []
+    assert cache.get(small) == "Salut."
+    assert len(cache) == 1
+
+
+def test_disabled():
+    cache = TranslationCache(max_entries=0)
+    key = make_key(cache, "One.")
+    assert not cache.enabled
+    assert cache.put(key, "Un.") == []
+    assert cache.get(key) is None
+    assert len(cache) == 0